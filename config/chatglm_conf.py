@@ -59,6 +59,7 @@ chatglm_conf = {
         ],
         
         "auto_quantize": False, # 是否自动量化模型
+        # "fallback": "chatglm2-6b-int4", # 熔断时改发到的模型 , 见 config/main.py global_breaker_args
         "model_config": {
             "model_type": "chatglm2",
             "model_name_or_path": "/data/nlp/pre_models/torch/chatglm2/chatglm2-6b",
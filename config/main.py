@@ -2,6 +2,8 @@
 # @Time:  18:46
 # @Author: tk
 # @File：constant_map
+import importlib
+import sys
 from config.utils.env_check import check_config
 from config.baichuan_conf import baichuan_config
 from config.bloom_conf import bloom_conf
@@ -12,11 +14,27 @@ from config.moss_conf import moss_conf
 from config.opt_conf import opt_conf
 from config.rwkv_conf import rwkv_conf
 from config.qwen_conf import qwen_conf
+from config.mock_conf import mock_conf
 
 
 __all__ = [
     'global_models_info_args',
-    'global_serve_args'
+    'global_serve_args',
+    'global_scheduler_args',
+    'global_request_log_args',
+    'global_session_args',
+    'global_stream_args',
+    'global_context_args',
+    'global_token_ipc_args',
+    'global_ipc_args',
+    'global_worker_args',
+    'global_autoscale_args',
+    'global_cluster_args',
+    'global_hedge_args',
+    'global_breaker_args',
+    'global_load_args',
+    'global_artifact_args',
+    'load_models_info_args',
 ]
 
 # 资源充足可以全部启用 , 并导入 global_models_info_args
@@ -30,6 +48,7 @@ global_models_info_args = {
     # **opt_conf,
     # **rwkv_conf,
      **qwen_conf,
+    # **mock_conf,
 
 }
 
@@ -39,9 +58,239 @@ global_serve_args = {
     "workers":4
 }
 
+# 请求调度 , 优先级分类 + 同一优先级内按 api key 加权公平排队
+global_scheduler_args = {
+    "enable": True,
+    "max_inflight": None,  # 每个模型同时下发到 worker 的请求数 , None 则等于 worker 数
+    "priority_classes": ["interactive", "standard", "batch"],  # 优先级从高到低
+    "default_priority": "standard",
+    "starvation_timeout": 30,  # 秒 , 等待超过该时间的请求优先下发 , 防止饿死
+    "max_queue_size": 1024,  # 每个模型最大排队数
+    # 秒 , 排队超时返回错误 ; 同步接口排队时占用线程池的一个线程 , 线程池按 排队上限 + 并发上限 + threadpool_reserve 设置 ,
+    # 排队满时直接返回错误 , 不会因线程耗尽阻塞新请求和监控接口
+    "queue_timeout": 120,
+    "threadpool_reserve": 64,
+    "tenant_weights": {
+        # api_key: 权重 , 默认 1
+    },
+    "tenant_priority": {
+        # api_key: 默认优先级
+    },
+}
+
+# 请求日志 , 后台线程批量写 json lines , 按路由采样
+global_request_log_args = {
+    "enable": True,
+    "path": "./logs/request.log",
+    "max_bytes": 100 * 1024 * 1024,  # 单文件大小 , 超过则滚动
+    "backup_count": 5,
+    "sample_rate": {
+        "default": 1.0,
+        # "/chat": 0.1,
+    },
+    "body_mode": "truncate",  # one of truncate,hash,full
+    "max_field_length": 512,  # 超过长度的字段截断或哈希
+    "batch_size": 256,
+    "flush_interval": 1.0,
+    "queue_size": 10000,  # 队列满则丢弃并计数
+}
+
+# 服务端会话 , 请求带 conversation_id 时只需发送本轮消息
+global_session_args = {
+    "enable": True,
+    "max_sessions": 10000,  # LRU 上限
+    "ttl": 3600,  # 秒 , 超时未使用的会话被清理
+    "max_turns": 64,  # 每个会话保留的最大轮数
+}
+
+# openai 流式续传 , 断线后带 Last-Event-ID 重新请求从断点继续
+global_stream_args = {
+    "enable": True,
+    "max_events": 4096,  # 每个流最多缓存的事件数
+    "grace_period": 60,  # 秒 , 断线后或生成结束后缓存保留时间 , 断线超时无人续传则停止生成
+    "max_streams": 10000,
+    "max_producers": 256,  # 同时后台生成的流数上限 , 超出的按普通流式请求处理 , 不支持续传
+}
+
+# 入队前按上下文长度裁剪历史 , 模型配置可单独设置 max_context_length
+global_context_args = {
+    "enable": True,
+    "policy": "drop_oldest",  # one of drop_oldest,trim_oldest,reject
+    "turn_overhead": 8,  # 每轮对话模板额外 token
+    "safety_margin": 0.2,  # 没有分词进程池 ( global_token_ipc_args ) 时按字符估算 token 数 , 估算值放大的比例
+    # 按 model_type 的默认上下文长度
+    "max_context_length": {
+        "default": 2048,
+        "baichuan": 4096,
+        "chatglm": 2048,
+        "chatglm2": 8192,
+        "internlm": 2048,
+        "llama": 4096,
+        "bloom": 2048,
+        "opt": 2048,
+        "moss": 2048,
+        "qwen": 8192,
+        "rwkv": 4096,
+    },
+}
+
+# token id 模式 , 对话模板和分词在前端分词进程池 , worker 只收发 token id , 前端增量解码
+# 支持 model_type: llama opt bloom chatglm2 , 模型配置 token_ipc 可单独开关
+global_token_ipc_args = {
+    "enable": False,
+    "num_workers": 2,  # 每个模型的分词进程数
+}
+
+# 前端和 worker 之间的消息编码 , binary 紧凑二进制帧 (流式只发增量) , pickle 旧格式
+global_ipc_args = {
+    "codec": "binary",
+}
+
+# 多 worker 调度 , 模型配置里的 balance 优先
+# balance: least_work 按在途请求和剩余 token 数选择 worker , round_robin 轮询
+# heartbeat_interval: worker 心跳间隔(秒) , 上报当前请求已生成 token 数 , 0 关闭
+# affinity: 会话和公共前缀的请求按一致性哈希路由到同一 worker , 提高 worker 内前缀缓存命中
+# affinity_prefix_chars: 无会话时取 prompt 开头多少字符计算路由 , 短于 affinity_min_prefix_chars 不做亲和
+# load_factor: 有界负载 , 首选 worker 在途请求超过平均值的倍数后回退到哈希环上的下一个
+global_worker_args = {
+    "balance": "least_work",
+    "heartbeat_interval": 1.0,
+    "affinity": True,
+    "affinity_prefix_chars": 256,
+    "affinity_min_prefix_chars": 64,
+    "load_factor": 1.25,
+    "virtual_nodes": 160,
+    # supervise: 后台检查 worker , 退出 , 初始化失败 , 心跳超时 , 卡死时按退避时间重启
+    # heartbeat_timeout: 心跳超时(秒) , stall_timeout: 处理请求时无生成进度的最长时间(秒)
+    # restart_backoff max_restart_backoff: 重启退避(秒) , 连续失败翻倍
+    # max_retries: 故障 worker 上还没返回结果的请求在其他 worker 重试次数
+    # ipc_timeout: 前端等待下一个结果帧的最长时间(秒)
+    "supervise": True,
+    "check_interval": 2.0,
+    "heartbeat_timeout": 30,
+    "stall_timeout": 600,
+    "restart_backoff": 1,
+    "max_restart_backoff": 60,
+    "max_retries": 1,
+    "ipc_timeout": 600,
+    # worker 回收 , 任一超限时先启动新进程预热 , ready 后接替 , 旧进程处理完在途请求后退出 , 0 不限制
+    # 预热期间新旧进程同时占用显存 , 模型配置里同名字段优先
+    # max_requests: 处理请求数 , max_rss: 常驻内存(MB) , max_age: 运行时间(秒)
+    # recycle_timeout: 新进程预热和旧进程排空的最长时间(秒)
+    "max_requests": 0,
+    "max_rss": 0,
+    "max_age": 0,
+    "recycle_timeout": 600,
+    # 启动屏障 , 启动时最多等待所有模型加载完成的秒数 , 0 不等待 ; 模型就绪前请求直接返回错误 , 就绪状态 GET /ready
+    "startup_wait": 0,
+    # 退出时排空 , 不再接收新请求 , 最多等待在途请求完成的秒数 , 滚动重启 POST /admin/rolling_restart
+    "drain_timeout": 60,
+    # 配置热加载 , kill -HUP 或 POST /admin/reload_config , 配置变化的模型启动新 worker 组 , 最多等待其就绪的秒数
+    "reload_timeout": 600,
+}
+
+# 按排队时间自动增减 worker , 模型配置 "autoscale": {"min_workers": 1, "max_workers": 4, "device_pool": [...]} 开启
+# scale_up_wait: 最早排队请求已等待 , 或上次检查以来下发的请求平均排队超过该秒数时扩容一个 worker ; 新 worker 就绪后才提高调度并发上限
+# scale_down_utilization: 无排队且在途请求数 / worker 数不超过该值持续 scale_down_delay 秒后缩容一个 worker
+# up_cooldown down_cooldown: 距上一次扩缩容的最短间隔秒数 , 扩容的 worker 加载完成前不再扩容
+# max_workers_per_device: 各模型共享显卡 , 同一设备上最多运行的 worker 数
+# dry_run: 只记录扩缩容决策不执行 , 配合 mock 模型 ( config/mock_conf.py ) 和 tests/sim_autoscale.py 评估策略
+global_autoscale_args = {
+    "enable": False,
+    "interval": 5,
+    "scale_up_wait": 10,
+    "scale_down_utilization": 0.5,
+    "scale_down_delay": 300,
+    "up_cooldown": 60,
+    "down_cooldown": 300,
+    "max_workers_per_device": 1,
+    "dry_run": False,
+}
+
+# 多机部署 , role: standalone 单机 ; gateway 网关 , 在 gateway_bind 接收 node 连接 , 把 node 上报的模型加入本机 api , 也可以同时有本地模型 ;
+# node 工作节点 , 连接 gateway_addr , 通过心跳上报本机模型的 worker 数和就绪状态 , 执行网关转发的请求
+# node_id: node 名称 , None 则为 主机名:端口 ; heartbeat_timeout: 网关判定 node 故障的秒数 , 其未返回结果的请求在其他 node 重试 max_retries 次
+# secret: 网关和 node 相同的共享密钥 , 心跳 请求 结果帧都用其签名 , 签名不对的帧丢弃 ; gateway_bind 或 gateway_addr 不是本机地址时必须设置
+# 连接不加密 , 跨不可信网络部署时放在内网或 vpn 内
+global_cluster_args = {
+    "role": "standalone",
+    "gateway_bind": "tcp://127.0.0.1:8091",
+    "gateway_addr": "tcp://127.0.0.1:8091",
+    "secret": None,
+    "node_id": None,
+    "heartbeat_interval": 1.0,
+    "heartbeat_timeout": 10,
+    "max_retries": 1,
+    # node 同时处理的网关请求数
+    "max_concurrency": 256,
+}
+
+# 请求对冲 , 降低短请求的尾延迟 , 只用于本机 worker 的非流式请求 , 且 max_new_tokens 不超过 max_new_tokens
+# 等待超过近期同类请求延迟的 percentile 分位数 ( 不低于 min_delay 秒 , 样本少于 min_samples 时不对冲 ) 仍无结果 ,
+# 复制一份发往负载最低的其他 worker , 先返回的结果生效 , 另一份取消 : 尚未开始执行的直接跳过 , 已开始的结果丢弃
+# budget_ratio: 全局预算 , 对冲数不超过请求数的该比例 , 最多累积 budget_burst 次 , 避免放大负载
+# cancel_slots: 每组 worker 共享内存中的取消标记数
+global_hedge_args = {
+    "enable": False,
+    "max_new_tokens": 128,
+    "percentile": 0.95,
+    "min_delay": 0.05,
+    "window": 500,
+    "min_samples": 50,
+    "budget_ratio": 0.05,
+    "budget_burst": 10,
+    "cancel_slots": 4096,
+}
+
+# 熔断 , 按模型统计最近 window 秒的请求 , 请求数不少于 min_requests 且失败率达到 error_rate 时熔断 ,
+# 失败包括返回错误 , 超时 , worker 不可用 , 以及处理耗时 ( 不含排队 ) 超过 slow_call_seconds 秒 ( 0 不按耗时判断 )
+# 熔断期间请求直接返回错误 , 排队中的请求同样处理 ; 模型配置 "fallback": "模型名" 时改发到该模型 , 如 chatglm2-6b 改发到 chatglm2-6b-int4
+# open_time 秒后放行 half_open_requests 个探测请求 , 成功则恢复 , 失败则再次熔断 , 时间加倍 , 最长 max_open_time 秒
+# 模型配置 "breaker": {...} 可单独设置以上参数
+global_breaker_args = {
+    "enable": False,
+    "window": 60,
+    "min_requests": 10,
+    "error_rate": 0.5,
+    "slow_call_seconds": 0,
+    "open_time": 30,
+    "max_open_time": 300,
+    "half_open_requests": 1,
+}
+
+# 模型加载 , lazy_load: 权重为 safetensors 且安装了 accelerate 时 , 先构建空模型 ( meta device ) ,
+# 再 mmap 各 shard 逐个参数直接转为目标 dtype 放到目标设备 , 不再先在内存中生成完整的 state dict , 峰值内存约为模型大小
+# 需要量化 , 合并 lora 或 cpu fork 模式时加载到 cpu , 否则直接加载到 gpu ; 模型配置 "lazy_load": False 单独关闭
+# prefetch_threads: 后台并行预读权重文件到 page cache 的线程数 , 同一机器加载同一模型的进程共享 page cache
+global_load_args = {
+    "lazy_load": True,
+    "prefetch_threads": 4,
+}
+
+# 模型产物缓存 , 单个 lora 合并 ( merge_and_unload ) 或自动量化 ( quantize ) 后的权重首次加载后保存到 cache_dir , 之后启动直接加载
+# key 由基础权重 , lora 权重 ( 文件名 大小 修改时间 ) , 模型类型 , auto_quantize , torch 版本决定 , 任一变化重新生成
+# verify_hash: 加载前校验 sha256 , 否则只校验文件大小 ; 总大小超过 max_size_gb 时按最近使用时间淘汰
+# 模型配置 "artifact_cache": True 可单独开启
+global_artifact_args = {
+    "enable": False,
+    "cache_dir": "./cache/artifacts",
+    "max_size_gb": 100,
+    "verify_hash": True,
+}
+
 
 check_config(global_models_info_args)
 
 
+def load_models_info_args():
+    '''
+        配置热加载 , 重新读取 config/*_conf.py 和本文件 , 返回新的 global_models_info_args
+        只有模型配置生效 , 其他配置仍需重启
+    '''
+    for name in [_ for _ in sys.modules if _.startswith('config.') and _.endswith('_conf')]:
+        importlib.reload(sys.modules[name])
+    return importlib.reload(sys.modules[__name__]).global_models_info_args
+
+
 
 
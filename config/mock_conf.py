@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/13 10:20
+
+# 模拟引擎 , 不加载模型 , 在 CPU 上测试调度 扩缩容等策略
+mock_conf = {
+    "mock-chat": {
+        "enable": False,
+        "work_mode": "hf",
+        "workers": [
+            {
+                "device_id": None  # 不设置 CUDA_VISIBLE_DEVICES
+            }
+        ],
+        # cpu 模式 , 模型加载一次后 fork 出各 worker , 权重内存 copy-on-write 共享 , 要求所有 worker device_id 为 None
+        "fork_workers": False,
+        # fork 模式每个 worker 的 torch 线程数 , 不设置时按 cpu 核数平分
+        # "cpu_threads": 4,
+        # 自动扩缩容 , 见 config/main.py global_autoscale_args , 其他参数也可在这里单独设置
+        "autoscale": {
+            "min_workers": 1,
+            "max_workers": 4,
+            # 扩容时按顺序选用的设备 , 不设置时复用最后一个 worker 的配置
+            # "device_pool": [[1], [2], [3]],
+        },
+        "model_config": {
+            "model_type": "mock",
+            "load_time": 2,  # 模拟加载耗时 秒
+            "prefill_latency": 0.0005,  # 每个输入 token 秒
+            "token_latency": 0.02,  # 每个输出 token 秒
+            "max_new_tokens": 64,
+            "weight_mb": 0,  # 模拟权重占用的内存 MB
+            "lora": {},
+        }
+    },
+}
@@ -0,0 +1,11 @@
+#!/usr/bin/env bash
+
+# 重新加载模型配置 ( config/*_conf.py ) , 只启动 停止 或调整变化的模型 , 其余模型继续服务
+# worker 是主进程 fork 的子进程 , 命令行相同 , 只向父进程不是 serving/main 的进程发送信号
+
+main_pids() {
+  ps -eo pid,ppid,args | grep python | grep "serving/main" | grep -v grep | \
+    awk '{pid[NR]=$1; ppid[NR]=$2; s[$1]=1} END {for (i in pid) if (!(ppid[i] in s)) print pid[i]}'
+}
+
+main_pids | xargs -I{} kill -HUP {}
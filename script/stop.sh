@@ -1,5 +1,21 @@
 #!/usr/bin/env bash
 
-ps -ef | grep python |grep "serving/main" | awk '{print $2}' |xargs -I{} kill {}
+# 先向主进程发送 SIGTERM , 服务停止监听并排空在途请求 ( global_worker_args drain_timeout ) , 超时后再强制退出
+# worker 是主进程 fork 的子进程 , 命令行相同 , 只向父进程不是 serving/main 的进程发送信号
+timeout=${DRAIN_TIMEOUT:-90}
 
-ps -ef | grep python |grep "serving/main" | awk '{print $2}' |xargs -I{} kill -9 {}
+main_pids() {
+  ps -eo pid,ppid,args | grep python | grep "serving/main" | grep -v grep | \
+    awk '{pid[NR]=$1; ppid[NR]=$2; s[$1]=1} END {for (i in pid) if (!(ppid[i] in s)) print pid[i]}'
+}
+
+main_pids | xargs -I{} kill {}
+
+for i in $(seq 1 ${timeout}); do
+  if [ -z "$(ps -ef | grep python |grep "serving/main" | grep -v grep)" ]; then
+    exit 0
+  fi
+  sleep 1
+done
+
+ps -ef | grep python |grep "serving/main" | grep -v grep | awk '{print $2}' |xargs -I{} kill -9 {}
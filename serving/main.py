@@ -10,9 +10,11 @@ root_dir = os.path.join(os.path.dirname(__file__),"..")
 root_dir = os.path.abspath(root_dir)
 sys.path.append(root_dir)
 
+import inspect
+import threading
 import time
 import uvicorn
-from config.main import global_serve_args
+from config.main import global_serve_args, global_worker_args
 from serving.utils import logger
 from serving.serve.api import global_instance,app
 
@@ -32,12 +34,20 @@ if __name__ == '__main__':
     remove_dir(tmp_dir)
     os.environ['ZEROMQ_SOCK_TMP_DIR'] = tmp_dir
 
-    global_instance().work_node.create()
-    config = uvicorn.Config(app, lifespan='off',**global_serve_args)
+    global_instance().startup()
+    # kill -HUP ( script/reload.sh ) 重新加载模型配置 , 后台执行
+    if hasattr(signal,'SIGHUP'):
+        signal.signal(signal.SIGHUP,lambda signum,frame: threading.Thread(target=global_instance().reload_config,daemon=True).start())
+    serve_args = dict(global_serve_args)
+    # 收到 SIGTERM 后停止监听 , 等待在途请求 ( 包括流式 ) 完成
+    if 'timeout_graceful_shutdown' in inspect.signature(uvicorn.Config).parameters:
+        serve_args.setdefault('timeout_graceful_shutdown', global_worker_args["drain_timeout"])
+    # 模型已在上面启动 , app 的 startup 只设置线程池
+    config = uvicorn.Config(app, lifespan='on',**serve_args)
     try:
         uvicorn.Server(config).run()
     except Exception as e:
         print(e)
     # threading.main_thread().is_alive()
     # signal.pthread_kill(threading.main_thread().ident, signal.SIGTSTP)
-    global_instance().work_node.release()
+    global_instance().shutdown()
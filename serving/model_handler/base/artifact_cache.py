@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/15 10:30
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import typing
+from serving.utils import logger
+
+__all__ = [
+    'ArtifactCache',
+    'fingerprint_dir',
+]
+
+# 缓存格式变化时修改 , 旧的缓存不再命中
+_VERSION = 1
+_MANIFEST = 'manifest.json'
+
+
+def fingerprint_dir(path, names: typing.Optional[typing.List[str]] = None):
+    '''
+        目录下文件的 (文件名 , 大小 , 修改时间) , 不读取文件内容 , 权重文件被替换或修改后指纹变化
+    '''
+    if not path or not os.path.isdir(path):
+        return path
+    names = names if names is not None else sorted(os.listdir(path))
+    files = []
+    for name in names:
+        file = os.path.join(path, name)
+        if os.path.isfile(file):
+            stat = os.stat(file)
+            files.append((name, stat.st_size, stat.st_mtime_ns))
+    return [os.path.abspath(path), files]
+
+
+def _sha256(file, block_size=16 * 1024 * 1024):
+    h = hashlib.sha256()
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with open(file, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+class ArtifactCache:
+    '''
+        本地磁盘上的模型产物缓存 ( 合并 lora , 量化后的权重 ) , 每个 key 一个目录 , 内容为 save_pretrained 的输出 和 manifest.json
+        写入先到临时目录 , 完成后 rename , 读到的目录总是完整的 ; 同一 key 同时只有一个进程写入
+        读取时按 manifest 校验文件大小 , verify_hash 时再校验 sha256 , 不一致的删除
+        写入后按最近使用时间淘汰 , 总大小不超过 max_size_gb
+    '''
+    def __init__(self, cache_dir, max_size_gb=100, verify_hash=True, **kwargs):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.verify_hash = verify_hash
+
+    @staticmethod
+    def make_key(info: typing.Dict):
+        return hashlib.sha256(json.dumps([_VERSION, info], sort_keys=True, default=str).encode('utf-8')).hexdigest()[:32]
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key) -> typing.Optional[str]:
+        path = self._path(key)
+        manifest_file = os.path.join(path, _MANIFEST)
+        if not os.path.exists(manifest_file):
+            return None
+        try:
+            with open(manifest_file, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            for name, item in manifest['files'].items():
+                file = os.path.join(path, name)
+                if os.path.getsize(file) != item['size']:
+                    raise ValueError('{} size mismatch'.format(name))
+                if self.verify_hash and _sha256(file) != item['sha256']:
+                    raise ValueError('{} sha256 mismatch'.format(name))
+        except Exception as e:  # noqa
+            logger.error('artifact {} corrupted , removed : {}'.format(key, e))
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        # 记录最近使用时间 , 用于淘汰
+        os.utime(manifest_file)
+        return path
+
+    def put(self, key, save_fn: typing.Callable[[str], None], info: typing.Optional[typing.Dict] = None):
+        '''
+            save_fn(目录) 写入产物 , 其他进程正在写入同一 key 时跳过 , 返回缓存目录 , 失败返回 None
+        '''
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        lock_file = open(path + '.lock', 'w')
+        try:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return None
+            if os.path.exists(os.path.join(path, _MANIFEST)):
+                return path
+            tmp_path = '{}.tmp.{}'.format(path, os.getpid())
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            start = time.time()
+            try:
+                save_fn(tmp_path)
+                files = {}
+                for root, _, names in os.walk(tmp_path):
+                    for name in names:
+                        file = os.path.join(root, name)
+                        files[os.path.relpath(file, tmp_path)] = {
+                            "size": os.path.getsize(file),
+                            "sha256": _sha256(file),
+                        }
+                with open(os.path.join(tmp_path, _MANIFEST), 'w', encoding='utf-8') as f:
+                    json.dump({"key": key, "info": info, "created": time.time(), "files": files},
+                              f, ensure_ascii=False, indent=2, default=str)
+                shutil.rmtree(path, ignore_errors=True)
+                os.rename(tmp_path, path)
+            except Exception as e:  # noqa
+                logger.error('artifact {} save error {}'.format(key, e))
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                return None
+            logger.info('artifact {} saved in {:.1f}s'.format(key, time.time() - start))
+        finally:
+            lock_file.close()
+        self.cleanup(keep=key)
+        return path
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            manifest_file = os.path.join(path, _MANIFEST)
+            if not os.path.isdir(path) or not os.path.exists(manifest_file):
+                continue
+            size = sum(os.path.getsize(os.path.join(root, _)) for root, _d, names in os.walk(path) for _ in names)
+            entries.append((os.path.getmtime(manifest_file), name, size))
+        return entries
+
+    def cleanup(self, keep=None):
+        '''
+            按最近使用时间淘汰 , 直到总大小不超过 max_size , keep 不淘汰 ; 顺带删除一天前残留的临时目录
+        '''
+        if not os.path.isdir(self.cache_dir):
+            return
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if '.tmp.' in name and now - os.path.getmtime(path) > 86400:
+                shutil.rmtree(path, ignore_errors=True)
+        entries = sorted(self._entries())
+        total = sum(_[2] for _ in entries)
+        for _, name, size in entries:
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            logger.info('artifact {} evicted , {:.1f} MB'.format(name, size / 1024 / 1024))
+            shutil.rmtree(self._path(name), ignore_errors=True)
+            self._remove_lock(name)
+            total -= size
+
+    def _remove_lock(self, key):
+        # 没有进程持有时删除锁文件
+        try:
+            with open(self._path(key) + '.lock', 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(self._path(key) + '.lock')
+        except OSError:
+            pass
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # @Author  : ssbuild
 # @Time    : 2023/7/21 10:53
+import json
 import logging
 import os
 import time
@@ -15,10 +16,11 @@ import threading
 from multiprocessing import Queue
 from deep_training.nlp.models.lora.v2 import LoraModel
 from serving.model_handler.base.data_define import WorkMode
-
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+from serving.model_handler.base.loader import get_weight_files, is_safetensors, can_lazy_load, prefetch_files
+from serving.model_handler.base.artifact_cache import ArtifactCache, fingerprint_dir
+from serving.model_handler.base.streamer import TokenIdStreamer
+from serving.utils import logger
+from config.main import global_load_args, global_artifact_args
 
 class EngineAPI_Base(ABC):
     def __init__(self,model_config_dict,group_name="",worker_idx=0):
@@ -31,6 +33,8 @@ class EngineAPI_Base(ABC):
         self.model = None
 
         self.auto_quantize = model_config_dict.get('auto_quantize',True)
+        # cpu fork 模式 , 权重留在 cpu , 由 ForkServer 加载一次后 fork 出各 worker
+        self.fork_workers = model_config_dict.get('fork_workers',False)
         self.lora_model: typing.Optional[LoraModel] = None
         self.current_adapter_name = ''
         self.lora_conf = model_config_dict['model_config']['lora']
@@ -70,8 +74,34 @@ class EngineAPI_Base(ABC):
         if self._q_out is None:
             self._q_out = multiprocessing.Manager().Queue()
 
+    def _prefetch_weights(self):
+        '''
+            后台预读权重文件到 page cache , 磁盘读取与 cuda 初始化 , 模型构建并行
+        '''
+        path = self.model_config_dict['model_config'].get('model_name_or_path',None)
+        prefetch_files(get_weight_files(path),global_load_args["prefetch_threads"])
+
+    def _get_load_kwargs(self,device_id=None,on_cpu=False):
+        '''
+            MyTransformer ( from_pretrained ) 的加载参数 , 权重为 safetensors 时构建空模型 , mmap 逐个参数加载到目标 dtype 和设备 ,
+            on_cpu 为 True ( 之后量化 , 合并 lora ) 或 cpu fork 模式时加载到 cpu , 之后由 _to_device 移动
+        '''
+        if not self.model_config_dict.get('lazy_load',global_load_args["lazy_load"]):
+            return {}
+        if self.work_mode != WorkMode.STANDORD_HF or self.world_size > 1:
+            return {}
+        files = get_weight_files(self.model_config_dict['model_config'].get('model_name_or_path',None))
+        if not is_safetensors(files) or not can_lazy_load():
+            return {}
+        if on_cpu or self.fork_workers:
+            device = 'cpu'
+        else:
+            device = torch.cuda.current_device() if device_id is None else device_id
+        return dict(low_cpu_mem_usage=True,device_map={"": device})
+
     def init(self):
         skip_init = False
+        self._prefetch_weights()
         self._init_data()
         if self.world_size > 1 and self.muti_lora_num <= 1:
             if self.work_mode_str == 'deepspeed':
@@ -90,19 +120,163 @@ class EngineAPI_Base(ABC):
         self._init_thead_generator()
         logger.info('serving ready')
 
+    def init_shared(self):
+        '''
+            fork 模式在 ForkServer 中调用 , 只加载模型 , 队列和生成线程在 fork 后由 init_forked 创建
+        '''
+        self._prefetch_weights()
+        self.work_mode_str = 'hf'
+        self.init_model()
+        model = self.get_model()
+        if hasattr(model,'requires_grad_'):
+            model.requires_grad_(False)
+
+    def init_forked(self):
+        '''
+            fork 出的 worker 中调用 , 线程和 Manager 队列不能跨 fork 继承 , 重新创建
+        '''
+        self._q_in = None
+        self._q_out = None
+        self._init_data()
+        self._init_thead_generator()
+        logger.info('serving ready')
+
+    def _to_device(self,model,device_id=None):
+        if self.fork_workers:
+            # 量化权重 ( 已量化的 checkpoint ) 的算子只支持 cuda , float() 也会转换量化层的 scale
+            assert not getattr(model,'quantized',False), \
+                ValueError('{} fork_workers run on cpu , quantized model not support'.format(self.group_name))
+            # cpu 不支持大部分 half 算子 , 使用 float32
+            return model.float()
+        if device_id is None:
+            return model.cuda()
+        return model.cuda(device_id)
+
     def init_model(self, device_id=None):
         self.model_config_dict['seed'] = None
+        cache = self._get_artifact_cache()
+        if cache is not None:
+            info = self._get_artifact_info()
+            key = cache.make_key(info)
+            source_quantized = self._is_source_quantized()
+            path = cache.get(key)
+            if path is not None:
+                start = time.time()
+                self.model, self.config, self.tokenizer = self._load_artifact(path,device_id)
+                logger.info('{} load artifact {} {:.1f}s'.format(self.group_name,key,time.time() - start))
+                return
+
         if self.muti_lora_num > 0:
             call_method = self._load_lora_model
         else:
             call_method = self._load_model
 
         self.model, self.config, self.tokenizer = call_method(device_id)
+        if cache is not None and (self.muti_lora_num == 1 or (getattr(self.model,'quantized',False) and not source_quantized)):
+            cache.put(key,self._save_artifact,info)
+
+    def _get_artifact_cache(self):
+        '''
+            合并 lora , 量化后的权重缓存到本地磁盘 , 之后启动直接加载 , 只用于单进程 hf 模式 , 多个 lora 不合并 , 不缓存
+        '''
+        if not self.model_config_dict.get('artifact_cache',global_artifact_args["enable"]):
+            return None
+        if self.work_mode != WorkMode.STANDORD_HF or self.world_size > 1 or self.muti_lora_num > 1:
+            return None
+        return ArtifactCache(**global_artifact_args)
+
+    def _get_artifact_info(self):
+        '''
+            缓存 key 的来源 : 模型类型 , 基础权重 , lora 权重 , 量化设置
+        '''
+        model_config = self.model_config_dict['model_config']
+        path = model_config.get('model_name_or_path',None)
+        return {
+            "model_type": model_config.get('model_type',None),
+            "handler": self.__class__.__module__,
+            "base": fingerprint_dir(path,[os.path.basename(_) for _ in get_weight_files(path)] + ['config.json']),
+            "lora": {k: fingerprint_dir(v) for k,v in self.lora_conf.items()},
+            "auto_quantize": self.auto_quantize,
+            "torch": torch.__version__,
+        }
+
+    def _is_source_quantized(self):
+        path = self.model_config_dict['model_config'].get('model_name_or_path',None)
+        try:
+            with open(os.path.join(path,'config.json'),'r',encoding='utf-8') as f:
+                return bool(json.load(f).get('quantization_bit',0))
+        except Exception: # noqa
+            return False
+
+    def _save_artifact(self,path):
+        model = self.model
+        if isinstance(model,LoraModel):
+            # 已合并 , 只保存基础模型
+            model = model.model
+        model.save_pretrained(path)
+
+    def _load_artifact(self,path,device_id=None):
+        '''
+            按已合并 lora , 已量化的普通模型加载 , 配置 ( 含 quantization_bit ) 使用缓存目录 , tokenizer 仍使用原目录
+        '''
+        model_config = self.model_config_dict['model_config']
+        lora_conf = self.lora_conf
+        self.model_config_dict['model_config'] = dict(model_config,model_name_or_path=path,config_name=path,
+                                                      tokenizer_name=model_config.get('tokenizer_name',None) or model_config['model_name_or_path'],
+                                                      lora={})
+        self.lora_conf = {}
+        try:
+            return self._load_model(device_id)
+        finally:
+            self.model_config_dict['model_config'] = model_config
+            self.lora_conf = lora_conf
+            # lora 已合并 , 不再切换
+            if len(lora_conf) == 1:
+                self.current_adapter_name = list(lora_conf.keys())[0]
 
     def get_model(self):
         return self.model_ds or self.model_accelerate or self.model
 
 
+    def _get_ids_generate_kwargs(self,kwargs):
+        config = getattr(self,'config',None)
+        eos_token_id = getattr(config,'eos_token_id',None) or getattr(self.tokenizer,'eos_token_id',None)
+        default_kwargs = dict(
+            eos_token_id=eos_token_id,
+            pad_token_id=getattr(config,'pad_token_id',None) or eos_token_id,
+            do_sample=True, top_p=0.7, temperature=0.95,
+        )
+        default_kwargs.update({k: v for k,v in kwargs.items() if k not in ['nchar','gtype','history']})
+        return default_kwargs
+
+    def _get_input_ids_tensor(self,input_ids):
+        model = self.get_model()
+        return torch.tensor([input_ids],dtype=torch.long,device=model.device)
+
+    def chat_ids(self,input_ids,**kwargs):
+        '''
+            token id 模式 , 模板和分词在前端完成 , 返回生成的 token id
+        '''
+        default_kwargs = self._get_ids_generate_kwargs(kwargs)
+        inputs = self._get_input_ids_tensor(input_ids)
+        outputs = self.get_model().generate(input_ids=inputs,**default_kwargs)
+        output_ids = outputs[0][inputs.shape[-1]:].tolist()
+        eos_token_id = default_kwargs.get('eos_token_id',None)
+        return [_ for _ in output_ids if _ != eos_token_id]
+
+    def chat_stream_ids(self,input_ids,nchar=1,**kwargs):
+        '''
+            token id 模式 , 只推送 token id , 增量解码在前端完成
+        '''
+        default_kwargs = self._get_ids_generate_kwargs(kwargs)
+        def process_ids_fn(ids):
+            self.push_response(((ids, None), 0, "ok", False))
+
+        streamer = TokenIdStreamer(process_ids_fn,nchar=nchar,skip_word_list=[default_kwargs.get('eos_token_id',None)])
+        self.get_model().generate(input_ids=self._get_input_ids_tensor(input_ids),streamer=streamer,**default_kwargs)
+        self.push_response((([], None), 0, "ok", True))
+        return None
+
     def chat_stream(self,query,nchar=1,gtype='total',**kwargs):
         raise NotImplemented
 
@@ -120,6 +294,8 @@ class EngineAPI_Base(ABC):
             from deepspeed.inference.engine import InferenceEngine
             torch.cuda.set_device(rank)
             dist.init_process_group("nccl", rank=rank, world_size=self.world_size,group_name=self.group_name + str(self.worker_idx))
+            # 请求广播走 cpu 上的 gloo , 不占用 nccl 通信
+            self._broadcast_group = dist.new_group(backend="gloo")
             self.init_model()
             old_current_device_function = deepspeed.get_accelerator().current_device_name
             def tmp_current_device_fn():
@@ -154,6 +330,14 @@ class EngineAPI_Base(ABC):
     def pull_response(self):
         return self._q_out.get()
 
+    def pull_request_ds(self):
+        '''
+            rank 0 从队列取请求并广播到其他 rank , 每个请求只入队一次 , 各 rank 按相同顺序处理
+        '''
+        objects = [self.pull_request() if self.rank == 0 else None]
+        dist.broadcast_object_list(objects, src=0, group=self._broadcast_group)
+        return objects[0]
+
     def push_response(self, data):
         if self.rank == 0:
             self._q_out.put(data)
@@ -165,7 +349,7 @@ class EngineAPI_Base(ABC):
             logging.info('\nserving is loaded , wait for serve...\n')
             logging.info('=' * 30)
         while True:
-            r = self.pull_request()
+            r = self.pull_request_ds()
             try:
                 if r.get('method', "generate") == 'chat_stream':
                     for item in self.trigger_generator(r=r, is_first=False):
@@ -266,8 +450,7 @@ class EngineAPI_Base(ABC):
     def trigger_generator(self ,r: typing.Dict,is_first=True):
         if self.work_mode == WorkMode.DS:
             if is_first:
-                for i in range(self.world_size):
-                    self.push_request(r)
+                self.push_request(r)
                 while True:
                     result_tuple = self.pull_response()
                     yield result_tuple
@@ -299,7 +482,10 @@ class EngineAPI_Base(ABC):
             if code != 0:
                 yield result,code,msg,True
 
-            gen_results = self.chat_stream(query, history=history, **params)
+            if r.get('input_ids', None) is not None:
+                gen_results = self.chat_stream_ids(r['input_ids'], **params)
+            else:
+                gen_results = self.chat_stream(query, history=history, **params)
             if gen_results is None:
                 return None
             for results in gen_results:
@@ -321,8 +507,7 @@ class EngineAPI_Base(ABC):
     def trigger(self ,r: typing.Dict,is_first=True):
         if self.work_mode == WorkMode.DS:
             if is_first:
-                for i in range(self.world_size):
-                    self.push_request(r)
+                self.push_request(r)
                 result_tuple = self.pull_response()
                 return result_tuple
 
@@ -344,7 +529,9 @@ class EngineAPI_Base(ABC):
             if code != 0:
                 return result, code, msg, True
 
-            if method == 'generate':
+            if r.get('input_ids', None) is not None:
+                result = (self.chat_ids(r['input_ids'], **params), None)
+            elif method == 'generate':
                 texts = r.get('texts', [])
                 for text in texts:
                     result.append(method_fn(text, **params))
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/14 20:10
+import importlib.util
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from serving.utils import logger
+
+__all__ = [
+    'get_weight_files',
+    'is_safetensors',
+    'can_lazy_load',
+    'prefetch_files',
+]
+
+_WEIGHT_EXT = ('.safetensors', '.bin', '.pt', '.pth')
+
+
+def get_weight_files(path):
+    '''
+        权重文件 , 按加载顺序排列 , 有 safetensors 时只返回 safetensors ( transformers 优先加载 )
+    '''
+    if not path or not os.path.isdir(path):
+        return []
+    for index_name in ['model.safetensors.index.json', 'pytorch_model.bin.index.json']:
+        index_file = os.path.join(path, index_name)
+        if not os.path.exists(index_file):
+            continue
+        try:
+            with open(index_file, 'r', encoding='utf-8') as f:
+                weight_map = json.load(f)['weight_map']
+        except Exception as e:  # noqa
+            logger.warning('read {} error {}'.format(index_file, e))
+            continue
+        # 按参数顺序去重 , 与逐个 shard 加载的顺序一致
+        files = list(dict.fromkeys(weight_map.values()))
+        return [os.path.join(path, _) for _ in files if os.path.exists(os.path.join(path, _))]
+    names = sorted(_ for _ in os.listdir(path) if _.endswith(_WEIGHT_EXT))
+    safetensors = [_ for _ in names if _.endswith('.safetensors')]
+    return [os.path.join(path, _) for _ in (safetensors or names)]
+
+
+def is_safetensors(files):
+    return bool(files) and all(_.endswith('.safetensors') for _ in files)
+
+
+def can_lazy_load():
+    # low_cpu_mem_usage 和 device_map 依赖 accelerate , mmap 依赖 safetensors
+    return importlib.util.find_spec('accelerate') is not None and importlib.util.find_spec('safetensors') is not None
+
+
+def _mem_available():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except Exception:  # noqa
+        pass
+    return None
+
+
+def _read_file(file, block_size=16 * 1024 * 1024):
+    # 读入 page cache , 复用同一块缓冲区 , 不增加常驻内存
+    buf = bytearray(block_size)
+    with open(file, 'rb', buffering=0) as f:
+        while f.readinto(buf):
+            pass
+
+
+def _advise_file(file):
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def prefetch_files(files, num_threads=4):
+    '''
+        后台多线程预读权重文件到 page cache , 与 cuda 初始化 , 模型构建并行 , 同一机器的其他进程共享 page cache
+        文件总大小超过可用内存的一半时只提示内核预读 , 避免挤出已缓存的页
+    '''
+    if not files:
+        return None
+    total = sum(os.path.getsize(_) for _ in files)
+    available = _mem_available()
+    read_through = available is not None and total <= available // 2
+    if not read_through and not hasattr(os, 'posix_fadvise'):
+        return None
+
+    def prefetch(file):
+        try:
+            if read_through:
+                _read_file(file)
+            else:
+                _advise_file(file)
+        except OSError:
+            pass
+
+    def run():
+        with ThreadPoolExecutor(max_workers=max(1, min(num_threads, len(files)))) as executor:
+            list(executor.map(prefetch, files))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
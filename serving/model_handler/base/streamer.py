@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/11 14:20
+import typing
+
+__all__ = [
+    'TokenIdStreamer'
+]
+
+
+class TokenIdStreamer:
+    '''
+        generate 的 streamer , 只收集 token id 不解码 , 每 nchar 个 token 回调一次 , 解码在前端做
+    '''
+    def __init__(self, process_ids_fn: typing.Callable, nchar=1, skip_word_list=None, skip_prompt=True):
+        self.process_ids_fn = process_ids_fn
+        self.nchar = max(1, nchar or 1)
+        self.skip_word_list = set(skip_word_list or [])
+        self.skip_prompt = skip_prompt
+        self.next_tokens_are_prompt = True
+        self.cache = []
+
+    def put(self, value):
+        if len(value.shape) > 1 and value.shape[0] > 1:
+            raise ValueError("TokenIdStreamer only supports batch size 1")
+        elif len(value.shape) > 1:
+            value = value[0]
+
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+
+        ids = [_ for _ in value.tolist() if _ not in self.skip_word_list]
+        if not ids:
+            return
+        self.cache.extend(ids)
+        if len(self.cache) >= self.nchar:
+            self.process_ids_fn(self.cache)
+            self.cache = []
+
+    def end(self):
+        if self.cache:
+            self.process_ids_fn(self.cache)
+            self.cache = []
+        self.next_tokens_are_prompt = True
@@ -28,7 +28,7 @@ class EngineAPI(EngineAPI_Base):
         tokenizer, config, _, _ = dataHelper.load_tokenizer_and_config(
             tokenizer_class_name=ChatGLMTokenizer, config_class_name=ChatGLMConfig)
 
-        pl_model = MyTransformer(config=config, model_args=model_args, torch_dtype=torch.float16, )
+        pl_model = MyTransformer(config=config, model_args=model_args, torch_dtype=torch.float16, **self._get_load_kwargs(device_id,on_cpu=self.auto_quantize))
         model = pl_model.get_llm_model()
         model = model.eval()
 
@@ -42,10 +42,7 @@ class EngineAPI(EngineAPI_Base):
             # 已经量化
             model.half()
 
-        if device_id is None:
-            model.cuda()
-        else:
-            model.cuda(device_id)
+        self._to_device(model,device_id)
 
         return model,config,tokenizer
 
@@ -76,6 +73,7 @@ class EngineAPI(EngineAPI_Base):
         pl_model = MyTransformer(config=config, model_args=model_args,
                                  lora_args=lora_args,
                                  torch_dtype=torch.float16, new_num_tokens=new_num_tokens,
+                                 **self._get_load_kwargs(device_id,on_cpu=True),
                                  # load_in_8bit=global_args["load_in_8bit"],
                                  # # device_map="auto",
                                  # device_map = {"":0} # 第一块卡
@@ -96,10 +94,7 @@ class EngineAPI(EngineAPI_Base):
         else:
             self.lora_model = self.lora_model.half().eval()
 
-        if device_id is None:
-            self.lora_model.cuda()
-        else:
-            self.lora_model.cuda(device_id)
+        self._to_device(self.lora_model,device_id)
         return self.lora_model, config, tokenizer
 
 
@@ -30,7 +30,8 @@ class EngineAPI(EngineAPI_Base):
         config.pad_token_id = config.eos_token_id
 
         pl_model = MyTransformer(config=config, model_args=model_args,
-                                 torch_dtype=torch.float16, )
+                                 torch_dtype=torch.float16,
+                                 **self._get_load_kwargs(device_id,on_cpu=self.auto_quantize))
 
         model = pl_model.get_llm_model()
         model = model.eval()
@@ -46,10 +47,7 @@ class EngineAPI(EngineAPI_Base):
             # 已经量化
             model.half()
 
-        if device_id is None:
-            model.cuda()
-        else:
-            model.cuda(device_id)
+        self._to_device(model,device_id)
         return model,config,tokenizer
 
 
@@ -78,6 +76,7 @@ class EngineAPI(EngineAPI_Base):
         pl_model = MyTransformer(config=config, model_args=model_args,
                                  lora_args=lora_args,
                                  torch_dtype=torch.float16, new_num_tokens=new_num_tokens,
+                                 **self._get_load_kwargs(device_id,on_cpu=True),
                                  # load_in_8bit=global_args["load_in_8bit"],
                                  # # device_map="auto",
                                  # device_map = {"":0} # 第一块卡
@@ -98,10 +97,7 @@ class EngineAPI(EngineAPI_Base):
         else:
             self.lora_model = self.lora_model.half().eval()
 
-        if device_id is None:
-            self.lora_model.cuda()
-        else:
-            self.lora_model.cuda(device_id)
+        self._to_device(self.lora_model,device_id)
         return self.lora_model, config, tokenizer
 
     @torch.no_grad()
@@ -30,14 +30,11 @@ class EngineAPI(EngineAPI_Base):
         if config.pad_token_id is None or config.pad_token_id >= config.vocab_size:
             config.pad_token_id = tokenizer.eos_token_id
 
-        pl_model = MyTransformer(config=config, model_args=model_args, torch_dtype=config.torch_dtype, )
+        pl_model = MyTransformer(config=config, model_args=model_args, torch_dtype=config.torch_dtype, **self._get_load_kwargs(device_id))
         model = pl_model.get_llm_model()
 
         model.eval().half()
-        if device_id is None:
-            model.cuda()
-        else:
-            model.cuda(device_id)
+        self._to_device(model,device_id)
         return model, config, tokenizer
 
     def _load_lora_model(self, device_id=None):
@@ -64,6 +61,7 @@ class EngineAPI(EngineAPI_Base):
         pl_model = MyTransformer(config=config, model_args=model_args,
                                  lora_args=lora_args,
                                  torch_dtype=torch.float16, new_num_tokens=new_num_tokens,
+                                 **self._get_load_kwargs(device_id,on_cpu=True),
                                  # load_in_8bit=global_args["load_in_8bit"],
                                  # # device_map="auto",
                                  # device_map = {"":0} # 第一块卡
@@ -78,10 +76,7 @@ class EngineAPI(EngineAPI_Base):
         else:
             self.lora_model = self.lora_model.half().eval()
 
-        if device_id is None:
-            self.lora_model.cuda()
-        else:
-            self.lora_model.cuda(device_id)
+        self._to_device(self.lora_model,device_id)
         return self.lora_model, config, tokenizer
 
     def chat_stream(self, query, nchar=1,gtype='total', history=None, **kwargs):
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/13 10:20
+import random
+import time
+import typing
+from serving.utils import logger
+
+
+class EngineAPI:
+    '''
+        模拟引擎 , 不加载模型 , 不依赖 torch , 按配置的耗时逐 token 返回输入文本的重复 , 用于在 CPU 上测试调度 扩缩容等策略
+        model_config: load_time 加载秒数 , prefill_latency 每个输入 token 秒数 , token_latency 每个输出 token 秒数 ,
+        max_new_tokens 默认输出 token 数 , error_rate 请求失败的比例 , 模拟显存不足等故障 , weight_mb 模拟权重占用的内存
+    '''
+    def __init__(self, model_config_dict, group_name="", worker_idx=0):
+        self.model_config_dict = model_config_dict
+        self.group_name = group_name
+        self.worker_idx = worker_idx
+        model_config = model_config_dict['model_config']
+        self.load_time = model_config.get('load_time', 0)
+        self.prefill_latency = model_config.get('prefill_latency', 0)
+        self.token_latency = model_config.get('token_latency', 0.02)
+        self.max_new_tokens = model_config.get('max_new_tokens', 64)
+        self.error_rate = model_config.get('error_rate', 0)
+        self.weight_mb = model_config.get('weight_mb', 0)
+        self.weights = None
+        self.lora_conf = model_config.get('lora', None) or {}
+
+    def init(self):
+        time.sleep(self.load_time)
+        if self.weight_mb:
+            # 写入内容 , 实际占用内存页
+            self.weights = b'\x01' * (self.weight_mb * 1024 * 1024)
+        logger.info('{} mock worker {} ready'.format(self.group_name, self.worker_idx))
+
+    def init_shared(self):
+        # fork_workers 模式 , fork 前加载
+        self.init()
+
+    def init_forked(self):
+        pass
+
+    def _check_params(self, params: typing.Dict):
+        adapter_name = params.pop('adapter_name', 'default')
+        if adapter_name != 'default' and adapter_name not in self.lora_conf:
+            return -1, '{} not in {}'.format(adapter_name, ','.join(list(self.lora_conf.keys())))
+        return 0, 'ok'
+
+    def _generate_tokens(self, prompt, params: typing.Dict):
+        # 输入按字符计 token , 输出循环重复输入
+        time.sleep(self.prefill_latency * len(prompt))
+        if self.error_rate and random.random() < self.error_rate:
+            raise RuntimeError('mock CUDA out of memory')
+        max_new_tokens = params.get('max_new_tokens', None) or self.max_new_tokens
+        prompt = prompt or 'mock'
+        for i in range(max_new_tokens):
+            time.sleep(self.token_latency)
+            yield prompt[i % len(prompt)]
+
+    def trigger_generator(self, r: typing.Dict, is_first=True):
+        params = dict(r.get('params', None) or {})
+        code, msg = self._check_params(params)
+        if code != 0:
+            yield [], code, msg, True
+            return None
+        nchar = params.get('nchar', 1) or 1
+        gtype = params.get('gtype', 'total')
+        input_ids = r.get('input_ids', None)
+        if input_ids is not None:
+            # token id 模式只返回 token id
+            chunk = []
+            for token in self._generate_tokens(input_ids, params):
+                chunk.append(token)
+                if len(chunk) >= nchar:
+                    yield chunk, 0, 'ok', False
+                    chunk = []
+            if chunk:
+                yield chunk, 0, 'ok', False
+            yield [], 0, 'ok', True
+            return None
+
+        query = r.get('query', "")
+        history = [(_["q"], _["a"]) for _ in r.get('history', None) or []]
+        text = ''
+        chunk = ''
+        for token in self._generate_tokens(query, params):
+            text += token
+            chunk += token
+            if len(chunk) >= nchar:
+                yield (text if gtype == 'total' else chunk, history), 0, 'ok', False
+                chunk = ''
+        if chunk:
+            yield (text if gtype == 'total' else chunk, history), 0, 'ok', False
+        yield ('', history), 0, 'ok', True
+
+    def trigger(self, r: typing.Dict, is_first=True):
+        params = dict(r.get('params', None) or {})
+        code, msg = self._check_params(params)
+        if code != 0:
+            return [], code, msg, True
+        method = r.get('method', "generate")
+        if r.get('input_ids', None) is not None:
+            return (list(self._generate_tokens(r['input_ids'], params)), None), 0, 'ok', True
+        if method == 'generate':
+            return [''.join(self._generate_tokens(text, params)) for text in r.get('texts', [])], 0, 'ok', True
+        if method == 'chat':
+            query = r.get('query', "")
+            response = ''.join(self._generate_tokens(query, params))
+            history = list(r.get('history', None) or []) + [{"q": query, "a": response}]
+            return (response, history), 0, 'ok', True
+        return [], -1, "mock not exist method {}".format(method), True
@@ -27,13 +27,10 @@ class EngineAPI(EngineAPI_Base):
 
         if config.pad_token_id is None or config.pad_token_id >= config.vocab_size:
             config.pad_token_id = tokenizer.eos_token_id
-        pl_model = MyTransformer(config=config, model_args=model_args, torch_dtype=torch.float16, )
+        pl_model = MyTransformer(config=config, model_args=model_args, torch_dtype=torch.float16, **self._get_load_kwargs(device_id))
         model = pl_model.get_llm_model()
         model.eval().half()
-        if device_id is None:
-            model.cuda()
-        else:
-            model.cuda(device_id)
+        self._to_device(model,device_id)
 
         self.gen_core = Generate(model,tokenizer)
         return model,config,tokenizer
@@ -65,6 +62,7 @@ class EngineAPI(EngineAPI_Base):
         pl_model = MyTransformer(config=config, model_args=model_args,
                                  lora_args=lora_args,
                                  torch_dtype=torch.float16, new_num_tokens=new_num_tokens,
+                                 **self._get_load_kwargs(device_id,on_cpu=True),
                                  # load_in_8bit=global_args["load_in_8bit"],
                                  # # device_map="auto",
                                  # device_map = {"":0} # 第一块卡
@@ -79,10 +77,7 @@ class EngineAPI(EngineAPI_Base):
         else:
             self.lora_model = self.lora_model.half().eval()
 
-        if device_id is None:
-            self.lora_model.cuda()
-        else:
-            self.lora_model.cuda(device_id)
+        self._to_device(self.lora_model,device_id)
         self.gen_core = Generate(self.lora_model, tokenizer)
         return self.lora_model, config, tokenizer
 
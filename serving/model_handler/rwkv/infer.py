@@ -32,15 +32,12 @@ class EngineAPI(EngineAPI_Base):
         tokenizer, config, _, _ = dataHelper.load_tokenizer_and_config(config_kwargs={"torch_dtype": torch.float16},
                                                                        config_class_name=RwkvConfig)
 
-        pl_model = MyTransformer(config=config, model_args=model_args, torch_dtype=torch.float16)
+        pl_model = MyTransformer(config=config, model_args=model_args, torch_dtype=torch.float16, **self._get_load_kwargs(device_id))
         model = pl_model.get_llm_model()
 
         model.requires_grad_(False)
         model.eval().half()
-        if device_id is None:
-            model.cuda()
-        else:
-            model.cuda(device_id)
+        self._to_device(model,device_id)
         return model,config,tokenizer
 
     def _load_lora_model(self, device_id=None):
@@ -72,6 +69,7 @@ class EngineAPI(EngineAPI_Base):
         pl_model = MyTransformer(config=config, model_args=model_args,
                                  lora_args=lora_args,
                                  torch_dtype=torch.float16, new_num_tokens=new_num_tokens,
+                                 **self._get_load_kwargs(device_id,on_cpu=True),
                                  # load_in_8bit=global_args["load_in_8bit"],
                                  # # device_map="auto",
                                  # device_map = {"":0} # 第一块卡
@@ -86,10 +84,7 @@ class EngineAPI(EngineAPI_Base):
         else:
             self.lora_model = self.lora_model.half().eval()
 
-        if device_id is None:
-            self.lora_model.cuda()
-        else:
-            self.lora_model.cuda(device_id)
+        self._to_device(self.lora_model,device_id)
         return self.lora_model, config, tokenizer
 
     def chat_stream(self, query, nchar=1,gtype='total', history=None, **kwargs):
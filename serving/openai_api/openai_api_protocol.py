@@ -4,7 +4,6 @@ from typing import Literal, Optional, List, Dict, Any, Union
 import time
 import uuid
 from pydantic import BaseModel, Field
-from transformers import GenerationConfig
 
 
 class Role(str, Enum):
@@ -77,6 +76,8 @@ class ChatCompletionRequest(BaseModel):
     presence_penalty: Optional[float] = None
     frequency_penalty: Optional[float] = None
     user: Optional[str] = None
+    priority: Optional[str] = None  # one of interactive,standard,batch
+    conversation_id: Optional[str] = None  # 服务端会话 , 空字符串则新建
     gtype: Optional[str] = "increace",  # one of total,increace
     do_sample: Optional[bool] = True
     nchar: Optional[int] = None
@@ -98,15 +99,21 @@ class ChatCompletionRequest(BaseModel):
     guidance_scale: Optional[float] = None
     low_memory: Optional[bool] = None
 
-    def build_query_history(self):
+    def get_system_prefix(self):
+        if len(self.messages) > 1 and self.messages[0].role == Role.SYSTEM:
+            return self.messages[0].content
+        return ""
+
+    def build_query_history(self,session_history=None):
         prev_messages = self.messages[:-1]
         if len(prev_messages) > 0 and prev_messages[0].role == Role.SYSTEM:
             prefix = prev_messages.pop(0).content
         else:
             prefix = ""
 
-        flag = False
-        history = []
+        # 会话已有历史 , system 已经拼接在第一轮
+        history = list(session_history or [])
+        flag = len(history) > 0
         if len(prev_messages) % 2 == 0:
             for i in range(0, len(prev_messages), 2):
                 if prev_messages[i].role == Role.USER and prev_messages[i + 1].role == Role.ASSISTANT:
@@ -164,8 +171,8 @@ class ChatCompletionRequest(BaseModel):
         r["params"] = {k: params[k] for k in keep_keys}
         return r
 
-    def build_request_chat(self):
-        query,history = self.build_query_history()
+    def build_request_chat(self,session_history=None):
+        query,history = self.build_query_history(session_history)
         r = {
             "method": "chat",
             "model": self.model,
@@ -174,8 +181,8 @@ class ChatCompletionRequest(BaseModel):
         }
         r = self._update_params(r)
         return r
-    def build_request_streaming(self):
-        query,history = self.build_query_history()
+    def build_request_streaming(self,session_history=None):
+        query,history = self.build_query_history(session_history)
         r = {
             "method": "chat_stream",
             "model": self.model,
@@ -185,8 +192,8 @@ class ChatCompletionRequest(BaseModel):
         r = self._update_params(r)
         return r
 
-    def build_request_generate(self):
-        query,history = self.build_query_history()
+    def build_request_generate(self,session_history=None):
+        query,history = self.build_query_history(session_history)
         r = {
             "method": "generate",
             "model": self.model,
@@ -209,6 +216,7 @@ class ChatCompletionResponse(BaseModel):
     model: str
     choices: List[ChatCompletionResponseChoice]
     usage: UsageInfo
+    conversation_id: Optional[str] = None
     
     def json(self,*args,exclude_unset=True, ensure_ascii=False,**kwargs):
         return super().json(*args,exclude_unset=exclude_unset, ensure_ascii=ensure_ascii,**kwargs)
@@ -231,6 +239,9 @@ class ChatCompletionStreamResponse(BaseModel):
     created: int = Field(default_factory=lambda: int(time.time()))
     model: str
     choices: List[ChatCompletionResponseStreamChoice]
+    usage: Optional[UsageInfo] = None
+    conversation_id: Optional[str] = None
+    timing: Optional[Dict[str, Any]] = None  # 最后一帧携带 receive,enqueue,pickup,first_token,last_token 等
 
 
 class TokenCheckRequestItem(BaseModel):
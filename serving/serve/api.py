@@ -2,24 +2,43 @@
 # @Time:  15:59
 # @Author: tk
 # @File：api
+import asyncio
 import json
 import logging
+import socket
+import threading
+import time
 import traceback
 import typing
 from contextlib import asynccontextmanager
 
-from fastapi import HTTPException, Depends, FastAPI
+import anyio
+from fastapi import HTTPException, Depends, FastAPI, Header, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseSettings
 from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import StreamingResponse
-from config.main import global_models_info_args
+from starlette.responses import StreamingResponse, PlainTextResponse
+from config.main import global_models_info_args, global_scheduler_args, global_request_log_args, global_session_args, \
+    global_stream_args, global_context_args, global_token_ipc_args, global_worker_args, global_autoscale_args, \
+    global_cluster_args, global_hedge_args, global_breaker_args, global_serve_args, load_models_info_args
 from serving.openai_api.openai_api_protocol import ModelCard, ModelPermission, ModelList, ChatCompletionRequest, Role, \
     ChatCompletionResponseStreamChoice, DeltaMessage, ChatCompletionStreamResponse, Finish, \
     ChatCompletionResponseChoice, ChatMessage, UsageInfo, ChatCompletionResponse
 from serving.serve.api_serving import WokerLoader
+from serving.serve.autoscaler import AutoScaler
+from serving.serve.circuit_breaker import CircuitBreaker
+from serving.serve.cluster import Gateway, NodeAgent
+from serving.serve.context_budget import ContextBudget, ContextBudgetError
+from serving.serve.hedging import Hedger
+from serving.serve.scheduler import FairScheduler, SchedulerRejectedError, SchedulerFullError, SchedulerCancelledError
+from serving.serve.session import SessionStore, SessionError
+from serving.serve.stream_buffer import StreamBufferStore, StreamBuffer, parse_event_id
+from serving.serve.tokenizer_pool import TOKEN_IPC_TEMPLATES, TokenizerPool, IncrementalDetokenizer
 from serving.utils import logger
+from serving.utils.metrics import global_registry, serving_metrics
+from serving.utils.request_log import RequestLogger
+from serving.workers.worker_group import WorkerUnavailableError, RequestCancelledError
 
 class AppSettings(BaseSettings):
     # The address of the model controller.
@@ -53,15 +72,422 @@ def check_api_key(
 
 
 
+# 只在前端生效的模型配置 , 变化时不需要重启 worker
+_FRONTEND_KEYS = ['autoscale','fallback','breaker']
+
+def _strip_runtime(config):
+    # check_config 为 deepspeed 多卡 worker 分配的端口每次加载都不同 , 比较时忽略
+    config = {k: v for k,v in config.items() if k not in _FRONTEND_KEYS}
+    config["workers"] = [{k: v for k,v in w.items() if k != 'deepspeed'} for w in config["workers"]]
+    return config
+
+def _config_change(old,new):
+    '''
+        None 未变化 , workers 只改变 worker 数 ( 已有 worker 的配置不变 ) , config 其他配置变化
+    '''
+    autoscale = new.get("autoscale",None)
+    old,new = _strip_runtime(old),_strip_runtime(new)
+    n = min(len(old["workers"]),len(new["workers"]))
+    if dict(old,workers=None) != dict(new,workers=None) or old["workers"][:n] != new["workers"][:n]:
+        return 'config'
+    if len(old["workers"]) == len(new["workers"]) or autoscale:
+        # 开启自动扩缩容时 worker 数由其决定
+        return None
+    return 'workers'
+
+
 class Resource:
    def __init__(self):
+       self.models_info_args = global_models_info_args
+       # 配置热加载时整体替换 , 不原地修改
        self.valid_model_map = set([k for k, v in global_models_info_args.items() if v["enable"]])
+       self._reload_lock = threading.Lock()
+       # 后台处理中的模型 , 处理完之前不参与下一次热加载
+       self._reloading = set()
        self.queue_mapper = {}
+       self.scheduler_mapper = {}
+       self.session_store = None
+       self.stream_store = None
+       self.budget_mapper = {}
+       self.tokenizer_mapper = {}
+       self.breaker_mapper = {}
        self.lifespan = None
-       self.work_node = WokerLoader(self.queue_mapper)
+       self.autoscaler = None
+       self.gateway = None
+       self.node_agent = None
+       self.hedger = Hedger(**global_hedge_args) if global_hedge_args["enable"] else None
+       # 排空中不再接收新请求
+       self.draining = False
+       self.work_node = WokerLoader(self.queue_mapper,on_ready=self._on_worker_ready)
+       if global_scheduler_args["enable"]:
+           for model_name in self.valid_model_map:
+               self.scheduler_mapper[model_name] = self._create_scheduler(global_models_info_args[model_name])
+       if global_session_args["enable"]:
+           self.session_store = SessionStore(max_sessions=global_session_args["max_sessions"],
+                                             ttl=global_session_args["ttl"],
+                                             max_turns=global_session_args["max_turns"])
+       for model_name in self.valid_model_map:
+           pool = self._create_tokenizer_pool(model_name,global_models_info_args[model_name])
+           if pool is not None:
+               self.tokenizer_mapper[model_name] = pool
+       if global_context_args["enable"]:
+           for model_name in self.valid_model_map:
+               self.budget_mapper[model_name] = self._create_budget(global_models_info_args[model_name],
+                                                                    self.tokenizer_mapper.get(model_name,None))
+       if global_breaker_args["enable"]:
+           for model_name in self.valid_model_map:
+               self.breaker_mapper[model_name] = self._create_breaker(model_name,global_models_info_args[model_name])
+       if global_stream_args["enable"]:
+           self.stream_store = StreamBufferStore(max_events=global_stream_args["max_events"],
+                                                 grace_period=global_stream_args["grace_period"],
+                                                 max_streams=global_stream_args["max_streams"],
+                                                 max_producers=global_stream_args["max_producers"])
+
+   def startup(self):
+       self.work_node.create()
+       for pool in self.tokenizer_mapper.values():
+           pool.start()
+       startup_wait = global_worker_args.get("startup_wait",0)
+       if startup_wait:
+           self.wait_ready(startup_wait)
+       if global_autoscale_args["enable"]:
+           self.autoscaler = AutoScaler(self,**{k: v for k,v in global_autoscale_args.items() if k != 'enable'})
+           self.autoscaler.start()
+       role = global_cluster_args["role"]
+       if role == 'gateway':
+           self.gateway = Gateway(global_cluster_args["gateway_bind"],
+                                  heartbeat_timeout=global_cluster_args["heartbeat_timeout"],
+                                  max_retries=global_cluster_args["max_retries"],
+                                  ipc_timeout=global_worker_args["ipc_timeout"],
+                                  load_factor=global_worker_args["load_factor"],
+                                  virtual_nodes=global_worker_args["virtual_nodes"],
+                                  on_model=self._add_remote_model,
+                                  secret=global_cluster_args["secret"])
+           self.gateway.start()
+       elif role == 'node':
+           node_id = global_cluster_args["node_id"] or '{}:{}'.format(socket.gethostname(),global_serve_args["port"])
+           self.node_agent = NodeAgent(global_cluster_args["gateway_addr"],node_id,
+                                       handler=_node_request,
+                                       get_models=self._local_models,
+                                       heartbeat_interval=global_cluster_args["heartbeat_interval"],
+                                       max_concurrency=global_cluster_args["max_concurrency"],
+                                       secret=global_cluster_args["secret"])
+           self.node_agent.start()
+
+   def wait_ready(self,timeout):
+       '''
+           启动屏障 , 等待所有模型加载完成 , 超时后未就绪的模型继续加载 , 就绪前请求直接返回错误
+       '''
+       deadline = time.time() + timeout
+       for model_name,instance in self.queue_mapper.items():
+           if not instance.wait_ready(max(0,deadline - time.time())):
+               logger.warning('{} not ready after {}s'.format(model_name,timeout))
+
+   def shutdown(self):
+       if self.autoscaler is not None:
+           self.autoscaler.stop()
+       # node 排空期间心跳上报未就绪 , 网关不再转发新请求
+       self.drain(global_worker_args.get("drain_timeout",0))
+       for agent in [self.node_agent,self.gateway]:
+           if agent is not None:
+               agent.stop()
+       for pool in self.tokenizer_mapper.values():
+           pool.shutdown()
+       self.work_node.release()
+
+   def outstanding(self):
+       return {k: v.outstanding() for k,v in self.queue_mapper.items()}
+
+   def drain(self,timeout):
+       '''
+           不再接收新请求 , 等待在途请求完成 , 最多 timeout 秒
+       '''
+       self.draining = True
+       deadline = time.time() + (timeout or 0)
+       while True:
+           outstanding = sum(self.outstanding().values())
+           if outstanding == 0:
+               return True
+           if time.time() > deadline:
+               logger.warning('drain timeout , {} requests still in flight'.format(outstanding))
+               return False
+           time.sleep(0.5)
+
+   def rolling_restart(self,model_names=None):
+       '''
+           后台滚动重启 , 每个模型同一时间只重启一个 worker
+       '''
+       model_names = [_ for _ in (model_names or self.queue_mapper.keys()) if _ in self.queue_mapper]
+       for model_name in model_names:
+           threading.Thread(target=self.queue_mapper[model_name].rolling_restart,daemon=True).start()
+       return model_names
+
+   def reload_config(self):
+       '''
+           配置热加载 , 重新读取模型配置 , 只处理变化的模型 , 其余模型继续服务 , 缓存不受影响
+           新增的启动 worker 组 ; 删除或禁用的不再接收请求 , 排空后停止 ; 只改变 worker 数的原地增减 worker ;
+           其他配置变化 ( 如 lora ) 的启动新 worker 组 , 就绪后替换旧的 , 旧的排空后停止 , 未就绪则保留旧配置
+       '''
+       with self._reload_lock:
+           try:
+               new_args = load_models_info_args()
+           except Exception as e:
+               logger.error('reload config error {}'.format(e))
+               return {'code': -1, 'msg': 'reload config error {}'.format(e)}
+           old_args = self.models_info_args
+           models_info_args = dict(new_args)
+           valid_model_map = set(self.valid_model_map)
+           result = {"added": [], "removed": [], "resized": [], "replaced": [], "pending": []}
+           # 新配置生效后再在后台执行
+           tasks = []
+           for model_name in sorted(set(old_args) | set(new_args)):
+               old = old_args.get(model_name,None)
+               new = new_args.get(model_name,None)
+               old_enable = old is not None and old["enable"]
+               new_enable = new is not None and new["enable"]
+               if not old_enable and not new_enable:
+                   continue
+               if model_name in self._reloading:
+                   result["pending"].append(model_name)
+                   models_info_args[model_name] = old
+                   continue
+               if not new_enable:
+                   valid_model_map.discard(model_name)
+                   tasks.append((model_name,self._remove_model,(model_name,)))
+                   result["removed"].append(model_name)
+               elif not old_enable:
+                   self._add_model(model_name,new)
+                   valid_model_map.add(model_name)
+                   result["added"].append(model_name)
+               else:
+                   change = _config_change(old,new)
+                   if change is None:
+                       frontend = {k: new[k] for k in _FRONTEND_KEYS if k in new}
+                       models_info_args[model_name] = old if frontend == {k: old[k] for k in _FRONTEND_KEYS if k in old} \
+                           else dict({k: v for k,v in old.items() if k not in _FRONTEND_KEYS},**frontend)
+                       if global_breaker_args["enable"] and old.get("breaker",None) != new.get("breaker",None):
+                           self.breaker_mapper[model_name] = self._create_breaker(model_name,new)
+                   elif change == 'workers':
+                       n = min(len(old["workers"]),len(new["workers"]))
+                       new = models_info_args[model_name] = dict(new,workers=old["workers"][:n] + new["workers"][n:])
+                       tasks.append((model_name,self._resize_model,(model_name,new)))
+                       result["resized"].append(model_name)
+                   else:
+                       # 替换成功后再更新
+                       models_info_args[model_name] = old
+                       tasks.append((model_name,self._replace_model,(model_name,new)))
+                       result["replaced"].append(model_name)
+           self.models_info_args = models_info_args
+           self.valid_model_map = valid_model_map
+           for model_name,fn,args in tasks:
+               self._reload_background(model_name,fn,*args)
+       logger.info('reload config {}'.format(result))
+       return {'code': 0, 'msg': 'ok', 'result': result}
+
+   def _add_remote_model(self,model_name,instance):
+       '''
+           网关收到 node 上报的新模型 , 与本地同名的模型只使用本地 worker
+       '''
+       with self._reload_lock:
+           if model_name in self.queue_mapper:
+               logger.warning('{} is served locally , ignore remote nodes'.format(model_name))
+               return
+           self.queue_mapper[model_name] = instance
+           if global_breaker_args["enable"]:
+               self.breaker_mapper[model_name] = self._create_breaker(model_name,{})
+           self.valid_model_map = self.valid_model_map | {model_name}
+       logger.info('remote model {} registered'.format(model_name))
+
+   def _local_models(self):
+       # node 心跳上报的本机模型 , 排空中上报未就绪
+       return {k: {"ready": v.is_ready() and not self.draining,"workers": v.worker_num,"outstanding": v.outstanding()}
+               for k,v in list(self.queue_mapper.items()) if not getattr(v,'remote',False)}
+
+   def scale_model(self,model_name,workers):
+       '''
+           自动扩缩容 , 按新的 workers 配置增减 worker , 模型不存在或正在后台处理时返回 False
+       '''
+       with self._reload_lock:
+           config = self.models_info_args.get(model_name,None)
+           if config is None or not config["enable"] or model_name in self._reloading:
+               return False
+           config = dict(config,workers=workers)
+           self.models_info_args = dict(self.models_info_args,**{model_name: config})
+           self._reload_background(model_name,self._resize_model,model_name,config)
+       return True
+
+   def _reload_background(self,model_name,fn,*args):
+       self._reloading.add(model_name)
+
+       def run():
+           try:
+               fn(*args)
+           except Exception as e:
+               logger.error('{} reload error {}'.format(model_name,e))
+           finally:
+               self._reloading.discard(model_name)
+
+       threading.Thread(target=run,daemon=True).start()
+
+   def _add_model(self,model_name,config):
+       if global_scheduler_args["enable"]:
+           self.scheduler_mapper[model_name] = self._create_scheduler(config)
+       pool = self._create_tokenizer_pool(model_name,config)
+       if pool is not None:
+           pool.start()
+           self.tokenizer_mapper[model_name] = pool
+       if global_context_args["enable"]:
+           self.budget_mapper[model_name] = self._create_budget(config,pool)
+       if global_breaker_args["enable"]:
+           self.breaker_mapper[model_name] = self._create_breaker(model_name,config)
+       self.work_node.add_group(model_name,config)
+       _resize_threadpool()
+
+   def _drain_model(self,model_name,instance,timeout,scheduler=None):
+       deadline = time.time() + (timeout or 0)
+       while instance.outstanding() or (scheduler is not None and (scheduler.inflight or scheduler.queued)):
+           if time.time() > deadline:
+               logger.warning('{} drain timeout , {} requests still in flight'.format(model_name,instance.outstanding()))
+               return False
+           time.sleep(0.5)
+       return True
+
+   def _remove_model(self,model_name):
+       instance = self.queue_mapper.get(model_name,None)
+       if instance is not None:
+           self._drain_model(model_name,instance,global_worker_args["drain_timeout"],
+                             self.scheduler_mapper.get(model_name,None))
+           self.work_node.remove_group(model_name,instance)
+       self.scheduler_mapper.pop(model_name,None)
+       self.budget_mapper.pop(model_name,None)
+       self.breaker_mapper.pop(model_name,None)
+       pool = self.tokenizer_mapper.pop(model_name,None)
+       if pool is not None:
+           pool.shutdown()
+       _resize_threadpool()
+       logger.info('{} removed'.format(model_name))
+
+   def _resize_model(self,model_name,config):
+       scheduler = self.scheduler_mapper.get(model_name,None)
+       if scheduler is not None and not global_scheduler_args["max_inflight"] and len(config['workers']) < scheduler.max_inflight:
+           # 缩容立即降低并发上限 , 扩容等新 worker 就绪后在 _on_worker_ready 提高
+           scheduler.set_max_inflight(len(config['workers']))
+           _resize_threadpool()
+       worker_num = self.work_node.resize_group(model_name,config)
+       instance = self.queue_mapper.get(model_name,None)
+       if instance is not None:
+           # 没有心跳时新 worker 直接视为就绪
+           self._on_worker_ready(model_name,instance)
+       logger.info('{} resized to {} workers'.format(model_name,worker_num))
+
+   def _on_worker_ready(self,model_name,instance):
+       '''
+           worker 就绪后按就绪的 worker 数提高调度并发上限 , 加载中的 worker 不计入 , 请求不会在其队列中等待
+       '''
+       scheduler = self.scheduler_mapper.get(model_name,None)
+       if scheduler is None or global_scheduler_args["max_inflight"] or self.queue_mapper.get(model_name,None) is not instance:
+           return
+       ready = instance.ready_count()
+       if ready > scheduler.max_inflight:
+           scheduler.set_max_inflight(ready)
+           _resize_threadpool()
+
+   def _replace_model(self,model_name,config):
+       instance = self.work_node.add_group(model_name,config,activate=False)
+       if not instance.wait_ready(global_worker_args.get("reload_timeout",600)):
+           logger.error('{} reload failed , new workers not ready , keep old config'.format(model_name))
+           self.work_node.remove_group(model_name,instance)
+           return
+       pool = self._create_tokenizer_pool(model_name,config)
+       if pool is not None:
+           pool.start()
+       old_pool = self.tokenizer_mapper.get(model_name,None)
+       if pool is not None:
+           self.tokenizer_mapper[model_name] = pool
+       else:
+           self.tokenizer_mapper.pop(model_name,None)
+       if global_context_args["enable"]:
+           self.budget_mapper[model_name] = self._create_budget(config,pool)
+       if global_breaker_args["enable"]:
+           # 新的 worker 组 , 重新统计
+           self.breaker_mapper[model_name] = self._create_breaker(model_name,config)
+       old = self.work_node.activate_group(model_name,instance)
+       scheduler = self.scheduler_mapper.get(model_name,None)
+       if scheduler is not None and not global_scheduler_args["max_inflight"]:
+           scheduler.set_max_inflight(len(config['workers']))
+           _resize_threadpool()
+       with self._reload_lock:
+           self.models_info_args = dict(self.models_info_args,**{model_name: config})
+       logger.info('{} replaced by new workers'.format(model_name))
+       if old is not None:
+           # 刚切换时可能还有请求正在发往旧的 worker 组
+           time.sleep(5)
+           self._drain_model(model_name,old,global_worker_args["drain_timeout"])
+           self.work_node.remove_group(model_name,old)
+       if old_pool is not None:
+           old_pool.shutdown()
+
+   def _create_tokenizer_pool(self,model_name,config):
+       token_ipc = config.get("token_ipc",None)
+       if token_ipc is None:
+           token_ipc = global_token_ipc_args["enable"]
+       if not token_ipc:
+           return None
+       model_type = config["model_config"]["model_type"]
+       if model_type not in TOKEN_IPC_TEMPLATES:
+           logger.warning('{} model_type {} not support token_ipc , use text mode'.format(model_name,model_type))
+           return None
+       return TokenizerPool(model_name,config["model_config"],num_workers=global_token_ipc_args["num_workers"])
+
+   def _create_budget(self,config,pool=None):
+       max_context_length = config.get("max_context_length",None)
+       if max_context_length is None:
+           lengths = global_context_args["max_context_length"]
+           model_type = config.get("model_config",{}).get("model_type",None)
+           max_context_length = lengths.get(model_type,lengths["default"])
+       # 有分词进程池时按模型 tokenizer 准确计数 , 否则按字符估算并留余量
+       return ContextBudget(max_context_length=max_context_length,
+                            policy=global_context_args["policy"],
+                            turn_overhead=global_context_args["turn_overhead"],
+                            counter=(lambda text: pool.count_tokens([text])[0]) if pool is not None else None,
+                            batch_counter=pool.count_tokens if pool is not None else None,
+                            safety_margin=global_context_args["safety_margin"])
+
+   def _create_breaker(self,model_name,config):
+       return CircuitBreaker(model_name,on_open=self._on_breaker_open,
+                             **dict(global_breaker_args,**(config.get("breaker",None) or {})))
+
+   def _on_breaker_open(self,model_name):
+       # 排队中的请求不再等待 , 直接失败或改发到 fallback 模型
+       scheduler = self.scheduler_mapper.get(model_name,None)
+       if scheduler is not None:
+           n = scheduler.reject_queued('{} circuit open'.format(model_name))
+           if n:
+               logger.warning('{} circuit open , reject {} queued requests'.format(model_name,n))
+
+   def get_fallback(self,model_name):
+       config = self.models_info_args.get(model_name,None) or {}
+       fallback = config.get("fallback",None)
+       if fallback and fallback != model_name and fallback in self.valid_model_map:
+           return fallback
+       return None
+
+   def _create_scheduler(self,config):
+       max_inflight = global_scheduler_args["max_inflight"] or len(config['workers'])
+       return FairScheduler(max_inflight=max_inflight,
+                            priority_classes=global_scheduler_args["priority_classes"],
+                            default_priority=global_scheduler_args["default_priority"],
+                            tenant_weights=global_scheduler_args["tenant_weights"],
+                            starvation_timeout=global_scheduler_args["starvation_timeout"],
+                            max_queue_size=global_scheduler_args["max_queue_size"])
 
 
 _g_instance = Resource()
+_g_metrics = serving_metrics()
+_g_request_logger = RequestLogger(**global_request_log_args)
+# 事件循环和线程池 , 启动后设置
+_g_loop = None
+_g_thread_limiter = None
 
 def global_instance() -> Resource:
     global _g_instance
@@ -69,9 +495,9 @@ def global_instance() -> Resource:
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await global_instance().work_node.create()
+    global_instance().startup()
     yield
-    await global_instance().work_node.release()
+    global_instance().shutdown()
 
 app = FastAPI()
 app.add_middleware(  # 添加中间件
@@ -82,20 +508,568 @@ app.add_middleware(  # 添加中间件
     allow_headers=["*"],  # 允许头部
 )
 
+def _threadpool_size():
+    self = global_instance()
+    size = global_scheduler_args["threadpool_reserve"]
+    for scheduler in list(self.scheduler_mapper.values()):
+        size += scheduler.max_queue_size + scheduler.max_inflight
+    return max(size,40)
+
+def _resize_threadpool():
+    '''
+        同步接口和流式生成器在线程池中执行 , 排队等待调度的请求也占用线程 ,
+        线程数按各模型的排队上限 + 并发上限 + 预留设置 , 排队满时返回错误 , 线程不会被排队的请求占满
+    '''
+    loop,limiter = _g_loop,_g_thread_limiter
+    if loop is None or limiter is None:
+        return
+    size = _threadpool_size()
+
+    def resize():
+        if limiter.total_tokens != size:
+            limiter.total_tokens = size
+            logger.info('threadpool size {}'.format(size))
+
+    loop.call_soon_threadsafe(resize)
+
+@app.on_event("startup")
+async def _on_startup():
+    global _g_loop,_g_thread_limiter
+    _g_loop = asyncio.get_running_loop()
+    _g_thread_limiter = anyio.to_thread.current_default_thread_limiter()
+    _resize_threadpool()
+
+
+
+
+
+
+def _get_tenant(api_key: typing.Optional[str],user: typing.Optional[str] = None):
+    return api_key or user or "default"
+
+def _get_priority(tenant,priority: typing.Optional[str] = None):
+    if priority is None:
+        priority = global_scheduler_args["tenant_priority"].get(tenant,None)
+    return priority
+
+def _estimate_cost(r: typing.Dict):
+    params = r.get('params',None) or {}
+    max_new_tokens = params.get('max_new_tokens',None) or 512
+    return max_new_tokens * max(1,len(r.get('texts',None) or []))
+
+def _stamp(r: typing.Dict,key,t=None):
+    timing = r.get("timing",None)
+    if timing is None:
+        timing = r["timing"] = {}
+    timing[key] = t or time.time()
+
+_TIMING_HEADERS = {
+    "receive": "X-Timing-Receive",
+    "enqueue": "X-Timing-Enqueue",
+    "pickup": "X-Timing-Pickup",
+    "first_token": "X-Timing-First-Token",
+    "last_token": "X-Timing-Last-Token",
+    "prompt_tokens": "X-Prompt-Tokens",
+    "completion_tokens": "X-Completion-Tokens",
+}
+
+def _set_timing_headers(response: Response,timing: typing.Optional[typing.Dict]):
+    if not timing:
+        return
+    for k,header in _TIMING_HEADERS.items():
+        v = timing.get(k,None)
+        if v is not None:
+            response.headers[header] = str(v)
+
+def _merge_timing(timings: typing.List[typing.Dict]):
+    timings = [_ for _ in timings if _]
+    if not timings:
+        return None
+    timing = dict(timings[0])
+    if "last_token" in timings[-1]:
+        timing["last_token"] = timings[-1]["last_token"]
+    for k in ["prompt_tokens","completion_tokens"]:
+        timing[k] = sum(_.get(k,0) for _ in timings)
+    return timing
+
+def _schedule(model_name,r: typing.Dict,tenant,priority,cancelled=None):
+    scheduler = global_instance().scheduler_mapper.get(model_name,None)
+    if scheduler is None:
+        return None
+    ticket = scheduler.acquire(tenant,_get_priority(tenant,priority),cost=_estimate_cost(r),
+                               timeout=global_scheduler_args["queue_timeout"],cancelled=cancelled)
+    _g_metrics.scheduler_wait.observe(model_name,value=ticket.wait_time)
+    return ticket
+
+def _unschedule(model_name,ticket,instance=None,request_id=None,complete=True):
+    '''
+        ticket 为 None 时 ( 未启用调度 , 远程模型 , 网关转发 ) 也要处理未完成的请求 , 否则 worker 负载和在途记录不释放
+    '''
+    scheduler = global_instance().scheduler_mapper.get(model_name,None) if ticket is not None else None
+
+    def release():
+        if scheduler is not None:
+            scheduler.release(ticket)
+
+    if complete or request_id is None:
+        release()
+        return
+
+    # 客户端提前断开 , worker 仍在生成 , 读完剩余结果再释放 ; 读取出错时取消请求
+    def drain():
+        try:
+            while not instance.get(request_id)["complete"]:
+                pass
+        except Exception as e:
+            logger.error('drain {} {} error {}'.format(model_name,request_id,e))
+            if hasattr(instance,'cancel'):
+                instance.cancel(request_id)
+        finally:
+            release()
+
+    threading.Thread(target=drain,daemon=True).start()
+
+def _open_session(model_name,conversation_id,tenant,history=None):
+    '''
+        conversation_id 为 None 不使用会话 , 空字符串则新建会话 , 会话只属于创建它的租户
+    '''
+    session_store = global_instance().session_store
+    if conversation_id is None or session_store is None:
+        return None
+    return session_store.get_or_create(conversation_id,model_name,history=history,owner=tenant)
+
+def _bind_session(r: typing.Dict,session):
+    if session is None:
+        return
+    r["history"] = session.get_history()
+    r["conversation_id"] = session.conversation_id
+    # 同一会话路由到同一个 worker
+    r["route_key"] = session.conversation_id
+
+def _close_session(session,query,response):
+    if session is None:
+        return
+    global_instance().session_store.append(session,query,response)
+
+def _accumulate_text(text,delta,gtype):
+    return delta if gtype == 'total' else text + delta
+
+def _fit_context(model_name,r: typing.Dict,prefix=""):
+    '''
+        入队前裁剪历史 , 超出上下文长度抛出 ContextBudgetError
+    '''
+    budget = global_instance().budget_mapper.get(model_name,None)
+    if budget is None:
+        return
+    max_new_tokens = (r.get('params',None) or {}).get('max_new_tokens',None)
+    if r["method"] == "generate":
+        budget.check_texts(r.get('texts',None) or [],max_new_tokens)
+        return
+    query,history,dropped = budget.fit(r["query"],r.get("history",None),max_new_tokens,prefix=prefix)
+    if dropped:
+        logger.info('{} drop {} history turns for context length {}'.format(model_name,dropped,budget.max_context_length))
+    r["query"] = query
+    r["history"] = history
+
+def _build_openai_request(request: ChatCompletionRequest,tenant):
+    # messages 中的历史只用于新建会话 , 已有会话时再带历史由 get_or_create 拒绝
+    _,history = request.build_query_history()
+    session = _open_session(request.model,request.conversation_id,tenant,history)
+    session_history = session.get_history() if session is not None and not history else None
+    if request.stream:
+        r = request.build_request_streaming(session_history)
+    else:
+        r = request.build_request_chat(session_history)
+    _bind_session(r,session)
+    _fit_context(request.model,r,request.get_system_prefix())
+    return session,r
+
+def _route_key(r: typing.Dict):
+    '''
+        会话用 conversation_id , 否则用 prompt 开头部分 ( system 前缀 , 第一轮对话 ) , 过短不做亲和
+    '''
+    if not global_worker_args.get("affinity",True):
+        return None
+    if r.get("route_key",None):
+        return r["route_key"]
+    if r["method"] == "generate":
+        texts = r.get("texts",None) or []
+        prompt = texts[0] if len(texts) == 1 else ""
+    else:
+        history = r.get("history",None) or []
+        prompt = history[0]["q"] if history else r.get("query","")
+    if len(prompt) < global_worker_args.get("affinity_min_prefix_chars",64):
+        return None
+    return "prefix:" + prompt[:global_worker_args.get("affinity_prefix_chars",256)]
+
+def _to_worker_request(model_name,r: typing.Dict):
+    '''
+        token id 模式下前端完成模板拼接和分词 , worker 只收 token id
+    '''
+    pool = global_instance().tokenizer_mapper.get(model_name,None)
+    if pool is None or r["method"] not in ["chat","chat_stream"]:
+        return r,None
+    payload = {k: v for k,v in r.items() if k not in ["query","history"]}
+    payload["input_ids"] = pool.encode_prompt(r["query"],r.get("history",None))
+    return payload,pool
+
+class _NotReadyError(Exception):
+    '''
+        模型加载中 , 服务排空中等 , 请求没有执行 , 熔断器不计为失败 , result 为返回给客户端的错误
+    '''
+    def __init__(self,result: typing.Dict):
+        super().__init__(result["msg"])
+        self.result = result
+
+def _check_ready(model_name,instance):
+    if global_instance().draining:
+        return {"code": -1, "msg": "server is draining , retry later", "complete": True}
+    if instance is None:
+        return {"code": -1, "msg": "{} is not enabled".format(model_name), "complete": True}
+    if instance.is_ready():
+        return None
+    return {"code": -1, "msg": "{} is loading , retry later".format(model_name), "complete": True}
+
+def _put(instance,payload,r: typing.Dict,tenant,priority=None,**kwargs):
+    if getattr(instance,'remote',False):
+        # 远程 node 按同样的租户和优先级调度 , 不支持取消标记
+        payload = dict(payload,tenant=tenant,priority=priority)
+        kwargs.pop('cancelable',None)
+    return instance.put(payload,worker_idx=instance.route(_route_key(r)),**kwargs)
+
+def _get_result(model_name,instance,payload,r: typing.Dict,tenant,priority=None):
+    '''
+        非流式请求下发并等待结果 , 本机 worker 的短请求按对冲策略等待
+    '''
+    hedger = global_instance().hedger
+    if hedger is None or getattr(instance,'remote',False) or not hedger.eligible(r):
+        return instance.get(_put(instance,payload,r,tenant,priority))
+    start = time.time()
+    delay = hedger.delay(model_name)
+    request_id = _put(instance,payload,r,tenant,priority,cancelable=delay is not None)
+    if delay is None:
+        result = instance.get(request_id)
+    else:
+        result,hedged,won = instance.get_hedged(request_id,delay,allow=lambda: hedger.acquire(model_name))
+        hedger.record(model_name,hedged,won)
+    if result["code"] == 0:
+        hedger.observe(model_name,time.time() - start)
+    return result
+
+def _breaker_latency(r: typing.Dict):
+    # 处理耗时 , 不含排队
+    enqueue = (r.get("timing",None) or {}).get("enqueue",None)
+    return time.time() - enqueue if enqueue is not None else None
+
+def _fallback(model_name,r: typing.Dict,breaker):
+    '''
+        熔断时改发的模型 , 没有配置返回 None ; 按 fallback 模型的上下文长度重新裁剪 , 超出时抛出 ContextBudgetError
+    '''
+    fallback = global_instance().get_fallback(model_name)
+    if fallback is None:
+        return None
+    breaker.fallbacks += 1
+    _fit_context(fallback,r)
+    return fallback
+
+def _call(model_name,r: typing.Dict,tenant,priority=None,fallback=True):
+    '''
+        按熔断器状态执行 , 熔断时快速失败或改发到 fallback 模型 ( 只改发一次 )
+    '''
+    breaker = global_instance().breaker_mapper.get(model_name,None)
+    if breaker is None:
+        try:
+            return _call_model(model_name,r,tenant,priority)
+        except _NotReadyError as e:
+            return e.result
+    admitted = breaker.acquire()
+    if admitted is not None:
+        try:
+            result = _call_model(model_name,r,tenant,priority)
+        except SchedulerRejectedError:
+            breaker.record(admitted,None)
+        except _NotReadyError as e:
+            breaker.record(admitted,None)
+            return e.result
+        except Exception as e:
+            breaker.record(admitted,True,str(e))
+            raise
+        else:
+            failure = breaker.is_failure(result,_breaker_latency(r))
+            breaker.record(admitted,failure,result.get("msg",None) if failure else None)
+            return result
+    try:
+        name = _fallback(model_name,r,breaker) if fallback else None
+    except ContextBudgetError as e:
+        return {"code": -1, "msg": str(e), "complete": True}
+    if name is None:
+        return {"code": -1, "msg": "{} circuit open , retry later".format(model_name), "complete": True}
+    return _call(name,r,tenant,priority,fallback=False)
+
+def _call_model(model_name,r: typing.Dict,tenant,priority=None):
+    instance = global_instance().queue_mapper.get(model_name,None)
+    error = _check_ready(model_name,instance)
+    if error is not None:
+        raise _NotReadyError(error)
+    try:
+        ticket = _schedule(model_name,r,tenant,priority)
+    except (SchedulerFullError,TimeoutError) as e:
+        return {"code": -1, "msg": str(e), "complete": True}
+    # 排队期间可能被配置热加载替换
+    instance = global_instance().queue_mapper.get(model_name,instance)
+    try:
+        payload,pool = _to_worker_request(model_name,r)
+        _stamp(r,"enqueue")
+        try:
+            result = _get_result(model_name,instance,payload,r,tenant,priority)
+        except WorkerUnavailableError as e:
+            return {"code": -1, "msg": str(e), "complete": True}
+        if pool is not None and result["code"] == 0:
+            result["result"] = pool.decode(result.pop("token_ids",None) or [])
+            result["history"] = list(r.get("history",None) or []) + [{"q": r["query"],"a": result["result"]}]
+        return result
+    finally:
+        _unschedule(model_name,ticket)
 
+def _call_stream(model_name,r: typing.Dict,tenant,priority=None,fallback=True,cancelled=None):
+    '''
+        流式请求的熔断 , 按首帧耗时判断慢请求 , 客户端提前断开的不统计
+        cancelled() 为 True 时 ( 客户端已离开 ) 排队和等待首帧的请求直接结束 , 不返回结果
+    '''
+    breaker = global_instance().breaker_mapper.get(model_name,None)
+    if breaker is None:
+        try:
+            yield from _call_stream_model(model_name,r,tenant,priority,cancelled)
+        except _NotReadyError as e:
+            yield e.result
+        return
+    admitted = breaker.acquire()
+    if admitted is not None:
+        failure,error,first = None,None,True
+        gen = _call_stream_model(model_name,r,tenant,priority,cancelled)
+        try:
+            for result in gen:
+                if result["code"] != 0 or (first and breaker.is_failure(result,_breaker_latency(r))):
+                    failure,error = True,result.get("msg",None)
+                first = False
+                if result["complete"] and failure is None:
+                    failure = False
+                yield result
+            return
+        except SchedulerRejectedError:
+            failure = None
+        except _NotReadyError as e:
+            # 没有执行 , 不计为失败 , 也不作为半开探测的结果
+            failure = None
+            yield e.result
+            return
+        except Exception as e:
+            failure,error = True,str(e)
+            raise
+        finally:
+            gen.close()
+            breaker.record(admitted,failure,error)
+    try:
+        name = _fallback(model_name,r,breaker) if fallback else None
+    except ContextBudgetError as e:
+        yield {"code": -1, "msg": str(e), "complete": True}
+        return
+    if name is None:
+        yield {"code": -1, "msg": "{} circuit open , retry later".format(model_name), "complete": True}
+        return
+    yield from _call_stream(name,r,tenant,priority,fallback=False,cancelled=cancelled)
 
+def _call_stream_model(model_name,r: typing.Dict,tenant,priority=None,cancelled=None):
+    instance = global_instance().queue_mapper.get(model_name,None)
+    error = _check_ready(model_name,instance)
+    if error is not None:
+        raise _NotReadyError(error)
+    try:
+        ticket = _schedule(model_name,r,tenant,priority,cancelled)
+    except SchedulerRejectedError:
+        # 熔断 , 由 _call_stream 处理
+        raise
+    except SchedulerCancelledError:
+        return
+    except Exception as e:
+        yield {"code": -1, "msg": str(e), "complete": True}
+        return
+    instance = global_instance().queue_mapper.get(model_name,instance)
+    request_id = None
+    complete = False
+    try:
+        payload,pool = _to_worker_request(model_name,r)
+        detokenizer = IncrementalDetokenizer(pool) if pool is not None else None
+        gtype = (r.get('params',None) or {}).get('gtype','total')
+        _stamp(r,"enqueue")
+        try:
+            request_id = _put(instance,payload,r,tenant,priority,cancelable=cancelled is not None)
+        except WorkerUnavailableError as e:
+            complete = True
+            yield {"code": -1, "msg": str(e), "complete": True}
+            return
+        while not complete:
+            try:
+                result = instance.get(request_id,cancelled=cancelled)
+            except RequestCancelledError:
+                # 已取消 , 负载已释放
+                complete = True
+                return
+            complete = result["complete"]
+            if detokenizer is not None and result["code"] == 0:
+                delta = detokenizer.add(result.pop("token_ids",None) or [],final=complete)
+                if gtype == 'total':
+                    result["result"] = detokenizer.text if delta or not complete else ''
+                else:
+                    result["result"] = delta
+            yield result
+    finally:
+        _unschedule(model_name,ticket,instance,request_id,complete)
 
+def _node_request(model_name,r: typing.Dict):
+    '''
+        网关转发的请求 , 会话已在网关处理 , 这里按本机的调度 上下文裁剪 路由执行
+    '''
+    tenant = r.pop("tenant",None) or "default"
+    priority = r.pop("priority",None)
+    self = global_instance()
+    if model_name not in self.valid_model_map:
+        yield {"code": -1, "msg": "model not in " + ','.join(self.valid_model_map), "complete": True}
+        return
+    try:
+        _fit_context(model_name,r)
+    except ContextBudgetError as e:
+        yield {"code": -1, "msg": str(e), "complete": True}
+        return
+    if r["method"] == "chat_stream":
+        yield from _call_stream(model_name,r,tenant,priority)
+    else:
+        yield _call(model_name,r,tenant,priority)
 
 
 @app.get("/")
 def read_root():
     return {"aigc_serving": "hello world"}
 
+@app.get("/scheduler")
+async def scheduler_state():
+    self = global_instance()
+    return {k: v.get_state() for k,v in self.scheduler_mapper.items()}
+
+@app.get("/ready")
+async def ready(response: Response):
+    self = global_instance()
+    models = {k: v.is_ready() for k,v in self.queue_mapper.items()}
+    if self.draining:
+        response.status_code = 503
+        return {'code': -1, "msg": "draining", "models": models}
+    is_ready = len(models) > 0 and all(models.values())
+    if not is_ready:
+        response.status_code = 503
+    return {'code': 0 if is_ready else -1, "msg": "ok" if is_ready else "loading", "models": models}
+
+@app.get("/ready/{model_name}")
+async def model_ready(model_name: str,response: Response):
+    self = global_instance()
+    instance = self.queue_mapper.get(model_name,None)
+    if instance is None:
+        response.status_code = 404
+        return {'code': -1, "msg": "model not in " + ','.join(self.valid_model_map)}
+    if not instance.is_ready():
+        response.status_code = 503
+        return {'code': -1, "msg": "loading", "result": instance.get_state()}
+    return {'code': 0, "msg": "ok", "result": instance.get_state()}
+
+@app.post("/admin/drain")
+def admin_drain(api_key: typing.Optional[str] = Depends(check_api_key)):
+    '''
+        进入排空模式 , /ready 返回 503 , 新请求直接返回错误 , 在途请求继续完成
+    '''
+    self = global_instance()
+    self.draining = True
+    return {'code': 0, "msg": "ok", "result": self.outstanding()}
+
+@app.post("/admin/rolling_restart")
+def admin_rolling_restart(r: typing.Optional[typing.Dict] = None,
+                          api_key: typing.Optional[str] = Depends(check_api_key)):
+    self = global_instance()
+    model_names = (r or {}).get("models",None)
+    return {'code': 0, "msg": "ok", "result": self.rolling_restart(model_names)}
+
+@app.post("/admin/reload_config")
+def admin_reload_config(api_key: typing.Optional[str] = Depends(check_api_key)):
+    '''
+        重新加载模型配置 , 同 kill -HUP , 返回新增 删除 调整 worker 数 替换的模型 , 后台完成
+    '''
+    return global_instance().reload_config()
+
+@app.get("/autoscale")
+def autoscale_state():
+    self = global_instance()
+    if self.autoscaler is None:
+        return {'code': -1, "msg": "autoscale is disabled"}
+    return {'code': 0, "msg": "ok", "result": self.autoscaler.get_state()}
+
+@app.get("/hedge")
+def hedge_state():
+    self = global_instance()
+    if self.hedger is None:
+        return {'code': -1, "msg": "hedge is disabled"}
+    return {'code': 0, "msg": "ok", "result": self.hedger.get_state()}
+
+@app.get("/breaker")
+def breaker_state():
+    self = global_instance()
+    if not self.breaker_mapper:
+        return {'code': -1, "msg": "breaker is disabled"}
+    return {'code': 0, "msg": "ok", "result": {k: dict(v.get_state(),fallback=self.get_fallback(k))
+                                               for k,v in self.breaker_mapper.items()}}
+
+@app.get("/cluster")
+def cluster_state():
+    self = global_instance()
+    if self.gateway is not None:
+        return {'code': 0, "msg": "ok", "result": dict(self.gateway.get_state(),role="gateway")}
+    if self.node_agent is not None:
+        return {'code': 0, "msg": "ok", "result": {"role": "node", "node_id": self.node_agent.node_id,
+                                                   "gateway": self.node_agent.gateway_addr}}
+    return {'code': 0, "msg": "ok", "result": {"role": "standalone"}}
+
+@app.get("/workers")
+def workers_state():
+    self = global_instance()
+    return {k: v.get_state() for k,v in self.queue_mapper.items() if hasattr(v, 'get_state')}
+
+@app.get("/session/{conversation_id}")
+def get_session(conversation_id: str,user: typing.Optional[str] = None,
+                api_key: typing.Optional[str] = Depends(check_api_key)):
+    self = global_instance()
+    tenant = _get_tenant(api_key,user)
+    session = self.session_store.get_owned(conversation_id,tenant) if self.session_store is not None else None
+    if session is None:
+        return {'code': -1, "msg": "conversation_id not found"}
+    return {'code': 0, "msg": "ok", "result": session.to_dict()}
+
+@app.delete("/session/{conversation_id}")
+def delete_session(conversation_id: str,user: typing.Optional[str] = None,
+                   api_key: typing.Optional[str] = Depends(check_api_key)):
+    self = global_instance()
+    if self.session_store is None or not self.session_store.delete(conversation_id,_get_tenant(api_key,user)):
+        return {'code': -1, "msg": "conversation_id not found"}
+    return {'code': 0, "msg": "ok"}
+
+@app.get("/metrics")
+async def metrics():
+    self = global_instance()
+    for model_name,scheduler in self.scheduler_mapper.items():
+        _g_metrics.inflight.set(model_name,value=scheduler.inflight)
+        _g_metrics.queued.set(model_name,value=scheduler.queued)
+    return PlainTextResponse(global_registry().render(),media_type="text/plain; version=0.0.4")
+
 #@app.get("/v1/models", dependencies=[Depends(check_api_key)])
 @app.get("/v1/models")
 async def list_models():
-    models = [k for k, v in global_models_info_args.items() if v["enable"]]
-    models.sort()
+    models = sorted(global_instance().valid_model_map)
     # TODO: return real model permission details
     model_cards = []
     for m in models:
@@ -105,10 +1079,22 @@ async def list_models():
 
 @app.post("/v1/completions")
 @app.post("/v1/chat/completions")
-def create_chat_completion(request: ChatCompletionRequest):
+def create_chat_completion(request: ChatCompletionRequest,
+                           response: Response,
+                           api_key: typing.Optional[str] = Depends(check_api_key),
+                           x_priority: typing.Optional[str] = Header(None),
+                           last_event_id: typing.Optional[str] = Header(None)):
     self = global_instance()
+    receive_time = time.time()
     try:
-        logger.info(request)
+        if request.stream and last_event_id and self.stream_store is not None:
+            # 断线续传 , 不重新生成
+            stream_id,seq = parse_event_id(last_event_id)
+            buffer = self.stream_store.get(stream_id) if stream_id is not None else None
+            # 只有创建者可以续传 , 否则按新请求处理
+            if buffer is not None and buffer.owner == _get_tenant(api_key,request.user):
+                return _stream_response(buffer,seq + 1)
+        _g_request_logger.log("/v1/chat/completions",request)
         if len(request.messages) == 0:
             raise ValueError("Invalid parameters")
 
@@ -123,34 +1109,50 @@ def create_chat_completion(request: ChatCompletionRequest):
             msg = "{} Invalid model: model not in ".format(request.model) + ','.join(self.valid_model_map)
             raise ValueError(msg)
 
+        tenant = _get_tenant(api_key,request.user)
+        priority = x_priority or request.priority
+        session,r = _build_openai_request(request,tenant)
         if request.stream:
-            _openai_chat_stream_generate =  _openai_chat_stream(request)
+            stream_store = self.stream_store
+            # 后台生成数达到上限时按普通流式请求处理 , 不支持续传
+            if stream_store is not None and stream_store.acquire_producer():
+                buffer = stream_store.create(owner=tenant)
+                # 断线超过 grace_period 无人续传 , 排队和等待首帧时也停止
+                _openai_chat_stream_generate = _openai_chat_stream(request,session,r,tenant,priority,receive_time,
+                                                                   cancelled=lambda: buffer.abandoned(stream_store.grace_period))
+                return _stream_response(_start_stream_buffer(buffer,_openai_chat_stream_generate),0)
+            _openai_chat_stream_generate =  _openai_chat_stream(request,session,r,tenant,priority,receive_time)
             return StreamingResponse(_openai_chat_stream_generate, media_type="text/event-stream")
         else:
-            return _openai_chat(request)
+            return _openai_chat(request,response,session,r,tenant,priority,receive_time)
+    except (ContextBudgetError,SessionError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         traceback.print_exc()
         print(e)
         return HTTPException(status_code=501, detail=str(e))
 
 
-def _openai_chat(request: ChatCompletionRequest):
-    self = global_instance()
-    r = request.build_request_chat()
+def _openai_chat(request: ChatCompletionRequest,response: Response,session,r: typing.Dict,tenant,priority=None,receive_time=None):
+    _stamp(r,"receive",receive_time)
     choices = []
+    timings = []
     prompt_length, response_length = 0, 0
     for i in range(max(1,request.n)):
-        instance = self.queue_mapper[request.model]
-        request_id = instance.put(r)
-        result = instance.get(request_id)
+        result = _call(request.model,r,tenant,priority)
         if result["code"] != 0:
             raise HTTPException(status_code=400, detail=result["msg"])
-        for x in r["history"]:
-            prompt_length += len(x['q'])
-            prompt_length += len(x['a'])
-        prompt_length += len(r['query'])
-
-        response_length = len(result["result"])
+        timing = result.get("timing",None)
+        timings.append(timing)
+        if timing is not None:
+            prompt_length += timing["prompt_tokens"]
+            response_length += timing["completion_tokens"]
+        else:
+            for x in r["history"]:
+                prompt_length += len(x['q'])
+                prompt_length += len(x['a'])
+            prompt_length += len(r['query'])
+            response_length += len(result["result"])
         choice_data = ChatCompletionResponseChoice(
             index=0,
             message=ChatMessage(role=Role.ASSISTANT, content=result["result"]),
@@ -162,10 +1164,60 @@ def _openai_chat(request: ChatCompletionRequest):
         completion_tokens=response_length,
         total_tokens=prompt_length + response_length
     )
+    _set_timing_headers(response,_merge_timing(timings))
+    if session is not None:
+        _close_session(session,r["query"],choices[0].message.content)
+        return ChatCompletionResponse(model=request.model, choices=choices, usage=usage,
+                                      conversation_id=session.conversation_id)
     return ChatCompletionResponse(model=request.model, choices=choices, usage=usage)
 
-def _openai_chat_stream(request: ChatCompletionRequest):
-    self = global_instance()
+def _start_stream_buffer(buffer: StreamBuffer,generator) -> StreamBuffer:
+    '''
+        后台线程生成 , 事件写入缓存 , 与客户端连接解耦 ; 调用方已占用 stream_store 的生成名额 , 结束时释放
+    '''
+    stream_store = global_instance().stream_store
+
+    def produce():
+        try:
+            for data in generator:
+                buffer.append(data)
+                if buffer.abandoned(stream_store.grace_period):
+                    logger.info('stream {} abandoned , stop generate'.format(buffer.stream_id))
+                    break
+        except Exception as e:
+            traceback.print_exc()
+            buffer.append(f"data: {json.dumps({'code': -1, 'msg': str(e)}, ensure_ascii=False)}\n\n")
+        finally:
+            generator.close()
+            buffer.finish()
+            stream_store.release_producer()
+
+    threading.Thread(target=produce,daemon=True).start()
+    return buffer
+
+def _stream_response(buffer: StreamBuffer,start_seq):
+    def iterdata():
+        seq = start_seq
+        if seq < buffer.first_seq():
+            error = {'code': -1, 'msg': 'Last-Event-ID out of replay buffer'}
+            yield f"data: {json.dumps(error, ensure_ascii=False)}\n\n"
+            return
+        buffer.attach()
+        try:
+            while True:
+                events,done = buffer.read(seq)
+                for event_seq,data in events:
+                    yield f"id: {buffer.event_id(event_seq)}\n{data}"
+                    seq = event_seq + 1
+                if done:
+                    break
+        finally:
+            buffer.detach()
+
+    return StreamingResponse(iterdata(), media_type="text/event-stream",
+                             headers={"X-Stream-Id": buffer.stream_id})
+
+def _openai_chat_stream(request: ChatCompletionRequest,session,r: typing.Dict,tenant,priority=None,receive_time=None,cancelled=None):
     choice_data = ChatCompletionResponseStreamChoice(
         index=0,
         delta=DeltaMessage(role=Role.ASSISTANT,content=''),
@@ -174,15 +1226,17 @@ def _openai_chat_stream(request: ChatCompletionRequest):
     chunk = ChatCompletionStreamResponse(model=request.model, choices=[choice_data])
     yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
 
-    r = request.build_request_streaming()
-    instance = self.queue_mapper[request.model]
-    request_id = instance.put(r)
-
-    while True:
-        result = instance.get(request_id)
+    _stamp(r,"receive",receive_time)
+    timing = None
+    response_text,success,complete = '',True,False
+    for result in _call_stream(request.model,r,tenant,priority,cancelled=cancelled):
+        timing = result.get("timing",timing)
+        complete = complete or result["complete"]
         if result["code"] != 0:
+            success = False
             yield f"data: {json.dumps(result, ensure_ascii=False)}\n\n"
         elif len(result["result"]) > 0:
+            response_text = _accumulate_text(response_text,result["result"],request.gtype)
             choice_data = ChatCompletionResponseStreamChoice(
                 index=0,
                 delta=DeltaMessage(role=Role.ASSISTANT,content=result["result"]),
@@ -191,9 +1245,6 @@ def _openai_chat_stream(request: ChatCompletionRequest):
             chunk = ChatCompletionStreamResponse(model=request.model, choices=[choice_data])
             yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
 
-        if result["complete"]:
-            break
-
 
     choice_data = ChatCompletionResponseStreamChoice(
         index=0,
@@ -201,14 +1252,28 @@ def _openai_chat_stream(request: ChatCompletionRequest):
         finish_reason=Finish.STOP
     )
     chunk = ChatCompletionStreamResponse(model=request.model, choices=[choice_data])
+    if session is not None:
+        # 取消的请求没有结束帧 , 不写入会话
+        if success and complete:
+            _close_session(session,r["query"],response_text)
+        chunk.conversation_id = session.conversation_id
+    if timing is not None:
+        chunk.timing = timing
+        chunk.usage = UsageInfo(prompt_tokens=timing["prompt_tokens"],
+                                completion_tokens=timing["completion_tokens"],
+                                total_tokens=timing["prompt_tokens"] + timing["completion_tokens"])
     yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
     yield "data: [DONE]\n\n"
 
 @app.post("/generate")
-def generate(r: typing.Dict):
+def generate(r: typing.Dict,
+             response: Response,
+             api_key: typing.Optional[str] = Depends(check_api_key),
+             x_priority: typing.Optional[str] = Header(None)):
     self = global_instance()
     try:
-        logger.info(r)
+        _stamp(r,"receive")
+        _g_request_logger.log("/generate",r)
         r["method"] = "generate"
         model_name = r.get('model', None)
         texts = r.get('texts', [])
@@ -219,10 +1284,10 @@ def generate(r: typing.Dict):
             print(msg)
             return {'code': -1, "msg": msg}
 
-        instance = self.queue_mapper[model_name]
-        request_id = instance.put(r)
-        result = instance.get(request_id)
-
+        _fit_context(model_name,r)
+        tenant = _get_tenant(api_key,r.get('user',None))
+        result = _call(model_name,r,tenant,x_priority or r.get('priority',None))
+        _set_timing_headers(response,result.pop("timing",None))
         return result
     except Exception as e:
         traceback.print_exc()
@@ -230,10 +1295,14 @@ def generate(r: typing.Dict):
         return {'code': -1, "msg": str(e)}
 
 @app.post("/chat")
-def chat(r: typing.Dict):
+def chat(r: typing.Dict,
+         response: Response,
+         api_key: typing.Optional[str] = Depends(check_api_key),
+         x_priority: typing.Optional[str] = Header(None)):
     self = global_instance()
     try:
-        logger.info(r)
+        _stamp(r,"receive")
+        _g_request_logger.log("/chat",r)
         r["method"] = "chat"
         model_name = r.get('model', None)
         history = r.get('history', [])
@@ -249,10 +1318,18 @@ def chat(r: typing.Dict):
             print(msg)
             return {'code': -1, "msg": msg}
 
-        instance = self.queue_mapper[model_name]
-        request_id = instance.put(r)
-        result = instance.get(request_id)
-
+        tenant = _get_tenant(api_key,r.get('user',None))
+        session = _open_session(model_name,r.get('conversation_id',None),tenant,history)
+        _bind_session(r,session)
+        _fit_context(model_name,r)
+        result = _call(model_name,r,tenant,x_priority or r.get('priority',None))
+        _set_timing_headers(response,result.pop("timing",None))
+        if session is not None:
+            if result["code"] == 0:
+                _close_session(session,query,result["result"])
+            # 会话由服务端保存 , 不再返回完整历史
+            result.pop("history",None)
+            result["conversation_id"] = session.conversation_id
         return result
     except Exception as e:
         traceback.print_exc()
@@ -260,10 +1337,13 @@ def chat(r: typing.Dict):
         return {'code': -1, "msg": str(e)}
 
 @app.post("/chat_stream")
-def chat_stream(r: typing.Dict):
+def chat_stream(r: typing.Dict,
+                api_key: typing.Optional[str] = Depends(check_api_key),
+                x_priority: typing.Optional[str] = Header(None)):
     self = global_instance()
     try:
-        logger.info(r)
+        _stamp(r,"receive")
+        _g_request_logger.log("/chat_stream",r)
         r["method"] = "chat_stream"
         model_name = r.get('model', None)
         history = r.get('history', [])
@@ -288,15 +1368,26 @@ def chat_stream(r: typing.Dict):
             print(msg)
             return {'code': -1, "msg": msg}
 
-        instance = self.queue_mapper[model_name]
-        request_id = instance.put(r)
+        tenant = _get_tenant(api_key,r.get('user',None))
+        session = _open_session(model_name,r.get('conversation_id',None),tenant,history)
+        _bind_session(r,session)
+        _fit_context(model_name,r)
+        priority = x_priority or r.get('priority',None)
+
+        # worker 按 params.gtype 输出
+        stream_gtype = (r.get('params', None) or {}).get('gtype', 'total')
 
         def iterdata():
-            while True:
-                result = instance.get(request_id)
+            response_text = ''
+            for result in _call_stream(model_name,r,tenant,priority):
+                if session is not None:
+                    if result["code"] == 0:
+                        response_text = _accumulate_text(response_text,result.get("result",""),stream_gtype)
+                        if result["complete"]:
+                            _close_session(session,query,response_text)
+                    result.pop("history",None)
+                    result["conversation_id"] = session.conversation_id
                 yield json.dumps(result, ensure_ascii=False)
-                if result["complete"]:
-                    break
     except Exception as e:
         traceback.print_exc()
         print(e)
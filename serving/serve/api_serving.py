@@ -5,48 +5,152 @@
 import os
 import multiprocessing
 import shutil
-from serving.workers import llm_worker
-from ipc_worker.ipc_zmq_loader import IPC_zmq, ZMQ_process_worker # noqa
-from config.main import global_models_info_args
+from serving.workers.worker_group import WorkerGroup
+from config.main import global_models_info_args, global_ipc_args, global_worker_args, global_hedge_args
 from serving.utils import logger
+from serving.utils.metrics import MetricsCollector, global_registry
+from serving.workers.supervisor import WorkerSupervisor
+
+# auto_quantize 时加载后量化 ( model.half().quantize ) 的模型 , 量化算子只支持 cuda
+_AUTO_QUANTIZE_TYPES = ('chatglm', 'chatglm2', 'baichuan', 'baichuan2', 'internlm', 'qwen')
 
 class WokerLoader:
-    def __init__(self,queue_mapper):
+    '''
+        前端进程只依赖轻量模块 , worker 模块 ( torch , transformers ) 在 create 时才导入
+    '''
+    def __init__(self,queue_mapper,on_ready=None):
         self.queue_mapper = queue_mapper
-        self.evt_quit = multiprocessing.Manager().Event()
+        # on_ready(model_name , instance) , worker 变为就绪时调用
+        self.on_ready = on_ready
+        self.evt_quit = None
         self.process_list = []
+        # worker 指标旁路通道
+        self.metrics_queue = multiprocessing.Queue(maxsize=10000)
+        self.metrics_collector = MetricsCollector(self.metrics_queue, global_registry(), handlers=[self._on_heartbeat])
+        self.supervisor = None
+
+    def _on_heartbeat(self, item):
+        heartbeat = item.get("heartbeat", None)
+        if heartbeat is None:
+            return
+        # 配置热加载时同一模型可能同时存在新旧两组 worker , 按 pid 区分
+        for instance in list(self.process_list):
+            if instance.worker_args[0] == item["model"]:
+                if instance.on_heartbeat(item["worker"], heartbeat) and self.on_ready is not None:
+                    self.on_ready(item["model"], instance)
 
     def create(self):
         logger.info('WokerLoader create...')
-        queue_mapper = self.queue_mapper
-        process_list = self.process_list
+        self.evt_quit = multiprocessing.Manager().Event()
+        self.metrics_collector.start()
         for model_name, config in global_models_info_args.items():
             if not config["enable"]:
                 continue
-            group_name = 'ai_group_{}'.format(model_name)
-            # group_name
-            # manager is an agent  and act as a load balancing
-            # worker is real doing your work
-            instance = IPC_zmq(
-                CLS_worker=llm_worker.My_worker,
-                worker_args=(model_name, config,),  # must be tuple
-                worker_num=len(config['workers']),  # number of worker Process  大模型 建议使用1个 worker
-                group_name=group_name,  # share memory name
-                evt_quit=self.evt_quit,
-                queue_size=20,  # recv queue size
-                is_log_time=True,  # whether log compute time
-            )
-            process_list.append(instance)
-            queue_mapper[model_name] = instance
-            instance.start()
+            self.add_group(model_name, config)
+        if global_worker_args["supervise"]:
+            self.supervisor = WorkerSupervisor(self.process_list, check_interval=global_worker_args["check_interval"])
+            self.supervisor.start()
+
+    def add_group(self, model_name, config, activate=True):
+        '''
+            启动一组 worker , activate 为 False 时只启动不接收请求 , 由 activate_group 替换旧的 worker 组
+        '''
+        from serving.workers import llm_worker
+        group_name = 'ai_group_{}'.format(model_name)
+        # 请求对冲的取消标记 , 共享内存 , 前端写 worker 读
+        cancel_slots = multiprocessing.RawArray('i', global_hedge_args["cancel_slots"]) if global_hedge_args["enable"] else None
+        worker_args = (model_name, config, self.metrics_queue, cancel_slots,)
+        CLS_worker = llm_worker.My_worker
+        fork_server = None
+        if config.get("fork_workers", False):
+            # cpu 模式 , 模型加载一次 , worker 由 fork server fork , 权重内存 copy-on-write 共享
+            assert all(_['device_id'] is None for _ in config['workers']), \
+                ValueError('{} fork_workers only support cpu workers , device_id must be None'.format(model_name))
+            assert multiprocessing.get_start_method() == 'fork', ValueError('fork_workers require fork start method')
+            model_type = config.get('model_config',{}).get('model_type',None)
+            assert not (config.get('auto_quantize',True) and model_type in _AUTO_QUANTIZE_TYPES), \
+                ValueError('{} fork_workers run on cpu , quantized model not support , set auto_quantize False'.format(model_name))
+            from serving.workers.fork_server import ForkServer
+            fork_server = ForkServer(CLS_worker, worker_args, group_name, self.evt_quit)
+            fork_server.start()
+            CLS_worker = fork_server.create_worker
+        # group_name
+        # manager is an agent  and act as a load balancing
+        # worker is real doing your work
+        instance = WorkerGroup(
+            CLS_worker=CLS_worker,
+            worker_args=worker_args,  # must be tuple
+            worker_num=len(config['workers']),  # number of worker Process  大模型 建议使用1个 worker
+            group_name=group_name,  # share memory name
+            evt_quit=self.evt_quit,
+            queue_size=20,  # recv queue size
+            is_log_time=True,  # whether log compute time
+            codec=global_ipc_args["codec"],  # binary or pickle
+            balance=config.get("balance", global_worker_args["balance"]),  # least_work or round_robin
+            load_factor=global_worker_args["load_factor"],  # bounded load for affinity routing
+            virtual_nodes=global_worker_args["virtual_nodes"],
+            ipc_timeout=global_worker_args["ipc_timeout"],  # max seconds waiting for next result frame
+            heartbeat=bool(global_worker_args["heartbeat_interval"]),
+            heartbeat_timeout=global_worker_args["heartbeat_timeout"],
+            stall_timeout=global_worker_args["stall_timeout"],
+            restart_backoff=global_worker_args["restart_backoff"],
+            max_restart_backoff=global_worker_args["max_restart_backoff"],
+            max_retries=global_worker_args["max_retries"],
+            max_requests=config.get("max_requests", global_worker_args["max_requests"]),  # recycle policy
+            max_rss=config.get("max_rss", global_worker_args["max_rss"]),
+            max_age=config.get("max_age", global_worker_args["max_age"]),
+            recycle_timeout=global_worker_args["recycle_timeout"],
+            cancel_slots=cancel_slots,
+            fork_server=fork_server,
+        )
+        instance.start()
+        self.process_list.append(instance)
+        if activate:
+            self.queue_mapper[model_name] = instance
+        return instance
+
+    def activate_group(self, model_name, instance):
+        '''
+            新请求改发到 instance , 返回旧的 worker 组
+        '''
+        old = self.queue_mapper.get(model_name, None)
+        self.queue_mapper[model_name] = instance
+        return old
+
+    def resize_group(self, model_name, config):
+        instance = self.queue_mapper[model_name]
+        return instance.resize(len(config['workers']),
+                               worker_args=(model_name, config, self.metrics_queue, instance.cancel_slots,))
+
+    def remove_group(self, model_name, instance=None):
+        '''
+            停止一组 worker , 默认为模型当前的 worker 组 , 调用方负责先排空
+        '''
+        if instance is None:
+            instance = self.queue_mapper.get(model_name, None)
+            if instance is None:
+                return
+        if self.queue_mapper.get(model_name, None) is instance:
+            self.queue_mapper.pop(model_name, None)
+        if instance in self.process_list:
+            self.process_list.remove(instance)
+        try:
+            instance.terminate()
+        except Exception as e:  # noqa
+            logger.error('{} terminate error {}'.format(instance.group_name, e))
 
     def release(self):
         logger.info('WokerLoader release ...')
         try:
-            self.evt_quit.set()
+            self.metrics_collector.stop()
+            if self.supervisor is not None:
+                self.supervisor.stop()
+                self.supervisor = None
+            if self.evt_quit is not None:
+                self.evt_quit.set()
             for p in self.process_list:
                 p.terminate()
-            del self.evt_quit
+            self.evt_quit = None
         except Exception as e:  # noqa
             print(e)
         logger.info('WokerLoader release end')
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/13 11:05
+import threading
+import time
+import typing
+from config.utils.env_check import check_config
+from serving.utils import logger
+
+__all__ = [
+    'AutoScalePolicy',
+    'AutoScaler',
+    'allocate_workers',
+]
+
+
+class AutoScalePolicy:
+    '''
+        单个模型的扩缩容策略 , 只根据传入的状态计算目标 worker 数 , 不依赖进程 , 可离线模拟
+        排队过久时扩容 , 扩容的 worker 加载完成前不再扩容 ; 无排队且利用率低持续一段时间后缩容
+        按排队时间而不是排队数判断 , 排队数受 max_queue_size 限制 , 满了直接拒绝 , 不能反映负载
+    '''
+    def __init__(self, min_workers=1, max_workers=1, scale_up_wait=10,
+                 scale_down_utilization=0.5, scale_down_delay=300,
+                 up_cooldown=60, down_cooldown=300, **kwargs):
+        assert 0 < min_workers <= max_workers, ValueError('autoscale need 0 < min_workers <= max_workers')
+        assert scale_up_wait > 0, ValueError('autoscale need scale_up_wait > 0')
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.scale_up_wait = scale_up_wait
+        self.scale_down_utilization = scale_down_utilization
+        self.scale_down_delay = scale_down_delay
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.last_scale_time = None
+        # 开始满足缩容条件的时间
+        self.low_since = None
+        # 在途请求数的指数平均 , 瞬时值波动大
+        self.avg_inflight = None
+
+    def decide(self, now, workers, starting=0, queued=0, inflight=0, oldest_wait=0.0, avg_wait=0.0):
+        '''
+            workers: 当前 worker 数 , starting: 其中加载中的 , queued: 排队请求数 ,
+            inflight: 已下发未完成的请求数 ( 缩容按其指数平均判断 ) , oldest_wait: 最早排队请求已等待秒数 ,
+            avg_wait: 上次检查以来下发的请求的平均排队秒数 , 返回目标 worker 数
+        '''
+        self.avg_inflight = inflight if self.avg_inflight is None else 0.8 * self.avg_inflight + 0.2 * inflight
+        if workers < self.min_workers:
+            return self.min_workers
+        if workers > self.max_workers:
+            return self.max_workers
+        since = now - self.last_scale_time if self.last_scale_time is not None else float('inf')
+        pressure = max(oldest_wait if queued > 0 else 0.0, avg_wait) >= self.scale_up_wait
+        if pressure:
+            self.low_since = None
+            if workers < self.max_workers and starting == 0 and since >= self.up_cooldown:
+                return workers + 1
+            return workers
+        if queued == 0 and self.avg_inflight <= self.scale_down_utilization * workers and workers > self.min_workers:
+            if self.low_since is None:
+                self.low_since = now
+            if now - self.low_since >= self.scale_down_delay and since >= self.down_cooldown:
+                return workers - 1
+        else:
+            self.low_since = None
+        return workers
+
+    def record(self, now):
+        self.last_scale_time = now
+        self.low_since = None
+
+
+def allocate_workers(models_info_args: typing.Dict, model_name, worker_num, max_workers_per_device=1):
+    '''
+        计算模型新的 workers 配置 , 缩容去掉末尾的 worker , 扩容从 device_pool 依次选用未占满的设备 ,
+        各模型共享设备 , 占用数按所有启用模型当前的 workers 统计 , 设备不足返回 None
+    '''
+    config = models_info_args[model_name]
+    workers = list(config['workers'])
+    if worker_num <= len(workers):
+        return workers[:worker_num]
+
+    used = {}
+    for name, conf in models_info_args.items():
+        if not conf["enable"]:
+            continue
+        for worker in conf['workers']:
+            for device in worker.get('device_id', None) or []:
+                used[device] = used.get(device, 0) + 1
+
+    device_pool = (config.get("autoscale", None) or {}).get("device_pool", None)
+    new_workers = []
+    while len(workers) + len(new_workers) < worker_num:
+        if not device_pool:
+            # 没有设备池 , 复用最后一个 worker 的设备配置 , 如 cpu 或 mock 模型
+            new_workers.append({"device_id": workers[-1].get('device_id', None)})
+            continue
+        device_id = None
+        for candidate in device_pool:
+            if all(used.get(_, 0) < max_workers_per_device for _ in candidate):
+                device_id = list(candidate)
+                break
+        if device_id is None:
+            return None
+        for device in device_id:
+            used[device] = used.get(device, 0) + 1
+        new_workers.append({"device_id": device_id})
+    # deepspeed 多卡 worker 分配通信端口
+    check_config({model_name: dict(config, workers=new_workers)})
+    return workers + new_workers
+
+
+class AutoScaler:
+    '''
+        前端进程内的后台线程 , 定时按各模型的排队时间调整 worker 数 , 调整通过 Resource.scale_model 完成
+    '''
+    def __init__(self, resource, interval=5, dry_run=False, max_workers_per_device=1, **policy_args):
+        self.resource = resource
+        self.interval = interval
+        self.dry_run = dry_run
+        self.max_workers_per_device = max_workers_per_device
+        self.policy_args = policy_args
+        # model_name -> (autoscale 配置 , AutoScalePolicy)
+        self.policies = {}
+        # model_name -> (时间 , 累计下发数 , 累计排队秒数) , 计算区间平均排队时间
+        self._admitted = {}
+        # model_name -> 没有调度器时开始有请求排队的时间
+        self._queued_since = {}
+        self.decisions = []
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.interval + 5)
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            for model_name, config in list(self.resource.models_info_args.items()):
+                if self._stop.is_set():
+                    break
+                if not config["enable"] or not config.get("autoscale", None):
+                    self.policies.pop(model_name, None)
+                    self._admitted.pop(model_name, None)
+                    self._queued_since.pop(model_name, None)
+                    continue
+                try:
+                    self.check_model(model_name, config, time.time())
+                except Exception as e:  # noqa
+                    logger.error('{} autoscale error {}'.format(model_name, e))
+
+    def _get_policy(self, model_name, config):
+        autoscale = config["autoscale"]
+        item = self.policies.get(model_name, None)
+        if item is None or item[0] != autoscale:
+            # 配置热加载后重建 , 保留冷却时间
+            policy = AutoScalePolicy(**dict(self.policy_args, **autoscale))
+            if item is not None:
+                policy.last_scale_time = item[1].last_scale_time
+            item = self.policies[model_name] = (autoscale, policy)
+        return item[1]
+
+    def get_stats(self, model_name, now=None):
+        instance = self.resource.queue_mapper.get(model_name, None)
+        if instance is None:
+            return None
+        now = now or time.time()
+        state = instance.get_state()
+        workers = [_ for _ in state["workers"] if _["state"] != 'retired']
+        stats = {
+            "workers": len(workers),
+            "starting": sum(1 for _ in workers if _["state"] in ['starting', 'restarting']),
+            "inflight": instance.outstanding(),
+            "queued": 0,
+            "oldest_wait": 0.0,
+            "avg_wait": 0.0,
+        }
+        scheduler = self.resource.scheduler_mapper.get(model_name, None)
+        if scheduler is not None:
+            sched_state = scheduler.get_state()
+            stats["queued"] = sched_state["queued"]
+            stats["oldest_wait"] = max([_["oldest_wait"] for _ in sched_state["classes"].values()] or [0.0])
+            last = self._admitted.get(model_name, None)
+            self._admitted[model_name] = (now, sched_state["admitted"], sched_state["wait_sum"])
+            if last is not None and sched_state["admitted"] > last[1]:
+                stats["avg_wait"] = (sched_state["wait_sum"] - last[2]) / (sched_state["admitted"] - last[1])
+        else:
+            # 没有调度器时请求在 worker 的 zmq 队列中等待 , 按持续有排队的时间估计
+            stats["queued"] = max(0, stats["inflight"] - stats["workers"])
+            if stats["queued"] == 0:
+                self._queued_since.pop(model_name, None)
+            else:
+                stats["oldest_wait"] = now - self._queued_since.setdefault(model_name, now)
+        return stats
+
+    def check_model(self, model_name, config, now):
+        stats = self.get_stats(model_name, now)
+        if stats is None:
+            return
+        policy = self._get_policy(model_name, config)
+        target = policy.decide(now, **stats)
+        if target == stats["workers"]:
+            return
+        workers = allocate_workers(self.resource.models_info_args, model_name, target, self.max_workers_per_device)
+        if workers is None:
+            logger.warning('{} autoscale to {} workers , no free device'.format(model_name, target))
+            policy.record(now)
+            return
+        # 模型正在热加载或调整中 , 下次再检查
+        if not self.dry_run and not self.resource.scale_model(model_name, workers):
+            return
+        logger.info('{} autoscale {} -> {} workers{} , {}'.format(
+            model_name, stats["workers"], target, ' ( dry run )' if self.dry_run else '', stats))
+        policy.record(now)
+        self.decisions.append({"time": now, "model": model_name, "from": stats["workers"], "to": target, "stats": stats})
+        del self.decisions[:-100]
+
+    def get_state(self):
+        return {
+            "dry_run": self.dry_run,
+            "models": {k: {"min_workers": v[1].min_workers, "max_workers": v[1].max_workers,
+                           "last_scale_time": v[1].last_scale_time} for k, v in self.policies.items()},
+            "decisions": list(self.decisions),
+        }
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/14 10:15
+import threading
+import time
+import typing
+from collections import deque
+from serving.utils import logger
+
+__all__ = [
+    'CircuitBreaker',
+]
+
+
+class CircuitBreaker:
+    '''
+        单个模型的熔断器
+        closed: 正常 , 最近 window 秒请求数不少于 min_requests 且失败率达到 error_rate 时打开
+        open: 请求直接拒绝 , open_time 秒后进入 half_open , 连续熔断时间加倍 , 最长 max_open_time 秒
+        half_open: 最多放行 half_open_requests 个探测请求 , 全部成功则关闭 , 任一失败重新打开
+        acquire 返回放行时的状态 , 拒绝返回 None , 结果通过 record 回报 , 状态已变化的结果忽略
+    '''
+    def __init__(self, name, window=60, min_requests=10, error_rate=0.5, slow_call_seconds=0,
+                 open_time=30, max_open_time=300, half_open_requests=1,
+                 on_open: typing.Optional[typing.Callable] = None, **kwargs):
+        assert 0 < error_rate <= 1, ValueError('breaker error_rate must in (0,1]')
+        self.name = name
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_time = open_time
+        self.max_open_time = max_open_time
+        self.half_open_requests = half_open_requests
+        self.on_open = on_open
+        self.state = 'closed'
+        # (完成时间 , 是否失败)
+        self._calls = deque()
+        self._lock = threading.Lock()
+        self._open_until = 0
+        # 连续熔断次数 , 决定 open 时长
+        self._trips = 0
+        self._probes = 0
+        self._probe_time = 0
+        self._probe_success = 0
+        self.opened = 0
+        self.rejected = 0
+        self.fallbacks = 0
+        self.last_error = None
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            if self.state == 'open':
+                if now < self._open_until:
+                    self.rejected += 1
+                    return None
+                self.state = 'half_open'
+                self._probes = self._probe_success = 0
+                logger.info('{} circuit half open'.format(self.name))
+            if self.state == 'half_open':
+                # 探测请求长时间没有结果 , 不再占用名额
+                if self._probes >= self.half_open_requests and now - self._probe_time < self.open_time:
+                    self.rejected += 1
+                    return None
+                self._probes += 1
+                self._probe_time = now
+            return self.state
+
+    def is_failure(self, result: typing.Optional[typing.Dict], latency=None):
+        if result is None or result.get("code", -1) != 0:
+            return True
+        return bool(self.slow_call_seconds and latency is not None and latency > self.slow_call_seconds)
+
+    def record(self, admitted, failure: typing.Optional[bool], error=None):
+        '''
+            admitted: acquire 的返回值 , failure 为 None 表示请求未执行 , 只释放探测名额
+        '''
+        callback = False
+        with self._lock:
+            if failure and error:
+                self.last_error = error
+            if admitted == 'half_open' and self.state == 'half_open':
+                self._probes = max(0, self._probes - 1)
+                if failure is None:
+                    return
+                if failure:
+                    callback = self._open_locked('probe failed')
+                else:
+                    self._probe_success += 1
+                    if self._probe_success >= self.half_open_requests:
+                        self.state = 'closed'
+                        self._trips = 0
+                        self._calls.clear()
+                        logger.info('{} circuit closed'.format(self.name))
+            elif admitted == 'closed' and self.state == 'closed' and failure is not None:
+                now = time.time()
+                self._calls.append((now, failure))
+                while self._calls and now - self._calls[0][0] > self.window:
+                    self._calls.popleft()
+                failures = sum(1 for _ in self._calls if _[1])
+                if len(self._calls) >= self.min_requests and failures >= self.error_rate * len(self._calls):
+                    callback = self._open_locked('{}/{} failed in {}s'.format(failures, len(self._calls), self.window))
+        if callback and self.on_open is not None:
+            self.on_open(self.name)
+
+    def _open_locked(self, reason):
+        open_time = min(self.max_open_time, self.open_time * (2 ** self._trips))
+        self._trips += 1
+        self.state = 'open'
+        self._open_until = time.time() + open_time
+        self._calls.clear()
+        self.opened += 1
+        logger.error('{} circuit open for {}s , {} , last error {}'.format(self.name, open_time, reason, self.last_error))
+        return True
+
+    def get_state(self):
+        with self._lock:
+            failures = sum(1 for _ in self._calls if _[1])
+            return {
+                "state": self.state,
+                "requests": len(self._calls),
+                "failures": failures,
+                "open_remaining": max(0.0, self._open_until - time.time()) if self.state == 'open' else 0.0,
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "fallbacks": self.fallbacks,
+                "last_error": self.last_error,
+            }
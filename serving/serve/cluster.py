@@ -0,0 +1,553 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/13 16:10
+import hashlib
+import hmac
+import itertools
+import json
+import math
+import os
+import queue
+import struct
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+import zmq
+from serving.utils import logger
+from serving.utils.ipc_codec import encode_request, decode_request, ResultEncoder, ResultDecoder
+from serving.workers.hash_ring import HashRing
+from serving.workers.worker_group import WorkerUnavailableError, RequestCancelledError, CANCEL_CHECK_INTERVAL
+
+__all__ = [
+    'Gateway',
+    'RemoteGroup',
+    'NodeAgent',
+]
+
+# node -> 网关 : [heartbeat , json , 签名] , [result , request_id , 结果帧 , 签名]
+# 网关 -> node : [request , request_id , 请求 , 签名]
+# 请求和结果帧用 json 编码 extra 和非文本结果 ( ipc_codec safe ) , 不反序列化 pickle
+_MSG_HEARTBEAT = b'heartbeat'
+_MSG_REQUEST = b'request'
+_MSG_RESULT = b'result'
+
+
+def _sign(secret, identity, *parts):
+    '''
+        HMAC-SHA256 , 包含 node 连接的 identity 和消息类型 , 截获的帧不能从其他连接重放 , 也不能换成其他类型的消息
+        只做认证 , 不加密 , 跨机房部署请走内网或 VPN
+    '''
+    if not secret:
+        return b''
+    h = hmac.new(secret.encode('utf-8'), identity, hashlib.sha256)
+    for part in parts:
+        h.update(struct.pack('<Q', len(part)))
+        h.update(part)
+    return h.digest()
+
+
+def _verify(secret, signature, identity, *parts):
+    return not secret or hmac.compare_digest(signature, _sign(secret, identity, *parts))
+
+
+def _is_loopback(addr):
+    if not addr.startswith('tcp://'):
+        return True
+    host = addr[len('tcp://'):].rsplit(':', 1)[0].strip('[]')
+    return host in ('localhost', '::1') or host.startswith('127.')
+
+
+class _Channel:
+    '''
+        zmq socket 不是线程安全的 , 由 io 线程独占 , 其他线程通过 inproc 管道把消息交给 io 线程发送
+    '''
+    def __init__(self, context, name):
+        self.context = context
+        self.addr = 'inproc://{}'.format(name)
+        self.pull = context.socket(zmq.PULL)
+        self.pull.bind(self.addr)
+        self._local = threading.local()
+
+    def send(self, frames):
+        push = getattr(self._local, 'push', None)
+        if push is None:
+            push = self._local.push = self.context.socket(zmq.PUSH)
+            push.setsockopt(zmq.LINGER, 0)
+            push.connect(self.addr)
+        push.send_multipart(frames)
+
+
+def _recv_all(socket):
+    while True:
+        try:
+            yield socket.recv_multipart(zmq.NOBLOCK)
+        except zmq.Again:
+            return
+
+
+class RemoteNode:
+    def __init__(self, node_id, identity):
+        self.node_id = node_id
+        self.identity = identity
+        self.alive = True
+        self.heartbeat_time = time.time()
+        self.register_time = time.time()
+        # 最近一次心跳的序号 , 序号不增加的心跳为重放 , 丢弃
+        self.seq = 0
+        # model_name -> {"ready","workers","outstanding"} , 来自心跳
+        self.models = {}
+
+    def to_dict(self):
+        return {
+            "node_id": self.node_id,
+            "alive": self.alive,
+            "heartbeat_time": self.heartbeat_time,
+            "register_time": self.register_time,
+            "models": self.models,
+        }
+
+
+class _RemoteInflight:
+    def __init__(self, request_id, group, node_id, data, decoder):
+        self.request_id = request_id
+        self.group = group
+        self.node_id = node_id
+        # 已编码的请求 , 用于重试
+        self.data = data
+        self.decoder = decoder
+        self.queue = queue.Queue()
+        self.frames = 0
+        self.retries = 0
+
+
+class RemoteGroup:
+    '''
+        网关上一个模型在各 node 上的 worker , 接口与 WorkerGroup 相同 , route 和 put 的 worker_idx 为 node_id
+        按 node 在途请求数 / worker 数下发 , route_key 按一致性哈希优先发往同一 node
+    '''
+    remote = True
+
+    def __init__(self, gateway, model_name):
+        self.gateway = gateway
+        self.model_name = model_name
+        self.group_name = 'remote_{}'.format(model_name)
+        # node_id -> 在途请求数
+        self.node_outstanding = {}
+        self._ring = None
+        self._ring_nodes = frozenset()
+        self.affinity_hits = 0
+        self.affinity_fallbacks = 0
+
+    def _ready_nodes(self):
+        return {node.node_id: node for node in self.gateway.nodes.values()
+                if node.alive and node.models.get(self.model_name, {}).get('ready', False)}
+
+    def _workers(self, node):
+        return max(1, node.models.get(self.model_name, {}).get('workers', 1))
+
+    def is_ready(self):
+        with self.gateway.lock:
+            return len(self._ready_nodes()) > 0
+
+    def wait_ready(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        while not self.is_ready():
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.5)
+        return True
+
+    def route(self, route_key: typing.Optional[str]):
+        if not route_key:
+            return None
+        with self.gateway.lock:
+            nodes = self._ready_nodes()
+            if not nodes:
+                return None
+            if frozenset(nodes) != self._ring_nodes:
+                self._ring_nodes = frozenset(nodes)
+                self._ring = HashRing(sorted(nodes), replicas=self.gateway.virtual_nodes)
+            total = sum(self.node_outstanding.get(_, 0) for _ in nodes)
+            workers = sum(self._workers(_) for _ in nodes.values())
+            for i, node_id in enumerate(self._ring.iter_nodes(route_key)):
+                # 有界负载 , 按 worker 数分摊
+                bound = max(1, math.ceil(self.gateway.load_factor * (total + 1) * self._workers(nodes[node_id]) / workers))
+                if self.node_outstanding.get(node_id, 0) < bound:
+                    if i == 0:
+                        self.affinity_hits += 1
+                    else:
+                        self.affinity_fallbacks += 1
+                    return node_id
+        return None
+
+    def _select(self, exclude=None):
+        nodes = {k: v for k, v in self._ready_nodes().items() if k != exclude}
+        if not nodes:
+            raise WorkerUnavailableError('{} has no available node'.format(self.model_name))
+        return min(nodes, key=lambda k: (self.node_outstanding.get(k, 0) + 1) / self._workers(nodes[k]))
+
+    def put(self, data, worker_idx=None):
+        data = dict(data, model=self.model_name)
+        decoder = ResultDecoder(data, safe=True)
+        payload = encode_request(data, safe=True)
+        gateway = self.gateway
+        with gateway.lock:
+            node_id = worker_idx if worker_idx in self._ready_nodes() else self._select()
+            request_id = str(next(gateway.request_ids)).encode('utf-8')
+            gateway.inflight[request_id] = _RemoteInflight(request_id, self, node_id, payload, decoder)
+            self.node_outstanding[node_id] = self.node_outstanding.get(node_id, 0) + 1
+            identity = gateway.nodes[node_id].identity
+        gateway.send_request(identity, request_id, payload)
+        return request_id
+
+    def get(self, request_id, request_seq_id=None, timeout=None, cancelled=None):
+        inflight = self.gateway.inflight.get(request_id, None)
+        if inflight is None:
+            return {"code": -1, "msg": "request {} not found".format(request_id), "complete": True}
+        deadline = time.time() + (timeout or self.gateway.ipc_timeout)
+        while True:
+            remaining = max(deadline - time.time(), 0.001)
+            last = cancelled is None or remaining <= CANCEL_CHECK_INTERVAL
+            try:
+                ret = inflight.queue.get(timeout=remaining if last else CANCEL_CHECK_INTERVAL)
+                break
+            except queue.Empty:
+                if last:
+                    ret = {"code": -1, "msg": "{} wait result timeout".format(self.model_name), "complete": True}
+                    break
+            # 还没有收到结果时放弃 , node 上的结果到达后丢弃
+            if cancelled() and inflight.frames == 0:
+                self.gateway.finish(request_id)
+                raise RequestCancelledError('request {} cancelled'.format(request_id))
+        if ret["complete"]:
+            self.gateway.finish(request_id)
+        return ret
+
+    def outstanding(self):
+        with self.gateway.lock:
+            return sum(self.node_outstanding.values())
+
+    def rolling_restart(self, timeout=None):
+        logger.warning('{} is served by remote nodes , rolling restart on nodes'.format(self.model_name))
+        return False
+
+    def terminate(self):
+        pass
+
+    def get_state(self):
+        with self.gateway.lock:
+            nodes = {}
+            for node in self.gateway.nodes.values():
+                info = node.models.get(self.model_name, None)
+                if info is None:
+                    continue
+                nodes[node.node_id] = dict(info, alive=node.alive,
+                                           dispatched=self.node_outstanding.get(node.node_id, 0))
+            return {
+                "ready": len(self._ready_nodes()) > 0,
+                "remote": True,
+                "affinity_hits": self.affinity_hits,
+                "affinity_fallbacks": self.affinity_fallbacks,
+                "nodes": nodes,
+            }
+
+
+class Gateway:
+    '''
+        网关 , 在 tcp 地址上接收 node 连接 , node 的心跳即注册 , 上报各模型的 worker 数和就绪状态
+        心跳超时的 node 不再接收请求 , 其在途请求还没收到结果的发往其他 node 重试 , 否则返回失败
+        新出现的模型通过 on_model(model_name, RemoteGroup) 通知调用方
+        所有帧用 secret 签名 , 先验证再解码 , 签名不对的心跳和结果丢弃 ; 绑定非本机地址时必须设置 secret
+    '''
+    def __init__(self, bind_addr, heartbeat_timeout=10, max_retries=1, ipc_timeout=600,
+                 load_factor=1.25, virtual_nodes=160, on_model=None, secret=None):
+        assert secret or _is_loopback(bind_addr), ValueError(
+            'gateway bind {} is not loopback , secret is required'.format(bind_addr))
+        self.bind_addr = bind_addr
+        self.secret = secret
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_retries = max_retries
+        self.ipc_timeout = ipc_timeout
+        self.load_factor = load_factor
+        self.virtual_nodes = virtual_nodes
+        self.on_model = on_model
+        self.lock = threading.Lock()
+        # node_id -> RemoteNode
+        self.nodes = {}
+        # model_name -> RemoteGroup
+        self.groups = {}
+        # request_id -> _RemoteInflight
+        self.inflight = {}
+        self.request_ids = itertools.count(1)
+        self.context = None
+        self.socket = None
+        self.channel = None
+        self._threads = []
+        self._stop = threading.Event()
+
+    def start(self):
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        # node 不可达时发送报错 , node 重连后接管原来的 identity ; 接管者没有 secret 时发出的帧验证不通过
+        self.socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        self.socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(self.bind_addr)
+        self.channel = _Channel(self.context, 'gateway_{}'.format(id(self)))
+        logger.info('gateway bind {}'.format(self.bind_addr))
+        for target in [self._io_loop, self._monitor_loop]:
+            t = threading.Thread(target=target, daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        self._stop.set()
+        for t in self._threads:
+            t.join(5)
+        self._threads = []
+        if self.context is not None:
+            self.context.destroy(linger=0)
+            self.context = None
+
+    def send(self, frames):
+        self.channel.send(frames)
+
+    def send_request(self, identity, request_id, payload):
+        # 签名绑定接收的 node , 重试发往其他 node 时重新签名
+        self.send([identity, _MSG_REQUEST, request_id, payload,
+                   _sign(self.secret, identity, _MSG_REQUEST, request_id, payload)])
+
+    def get_state(self):
+        with self.lock:
+            return {
+                "bind": self.bind_addr,
+                "inflight": len(self.inflight),
+                "nodes": {k: v.to_dict() for k, v in self.nodes.items()},
+            }
+
+    def _io_loop(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.channel.pull, zmq.POLLIN)
+        while not self._stop.is_set():
+            events = dict(poller.poll(100))
+            if self.channel.pull in events:
+                for frames in _recv_all(self.channel.pull):
+                    try:
+                        self.socket.send_multipart(frames)
+                    except zmq.ZMQError as e:
+                        self._on_send_error(frames[0], e)
+            if self.socket in events:
+                for frames in _recv_all(self.socket):
+                    try:
+                        if frames[1] == _MSG_RESULT:
+                            self._on_result(frames[0], frames[2], frames[3], frames[4] if len(frames) > 4 else b'')
+                        elif frames[1] == _MSG_HEARTBEAT:
+                            self._on_heartbeat(frames[0], frames[2], frames[3] if len(frames) > 3 else b'')
+                    except Exception as e:  # noqa
+                        logger.error('gateway handle message error {}'.format(e))
+
+    def _on_heartbeat(self, identity, payload, signature):
+        if not _verify(self.secret, signature, identity, _MSG_HEARTBEAT, payload):
+            logger.warning('gateway reject heartbeat with bad signature')
+            return
+        info = json.loads(payload)
+        node_id = info["node_id"]
+        seq = info.get("seq", 0)
+        new_groups = []
+        with self.lock:
+            node = self.nodes.get(node_id, None)
+            if node is not None and node.identity == identity and seq <= node.seq:
+                logger.warning('gateway reject replayed heartbeat of node {}'.format(node_id))
+                return
+            if node is None or node.identity != identity:
+                node = self.nodes[node_id] = RemoteNode(node_id, identity)
+                logger.info('gateway node {} registered , models {}'.format(node_id, ','.join(info["models"])))
+            elif not node.alive:
+                node.alive = True
+                logger.info('gateway node {} back online'.format(node_id))
+            node.heartbeat_time = time.time()
+            node.seq = seq
+            node.models = info["models"]
+            for model_name in info["models"]:
+                if model_name not in self.groups:
+                    group = self.groups[model_name] = RemoteGroup(self, model_name)
+                    new_groups.append(group)
+        for group in new_groups:
+            if self.on_model is not None:
+                self.on_model(group.model_name, group)
+
+    def _on_result(self, identity, request_id, frame, signature):
+        if not _verify(self.secret, signature, identity, _MSG_RESULT, request_id, frame):
+            logger.warning('gateway reject result with bad signature')
+            return
+        with self.lock:
+            inflight = self.inflight.get(request_id, None)
+            if inflight is None:
+                # 已超时放弃
+                return
+            node = self.nodes.get(inflight.node_id, None)
+            if node is None or node.identity != identity:
+                # 重试前的旧 node 迟到的结果
+                return
+            inflight.frames += 1
+        inflight.queue.put(inflight.decoder.decode(frame))
+
+    def _on_send_error(self, identity, e):
+        logger.error('gateway send to {} error {}'.format(identity, e))
+        with self.lock:
+            for node in self.nodes.values():
+                if node.identity == identity:
+                    # 交给 monitor 按故障处理
+                    node.heartbeat_time = 0
+
+    def finish(self, request_id):
+        with self.lock:
+            inflight = self.inflight.pop(request_id, None)
+            if inflight is None:
+                return
+            group = inflight.group
+            group.node_outstanding[inflight.node_id] = group.node_outstanding.get(inflight.node_id, 1) - 1
+
+    def _monitor_loop(self):
+        while not self._stop.wait(1):
+            now = time.time()
+            lost = []
+            with self.lock:
+                for node in self.nodes.values():
+                    if node.alive and now - node.heartbeat_time > self.heartbeat_timeout:
+                        node.alive = False
+                        lost.append(node.node_id)
+            for node_id in lost:
+                logger.error('gateway node {} heartbeat timeout'.format(node_id))
+                self._recover(node_id)
+
+    def _recover(self, node_id):
+        '''
+            故障 node 的在途请求 , 还没有收到结果的发往其他 node 重试 , 否则返回失败
+        '''
+        retry = []
+        with self.lock:
+            for request_id, inflight in self.inflight.items():
+                if inflight.node_id != node_id:
+                    continue
+                group = inflight.group
+                target = None
+                if inflight.frames == 0 and inflight.retries < self.max_retries:
+                    try:
+                        target = group._select(exclude=node_id)
+                    except WorkerUnavailableError:
+                        target = None
+                if target is None:
+                    inflight.queue.put({"code": -1, "msg": "node {} lost".format(node_id), "complete": True})
+                    continue
+                group.node_outstanding[node_id] = group.node_outstanding.get(node_id, 1) - 1
+                group.node_outstanding[target] = group.node_outstanding.get(target, 0) + 1
+                inflight.node_id = target
+                inflight.retries += 1
+                retry.append((self.nodes[target].identity, inflight))
+        for identity, inflight in retry:
+            logger.info('gateway retry request {} on node {}'.format(inflight.request_id, inflight.node_id))
+            self.send_request(identity, inflight.request_id, inflight.data)
+
+
+class NodeAgent:
+    '''
+        工作节点 , 连接网关并定时发送心跳 ( 本机各模型 worker 数 就绪状态 ) , 执行网关转发的请求 , 结果逐帧返回
+        handler(model_name, r) 返回结果迭代器 , 最后一帧 complete 为 True ; 网关重启或网络中断后 zmq 自动重连 , 心跳即重新注册
+        secret 与网关相同 , 心跳和结果帧签名 , 请求帧先验证签名再解码 ; 网关不是本机地址时必须设置
+    '''
+    def __init__(self, gateway_addr, node_id, handler: typing.Callable, get_models: typing.Callable,
+                 heartbeat_interval=1.0, max_concurrency=256, secret=None):
+        assert secret or _is_loopback(gateway_addr), ValueError(
+            'gateway {} is not loopback , secret is required'.format(gateway_addr))
+        self.gateway_addr = gateway_addr
+        self.node_id = node_id
+        self.secret = secret
+        # 连接 identity , 每次启动随机生成 , 他人无法猜测后接管连接
+        self.identity = '{}#{}'.format(node_id, os.urandom(8).hex()).encode('utf-8')
+        self._seq = 0
+        self.handler = handler
+        self.get_models = get_models
+        self.heartbeat_interval = heartbeat_interval
+        self.max_concurrency = max_concurrency
+        self.context = None
+        self.socket = None
+        self.channel = None
+        self.executor = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.IDENTITY, self.identity)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(self.gateway_addr)
+        self.channel = _Channel(self.context, 'node_{}'.format(id(self)))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        logger.info('node {} connect gateway {}'.format(self.node_id, self.gateway_addr))
+        self._thread = threading.Thread(target=self._io_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        if self.context is not None:
+            self.context.destroy(linger=0)
+            self.context = None
+
+    def _heartbeat(self):
+        try:
+            models = self.get_models()
+        except Exception as e:  # noqa
+            logger.error('node get models error {}'.format(e))
+            return
+        self._seq += 1
+        info = {"node_id": self.node_id, "models": models, "time": time.time(), "seq": self._seq}
+        payload = json.dumps(info).encode('utf-8')
+        self.socket.send_multipart([_MSG_HEARTBEAT, payload, _sign(self.secret, self.identity, _MSG_HEARTBEAT, payload)])
+
+    def _io_loop(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.channel.pull, zmq.POLLIN)
+        next_heartbeat = 0
+        while not self._stop.is_set():
+            if time.time() >= next_heartbeat:
+                self._heartbeat()
+                next_heartbeat = time.time() + self.heartbeat_interval
+            events = dict(poller.poll(min(100, int(self.heartbeat_interval * 1000))))
+            if self.channel.pull in events:
+                for frames in _recv_all(self.channel.pull):
+                    self.socket.send_multipart(frames)
+            if self.socket in events:
+                for frames in _recv_all(self.socket):
+                    if frames[0] != _MSG_REQUEST or len(frames) < 3:
+                        continue
+                    if not _verify(self.secret, frames[3] if len(frames) > 3 else b'', self.identity,
+                                   _MSG_REQUEST, frames[1], frames[2]):
+                        logger.warning('node {} reject request with bad signature'.format(self.node_id))
+                        continue
+                    self.executor.submit(self._handle, frames[1], frames[2])
+
+    def _send_result(self, request_id, frame):
+        self.channel.send([_MSG_RESULT, request_id, frame, _sign(self.secret, self.identity, _MSG_RESULT, request_id, frame)])
+
+    def _handle(self, request_id, data):
+        encoder = ResultEncoder('generate', safe=True)
+        try:
+            r = decode_request(data, safe=True)
+            encoder = ResultEncoder(r.get('method', 'generate'), safe=True)
+            for ret in self.handler(r["model"], r):
+                self._send_result(request_id, encoder.encode(ret))
+                if ret.get("complete", True):
+                    return
+        except Exception as e:  # noqa
+            logger.error('node handle request error {}'.format(e))
+            self._send_result(request_id, encoder.encode({"code": -1, "msg": str(e), "complete": True}))
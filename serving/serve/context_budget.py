@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/11 10:30
+import math
+import typing
+from serving.utils.token_count import estimate_token_num
+
+__all__ = [
+    'ContextBudgetError',
+    'estimate_token_num',
+    'ContextBudget',
+]
+
+
+class ContextBudgetError(Exception):
+    pass
+
+
+class ContextBudget:
+    '''
+        入队前按上下文长度裁剪历史
+        policy:
+            drop_oldest 丢弃最早的轮次
+            trim_oldest 截断最早的轮次 , 保留尾部
+            reject 超出直接拒绝
+        system 前缀始终保留 , 当前 query 放不下直接拒绝
+        counter 为准确计数 ( 如前端分词进程池 ) , batch_counter 一次计数多个文本 , 减少进程间往返
+        没有 counter 时按字符估算 , 结果乘以 (1 + safety_margin) , 避免低估超出上下文长度
+    '''
+    def __init__(self,
+                 max_context_length: int,
+                 policy='drop_oldest',
+                 turn_overhead=8,
+                 counter: typing.Optional[typing.Callable[[str], int]] = None,
+                 batch_counter: typing.Optional[typing.Callable[[typing.List[str]], typing.List[int]]] = None,
+                 safety_margin=0.0):
+        assert policy in ['drop_oldest', 'trim_oldest', 'reject'], ValueError('policy one of drop_oldest,trim_oldest,reject')
+        self.max_context_length = max_context_length
+        self.policy = policy
+        # 每轮对话模板的额外 token
+        self.turn_overhead = turn_overhead
+        self.safety_margin = safety_margin
+        self.counter = counter or self._estimate
+        self.batch_counter = batch_counter
+
+    def _estimate(self, text):
+        return int(math.ceil(estimate_token_num(text) * (1 + self.safety_margin)))
+
+    def _prefetch(self, texts: typing.List[str]) -> typing.Callable[[str], int]:
+        '''
+            批量计数 , 返回先查缓存的计数函数
+        '''
+        if self.batch_counter is None:
+            return self.counter
+        texts = list(dict.fromkeys(_ for _ in texts if _))
+        cache = dict(zip(texts, self.batch_counter(texts))) if texts else {}
+        return lambda text: cache[text] if text in cache else (self.counter(text) if text else 0)
+
+    def count_turn(self, turn: typing.Dict, counter=None):
+        counter = counter or self.counter
+        return counter(turn["q"]) + counter(turn["a"]) + self.turn_overhead
+
+    def _trim_tail(self, text, max_tokens):
+        # 二分查找能保留的最长尾部
+        lo, hi = 0, len(text)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.counter(text[-mid:]) <= max_tokens:
+                lo = mid
+            else:
+                hi = mid - 1
+        return text[len(text) - lo:] if lo > 0 else ''
+
+    def _trim_turn(self, turn, max_tokens, counter):
+        max_tokens -= self.turn_overhead
+        q_num = counter(turn["q"])
+        if q_num >= max_tokens:
+            # 问题都放不下 , 整轮丢弃
+            return None
+        return {"q": turn["q"], "a": self._trim_tail(turn["a"], max_tokens - q_num)}
+
+    def fit(self, query: str, history: typing.List[typing.Dict], max_new_tokens=0, prefix=""):
+        '''
+            返回 (query, history, dropped) , prefix 为已拼接在第一轮 q 或 query 上的 system 前缀
+        '''
+        history = list(history or [])
+        # 拆出 system 前缀 , 裁剪后重新拼接到第一轮
+        if prefix:
+            if history and history[0]["q"].startswith(prefix):
+                history[0] = dict(history[0], q=history[0]["q"][len(prefix):])
+            elif query.startswith(prefix) and not history:
+                query = query[len(prefix):]
+            else:
+                prefix = ""
+
+        counter = self._prefetch([prefix, query] + [_[k] for _ in history for k in ['q', 'a']])
+        budget = self.max_context_length - (max_new_tokens or 0) - counter(prefix)
+        query_num = counter(query) + self.turn_overhead
+        if query_num > budget:
+            raise ContextBudgetError('prompt has about {} tokens , with max_tokens {} exceeds context length {}'.format(
+                query_num + counter(prefix), max_new_tokens or 0, self.max_context_length))
+        budget -= query_num
+
+        turn_nums = [self.count_turn(_, counter) for _ in history]
+        total = sum(turn_nums)
+        dropped = 0
+        if total > budget:
+            if self.policy == 'reject':
+                raise ContextBudgetError('history has about {} tokens , exceeds remaining context {}'.format(total, budget))
+            while history and total > budget:
+                if self.policy == 'trim_oldest':
+                    turn = self._trim_turn(history[0], turn_nums[0] - (total - budget), counter)
+                    if turn is not None:
+                        history[0] = turn
+                        num = self.count_turn(turn, counter)
+                        total = total - turn_nums[0] + num
+                        turn_nums[0] = num
+                        continue
+                history.pop(0)
+                total -= turn_nums.pop(0)
+                dropped += 1
+
+        if prefix:
+            if history:
+                history[0] = dict(history[0], q=prefix + history[0]["q"])
+            else:
+                query = prefix + query
+        return query, history, dropped
+
+    def check_texts(self, texts: typing.List[str], max_new_tokens=0):
+        counter = self._prefetch(texts)
+        for text in texts:
+            num = counter(text)
+            if num + (max_new_tokens or 0) > self.max_context_length:
+                raise ContextBudgetError('prompt has about {} tokens , with max_tokens {} exceeds context length {}'.format(
+                    num, max_new_tokens or 0, self.max_context_length))
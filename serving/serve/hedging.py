@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/13 21:40
+import threading
+import typing
+from collections import deque
+
+__all__ = [
+    'Hedger',
+]
+
+
+class Hedger:
+    '''
+        请求对冲策略 , 按模型记录近期短请求的延迟 , 对冲等待时间取其 percentile 分位数
+        全局预算 , 每个请求累积 budget_ratio 次对冲额度 , 最多 budget_burst 次 , 各模型共用
+    '''
+    def __init__(self, max_new_tokens=128, percentile=0.95, min_delay=0.05, window=500, min_samples=50,
+                 budget_ratio=0.05, budget_burst=10, **kwargs):
+        assert 0 < percentile < 1, ValueError('hedge percentile must in (0,1)')
+        self.max_new_tokens = max_new_tokens
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.window = window
+        self.min_samples = min_samples
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self.budget = 0.0
+        self._lock = threading.Lock()
+        # model_name -> 近期延迟
+        self._latencies = {}
+        # model_name -> [请求数 , 对冲数 , 副本先完成数 , 预算不足次数]
+        self._stats = {}
+
+    def eligible(self, r: typing.Dict):
+        if r.get('method', None) not in ['chat', 'generate']:
+            return False
+        params = r.get('params', None) or {}
+        max_new_tokens = params.get('max_new_tokens', None)
+        return max_new_tokens is not None and max_new_tokens <= self.max_new_tokens
+
+    def delay(self, model_name):
+        '''
+            对冲前等待的秒数 , 样本不足时返回 None , 不对冲
+        '''
+        with self._lock:
+            latencies = self._latencies.get(model_name, None)
+            if latencies is None or len(latencies) < self.min_samples:
+                return None
+            values = sorted(latencies)
+        return max(self.min_delay, values[min(len(values) - 1, int(len(values) * self.percentile))])
+
+    def observe(self, model_name, latency):
+        with self._lock:
+            latencies = self._latencies.get(model_name, None)
+            if latencies is None:
+                latencies = self._latencies[model_name] = deque(maxlen=self.window)
+            latencies.append(latency)
+            self._get_stats(model_name)[0] += 1
+            self.budget = min(self.budget_burst, self.budget + self.budget_ratio)
+
+    def acquire(self, model_name=None):
+        with self._lock:
+            if self.budget < 1:
+                if model_name is not None:
+                    self._get_stats(model_name)[3] += 1
+                return False
+            self.budget -= 1
+            return True
+
+    def record(self, model_name, hedged, won):
+        if not hedged:
+            return
+        with self._lock:
+            stats = self._get_stats(model_name)
+            stats[1] += 1
+            if won:
+                stats[2] += 1
+
+    def _get_stats(self, model_name):
+        stats = self._stats.get(model_name, None)
+        if stats is None:
+            stats = self._stats[model_name] = [0, 0, 0, 0]
+        return stats
+
+    def get_state(self):
+        models = {}
+        for model_name in list(self._stats):
+            delay = self.delay(model_name)
+            with self._lock:
+                requests, hedged, wins, no_budget = self._stats[model_name]
+            models[model_name] = {
+                "requests": requests,
+                "hedged": hedged,
+                "hedge_wins": wins,
+                "no_budget": no_budget,
+                "delay": delay,
+            }
+        with self._lock:
+            budget = self.budget
+        return {"budget": budget, "budget_ratio": self.budget_ratio, "models": models}
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/7 10:12
+import threading
+import time
+import typing
+from collections import deque
+
+__all__ = [
+    'SchedulerFullError',
+    'SchedulerRejectedError',
+    'SchedulerCancelledError',
+    'SchedTicket',
+    'FairScheduler',
+]
+
+
+class SchedulerFullError(Exception):
+    pass
+
+
+class SchedulerRejectedError(Exception):
+    pass
+
+
+class SchedulerCancelledError(Exception):
+    pass
+
+
+# 秒 , 排队时检查 cancelled 的间隔
+_CANCEL_CHECK_INTERVAL = 1.0
+
+
+class SchedTicket:
+    def __init__(self, tenant, priority, cost, start_tag, finish_tag):
+        self.tenant = tenant
+        self.priority = priority
+        self.cost = cost
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.enqueue_time = time.time()
+        self.dispatch_time = None
+        self.event = threading.Event()
+        self.released = False
+        # 排队中被拒绝的原因 , 如模型熔断
+        self.rejected = None
+
+    @property
+    def wait_time(self):
+        end_time = self.dispatch_time or time.time()
+        return end_time - self.enqueue_time
+
+
+class _PriorityClass:
+    def __init__(self, name):
+        self.name = name
+        self.virtual_time = 0.0
+        # tenant -> deque[SchedTicket]
+        self.tenant_queues: typing.Dict[str, deque] = {}
+        # tenant -> last finish tag
+        self.tenant_finish: typing.Dict[str, float] = {}
+        self.size = 0
+        self.dispatched = 0
+
+    def push(self, tenant, weight, cost, priority):
+        start_tag = max(self.virtual_time, self.tenant_finish.get(tenant, 0.0))
+        finish_tag = start_tag + cost / weight
+        self.tenant_finish[tenant] = finish_tag
+        ticket = SchedTicket(tenant, priority, cost, start_tag, finish_tag)
+        self.tenant_queues.setdefault(tenant, deque()).append(ticket)
+        self.size += 1
+        return ticket
+
+    def oldest(self) -> typing.Optional[SchedTicket]:
+        heads = [q[0] for q in self.tenant_queues.values() if len(q)]
+        if not heads:
+            return None
+        return min(heads, key=lambda t: t.enqueue_time)
+
+    def next(self) -> typing.Optional[SchedTicket]:
+        heads = [q[0] for q in self.tenant_queues.values() if len(q)]
+        if not heads:
+            return None
+        return min(heads, key=lambda t: (t.finish_tag, t.enqueue_time))
+
+    def pop(self, ticket: SchedTicket, dispatched=True):
+        q = self.tenant_queues[ticket.tenant]
+        q.remove(ticket)
+        if len(q) == 0:
+            self.tenant_queues.pop(ticket.tenant)
+        self.size -= 1
+        if dispatched:
+            self.dispatched += 1
+        self.virtual_time = max(self.virtual_time, ticket.start_tag)
+        if self.size == 0:
+            # 队列清空 , 重置虚拟时间 , 避免空闲租户积累额度
+            self.virtual_time = 0.0
+            self.tenant_finish.clear()
+
+
+class FairScheduler:
+    '''
+        每个模型一个调度器 , 位于 worker 队列之前
+        不同优先级之间严格按优先级下发 , 同一优先级内按 api key 加权公平排队 (WFQ)
+        等待超过 starvation_timeout 的请求优先下发 , 防止低优先级饿死
+    '''
+    def __init__(self,
+                 max_inflight: int,
+                 priority_classes=('interactive', 'standard', 'batch'),
+                 default_priority='standard',
+                 tenant_weights: typing.Optional[typing.Dict[str, float]] = None,
+                 starvation_timeout: float = 30,
+                 max_queue_size: int = 1024):
+        assert max_inflight > 0, ValueError('max_inflight must > 0')
+        assert default_priority in priority_classes, ValueError('default_priority not in priority_classes')
+        self.max_inflight = max_inflight
+        self.priority_classes = list(priority_classes)
+        self.default_priority = default_priority
+        self.tenant_weights = tenant_weights or {}
+        self.starvation_timeout = starvation_timeout
+        self.max_queue_size = max_queue_size
+
+        self._classes = {name: _PriorityClass(name) for name in self.priority_classes}
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._queued = 0
+        self._starvation_dispatched = 0
+        # 累计下发数和排队总秒数 , 用于按区间计算平均排队时间
+        self._admitted = 0
+        self._wait_sum = 0.0
+
+    @property
+    def inflight(self):
+        return self._inflight
+
+    @property
+    def queued(self):
+        return self._queued
+
+    def acquire(self, tenant: str, priority: typing.Optional[str] = None, cost: float = 1.0,
+                timeout: typing.Optional[float] = None,
+                cancelled: typing.Optional[typing.Callable[[], bool]] = None) -> SchedTicket:
+        '''
+            排队等待下发 , 超时抛出 TimeoutError , cancelled() 为 True ( 如客户端已离开 ) 时出队并抛出 SchedulerCancelledError
+        '''
+        if priority is None:
+            priority = self.default_priority
+        if priority not in self._classes:
+            raise ValueError('priority {} not in {}'.format(priority, ','.join(self.priority_classes)))
+        weight = float(self.tenant_weights.get(tenant, 1.0))
+        with self._lock:
+            if self._queued >= self.max_queue_size:
+                raise SchedulerFullError('scheduler queue is full , max_queue_size {}'.format(self.max_queue_size))
+            ticket = self._classes[priority].push(tenant, max(weight, 1e-6), max(float(cost), 1.0), priority)
+            self._queued += 1
+            self._dispatch_locked()
+
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            wait = max(deadline - time.time(), 0) if deadline is not None else None
+            if cancelled is not None:
+                wait = min(wait, _CANCEL_CHECK_INTERVAL) if wait is not None else _CANCEL_CHECK_INTERVAL
+            if ticket.event.wait(wait):
+                break
+            expired = deadline is not None and time.time() >= deadline
+            if not expired and not (cancelled is not None and cancelled()):
+                continue
+            with self._lock:
+                if not ticket.event.is_set():
+                    self._classes[priority].pop(ticket, dispatched=False)
+                    self._queued -= 1
+                    if expired:
+                        raise TimeoutError('wait for schedule timeout')
+                    raise SchedulerCancelledError('cancelled while queued')
+            break
+        if ticket.rejected is not None:
+            raise SchedulerRejectedError(ticket.rejected)
+        return ticket
+
+    def release(self, ticket: SchedTicket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self._inflight -= 1
+            self._dispatch_locked()
+
+    def set_max_inflight(self, max_inflight: int):
+        '''
+            worker 数变化时调整并发上限 , 已下发的请求不受影响
+        '''
+        assert max_inflight > 0, ValueError('max_inflight must > 0')
+        with self._lock:
+            self.max_inflight = max_inflight
+            self._dispatch_locked()
+
+    def reject_queued(self, reason):
+        '''
+            拒绝所有排队中的请求 , 如模型熔断 , 等待的线程抛出 SchedulerRejectedError , 返回拒绝数
+        '''
+        with self._lock:
+            tickets = [t for c in self._classes.values() for q in c.tenant_queues.values() for t in q]
+            for ticket in tickets:
+                self._classes[ticket.priority].pop(ticket, dispatched=False)
+                self._queued -= 1
+                ticket.rejected = reason
+                ticket.event.set()
+        return len(tickets)
+
+    def _select_locked(self) -> typing.Optional[SchedTicket]:
+        now = time.time()
+        starved = None
+        for name in self.priority_classes:
+            oldest = self._classes[name].oldest()
+            if oldest is not None and now - oldest.enqueue_time >= self.starvation_timeout:
+                if starved is None or oldest.enqueue_time < starved.enqueue_time:
+                    starved = oldest
+        if starved is not None:
+            self._starvation_dispatched += 1
+            return starved
+
+        for name in self.priority_classes:
+            ticket = self._classes[name].next()
+            if ticket is not None:
+                return ticket
+        return None
+
+    def _dispatch_locked(self):
+        while self._inflight < self.max_inflight and self._queued > 0:
+            ticket = self._select_locked()
+            if ticket is None:
+                break
+            self._classes[ticket.priority].pop(ticket)
+            self._queued -= 1
+            self._inflight += 1
+            ticket.dispatch_time = time.time()
+            self._admitted += 1
+            self._wait_sum += ticket.dispatch_time - ticket.enqueue_time
+            ticket.event.set()
+
+    def get_state(self):
+        now = time.time()
+        with self._lock:
+            classes = {}
+            for name in self.priority_classes:
+                c = self._classes[name]
+                oldest = c.oldest()
+                classes[name] = {
+                    "queued": c.size,
+                    "dispatched": c.dispatched,
+                    "virtual_time": c.virtual_time,
+                    "oldest_wait": (now - oldest.enqueue_time) if oldest is not None else 0,
+                    "tenants": {tenant: len(q) for tenant, q in c.tenant_queues.items()},
+                }
+            return {
+                "inflight": self._inflight,
+                "max_inflight": self.max_inflight,
+                "queued": self._queued,
+                "max_queue_size": self.max_queue_size,
+                "starvation_timeout": self.starvation_timeout,
+                "starvation_dispatched": self._starvation_dispatched,
+                "admitted": self._admitted,
+                "wait_sum": self._wait_sum,
+                "classes": classes,
+            }
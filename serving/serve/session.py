@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/10 11:05
+import threading
+import time
+import typing
+import uuid
+from collections import OrderedDict
+
+__all__ = [
+    'Session',
+    'SessionStore',
+    'SessionError',
+]
+
+
+class SessionError(Exception):
+    pass
+
+
+class Session:
+    def __init__(self, conversation_id, model, history=None, owner=None):
+        self.conversation_id = conversation_id
+        self.model = model
+        # 创建会话的租户 , 其他租户不能读取和续写
+        self.owner = owner
+        # [{"q": ..., "a": ...}]
+        self.history: typing.List[typing.Dict] = list(history or [])
+        self.created = time.time()
+        self.updated = self.created
+
+    def get_history(self):
+        return list(self.history)
+
+    def to_dict(self):
+        return {
+            "conversation_id": self.conversation_id,
+            "model": self.model,
+            "turns": len(self.history),
+            "created": self.created,
+            "updated": self.updated,
+        }
+
+
+class SessionStore:
+    '''
+        服务端会话 , LRU + TTL , 客户端只需要发送 conversation_id 和本轮消息
+        只保存文本 , 不缓存每轮的 token id : 分词器对拼接后的 prompt 分词与各轮分别分词再拼接的结果不一致
+        ( sentencepiece 的前缀空格 , 跨轮边界的 bpe 合并 , chatglm2 裁剪历史后轮次编号变化 ) , token id 模式下整段 prompt 仍在分词进程池中分词
+    '''
+    def __init__(self, max_sessions=10000, ttl=3600, max_turns=64):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self._sessions: typing.Dict[str, Session] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _expired(self, session: Session, now):
+        return self.ttl is not None and now - session.updated > self.ttl
+
+    def _evict_locked(self, now):
+        # OrderedDict 头部是最久未使用的
+        while self._sessions:
+            conversation_id, session = next(iter(self._sessions.items()))
+            if len(self._sessions) > self.max_sessions or self._expired(session, now):
+                self._sessions.pop(conversation_id)
+            else:
+                break
+
+    def get(self, conversation_id) -> typing.Optional[Session]:
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(conversation_id, None)
+            if session is None:
+                return None
+            if self._expired(session, now):
+                self._sessions.pop(conversation_id)
+                return None
+            self._sessions.move_to_end(conversation_id)
+            return session
+
+    def get_or_create(self, conversation_id, model, history=None, owner=None) -> Session:
+        '''
+            conversation_id 为空则生成新的 id , 不存在或已过期则用客户端传入的 history 新建
+            会话属于其他租户 , 其他模型 , 或已有会话时客户端又传入 history ( 两份历史会重复拼接 ) 抛出 SessionError
+        '''
+        if conversation_id:
+            session = self.get(conversation_id)
+            if session is not None:
+                if session.owner != owner:
+                    raise SessionError('conversation {} belongs to another user'.format(conversation_id))
+                if session.model != model:
+                    raise SessionError('conversation {} belongs to model {}'.format(conversation_id, session.model))
+                if history:
+                    raise SessionError('conversation {} already has history , send only the new message'.format(conversation_id))
+                return session
+        else:
+            conversation_id = 'conv-{}'.format(uuid.uuid4())
+        session = Session(conversation_id, model, history=history, owner=owner)
+        now = time.time()
+        with self._lock:
+            self._sessions[conversation_id] = session
+            self._sessions.move_to_end(conversation_id)
+            self._evict_locked(now)
+        return session
+
+    def append(self, session: Session, query, response):
+        with self._lock:
+            session.history.append({"q": query, "a": response})
+            if self.max_turns is not None and len(session.history) > self.max_turns:
+                session.history = session.history[-self.max_turns:]
+            session.updated = time.time()
+
+    def get_owned(self, conversation_id, owner) -> typing.Optional[Session]:
+        # 其他租户的会话按不存在处理
+        session = self.get(conversation_id)
+        if session is None or session.owner != owner:
+            return None
+        return session
+
+    def delete(self, conversation_id, owner=None):
+        with self._lock:
+            session = self._sessions.get(conversation_id, None)
+            if session is None or session.owner != owner:
+                return False
+            self._sessions.pop(conversation_id)
+            return True
+
+    def get_state(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "ttl": self.ttl,
+                "max_turns": self.max_turns,
+            }
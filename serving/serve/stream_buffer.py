@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/10 15:20
+import itertools
+import threading
+import time
+import typing
+import uuid
+from collections import deque
+
+__all__ = [
+    'StreamBuffer',
+    'StreamBufferStore',
+    'parse_event_id',
+]
+
+
+def parse_event_id(event_id: typing.Optional[str]):
+    '''
+        Last-Event-ID 格式 {stream_id}:{seq}
+    '''
+    if not event_id or ':' not in event_id:
+        return None, None
+    stream_id, seq = event_id.rsplit(':', 1)
+    try:
+        return stream_id, int(seq)
+    except ValueError:
+        return None, None
+
+
+class StreamBuffer:
+    '''
+        单个流式请求已发出的事件 , 连接断开后生成继续 , 客户端可按 Last-Event-ID 续传
+    '''
+    def __init__(self, stream_id, max_events=4096, owner=None):
+        self.stream_id = stream_id
+        # 创建者 , 只有同一 owner 可以续传
+        self.owner = owner
+        self.events = deque(maxlen=max_events)
+        # 下一个事件序号 , 序号从 0 开始
+        self.next_seq = 0
+        self.complete = False
+        self.complete_time = None
+        self.readers = 0
+        self.last_access = time.time()
+        self._cond = threading.Condition()
+
+    def event_id(self, seq):
+        return '{}:{}'.format(self.stream_id, seq)
+
+    def append(self, data):
+        with self._cond:
+            self.events.append((self.next_seq, data))
+            self.next_seq += 1
+            self._cond.notify_all()
+
+    def finish(self):
+        with self._cond:
+            self.complete = True
+            self.complete_time = time.time()
+            self._cond.notify_all()
+
+    def attach(self):
+        with self._cond:
+            self.readers += 1
+            self.last_access = time.time()
+
+    def detach(self):
+        with self._cond:
+            self.readers -= 1
+            self.last_access = time.time()
+
+    def first_seq(self):
+        with self._cond:
+            return self.events[0][0] if self.events else self.next_seq
+
+    def read(self, start_seq, timeout=1.0):
+        '''
+            返回 start_seq 之后的事件 , 没有新事件时最多等待 timeout
+        '''
+        with self._cond:
+            if start_seq >= self.next_seq and not self.complete:
+                self._cond.wait(timeout)
+            self.last_access = time.time()
+            # 序号连续 , 按偏移切片 , 不扫描已读的事件
+            offset = start_seq - self.events[0][0] if self.events else 0
+            events = list(itertools.islice(self.events, max(offset, 0), None))
+            return events, self.complete and (not events or events[-1][0] == self.next_seq - 1)
+
+    def abandoned(self, grace_period):
+        # 没有客户端连接超过 grace_period , 不再继续生成
+        with self._cond:
+            return self.readers == 0 and time.time() - self.last_access > grace_period
+
+    def expired(self, grace_period, now):
+        with self._cond:
+            if self.readers > 0:
+                return False
+            if self.complete:
+                return now - max(self.complete_time, self.last_access) > grace_period
+            return False
+
+
+class StreamBufferStore:
+    '''
+        max_producers: 同时在后台生成的流数上限 , 每个占用一个线程 , 超出时由调用方按普通流式请求处理
+    '''
+    def __init__(self, max_events=4096, grace_period=60, max_streams=10000, max_producers=256):
+        self.max_events = max_events
+        self.grace_period = grace_period
+        self.max_streams = max_streams
+        self.max_producers = max_producers
+        self._buffers: typing.Dict[str, StreamBuffer] = {}
+        self._lock = threading.Lock()
+        self._producers = threading.BoundedSemaphore(max_producers)
+        self._producer_num = 0
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def _sweep_locked(self):
+        now = time.time()
+        for stream_id in [k for k, v in self._buffers.items() if v.expired(self.grace_period, now)]:
+            self._buffers.pop(stream_id)
+        if len(self._buffers) >= self.max_streams:
+            # 超出数量 , 先淘汰已结束的
+            finished = sorted([v for v in self._buffers.values() if v.complete and v.readers == 0],
+                              key=lambda v: v.complete_time)
+            for v in finished[:len(self._buffers) - self.max_streams + 1]:
+                self._buffers.pop(v.stream_id)
+
+    def acquire_producer(self):
+        if not self._producers.acquire(blocking=False):
+            return False
+        with self._lock:
+            self._producer_num += 1
+        return True
+
+    def release_producer(self):
+        with self._lock:
+            self._producer_num -= 1
+        self._producers.release()
+
+    def create(self, owner=None) -> StreamBuffer:
+        buffer = StreamBuffer(uuid.uuid4().hex, max_events=self.max_events, owner=owner)
+        with self._lock:
+            self._sweep_locked()
+            self._buffers[buffer.stream_id] = buffer
+        return buffer
+
+    def get(self, stream_id) -> typing.Optional[StreamBuffer]:
+        with self._lock:
+            self._sweep_locked()
+            return self._buffers.get(stream_id, None)
+
+    def remove(self, stream_id):
+        with self._lock:
+            self._buffers.pop(stream_id, None)
+
+    def get_state(self):
+        with self._lock:
+            return {
+                "streams": len(self._buffers),
+                "active": sum(1 for v in self._buffers.values() if not v.complete),
+                "producers": self._producer_num,
+                "max_producers": self.max_producers,
+                "grace_period": self.grace_period,
+                "max_events": self.max_events,
+            }
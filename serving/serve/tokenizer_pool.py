@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/11 15:05
+import multiprocessing
+import queue
+import threading
+import typing
+from concurrent.futures import Future, ProcessPoolExecutor
+from serving.utils import logger
+
+__all__ = [
+    'TOKEN_IPC_TEMPLATES',
+    'TokenizerPool',
+    'IncrementalDetokenizer',
+]
+
+# 支持 token id 模式的模型及其对话模板
+# concat: 历史直接拼接 , 与 model_handler/llm 一致
+# build_prompt: 使用 tokenizer.build_prompt , 与 chatglm2 一致
+TOKEN_IPC_TEMPLATES = {
+    "llama": "concat",
+    "opt": "concat",
+    "bloom": "concat",
+    "chatglm2": "build_prompt",
+}
+
+# 分词进程内的 tokenizer , 进程池 initializer 加载 , transformers 只在分词进程导入
+_tokenizer = None
+
+
+def _init_tokenizer(model_name_or_path, use_fast_tokenizer):
+    global _tokenizer
+    from transformers import AutoTokenizer
+    _tokenizer = AutoTokenizer.from_pretrained(model_name_or_path,
+                                               use_fast=bool(use_fast_tokenizer),
+                                               trust_remote_code=True)
+
+
+def _ping():
+    return _tokenizer is not None
+
+
+def _encode_prompt(query, history, template):
+    if template == 'build_prompt':
+        prompt = _tokenizer.build_prompt(query, history=[(_["q"], _["a"]) for _ in history])
+        return _tokenizer.encode(prompt)
+    prompt = ''.join(_["q"] + _["a"] for _ in history) + query
+    return _tokenizer.encode(prompt)
+
+
+def _count_tokens(texts):
+    return [len(_tokenizer.encode(_, add_special_tokens=False)) for _ in texts]
+
+
+def _decode(ids, skip_special_tokens=True):
+    return _tokenizer.decode(ids, skip_special_tokens=skip_special_tokens)
+
+
+def _decode_incremental(ids, read_offset, final=False, skip_special_tokens=True):
+    '''
+        ids 为 prefix_offset 之后的窗口 , 返回 (新文本 , 是否可以前移窗口)
+        末尾是不完整的多字节字符时先不输出 , final 时全部输出
+    '''
+    prefix_text = _tokenizer.decode(ids[:read_offset], skip_special_tokens=skip_special_tokens)
+    new_text = _tokenizer.decode(ids, skip_special_tokens=skip_special_tokens)
+    if len(new_text) > len(prefix_text) and (final or not new_text.endswith('�')):
+        return new_text[len(prefix_text):], True
+    return '', False
+
+
+def _decode_incremental_batch(items):
+    # 多个流的增量解码 , 一次进程间往返
+    return [_decode_incremental(ids, read_offset, final) for ids, read_offset, final in items]
+
+
+class TokenizerPool:
+    '''
+        前端分词进程池 , 对话模板拼接和分词 , 增量解码都在这里 , GPU worker 只处理 token id
+        各流的增量解码由一个线程合并 , 每个分词进程同时处理一批 , 进程都在忙时新的请求排队进入下一批
+    '''
+    def __init__(self, model_name, model_config: typing.Dict, num_workers=2, max_batch=64):
+        self.model_name = model_name
+        self.model_type = model_config["model_type"]
+        self.template = TOKEN_IPC_TEMPLATES[self.model_type]
+        self.model_name_or_path = model_config["model_name_or_path"]
+        self.use_fast_tokenizer = model_config.get("use_fast_tokenizer", False)
+        self.num_workers = num_workers
+        self.max_batch = max_batch
+        self._executor = None
+        # (ids , read_offset , final , Future) , None 为退出
+        self._decode_queue = None
+        self._decode_thread = None
+
+    def start(self):
+        if self._executor is not None:
+            return
+        # spawn , 不复制前端进程的线程和 socket
+        self._executor = ProcessPoolExecutor(max_workers=self.num_workers,
+                                             mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_init_tokenizer,
+                                             initargs=(self.model_name_or_path, self.use_fast_tokenizer))
+        # 预热 , 加载 tokenizer
+        futures = [self._executor.submit(_ping) for _ in range(self.num_workers)]
+        for f in futures:
+            f.result()
+        self._decode_queue = queue.Queue()
+        self._decode_thread = threading.Thread(target=self._decode_loop, args=(self._executor, self._decode_queue),
+                                               daemon=True)
+        self._decode_thread.start()
+        logger.info('{} tokenizer pool ready , workers {}'.format(self.model_name, self.num_workers))
+
+    def shutdown(self):
+        if self._decode_queue is not None:
+            self._decode_queue.put(None)
+            self._decode_queue = None
+            self._decode_thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _decode_loop(self, executor, decode_queue):
+        slots = threading.BoundedSemaphore(self.num_workers)
+
+        def on_done(future, batch):
+            slots.release()
+            try:
+                results = future.result()
+            except Exception as e:  # noqa
+                for item in batch:
+                    item[3].set_exception(e)
+                return
+            for item, result in zip(batch, results):
+                item[3].set_result(result)
+
+        while True:
+            # 先等空闲的进程 , 等待期间到达的请求合并到同一批
+            slots.acquire()
+            item = decode_queue.get()
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.max_batch:
+                    break
+                try:
+                    item = decode_queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    future = executor.submit(_decode_incremental_batch, [_[:3] for _ in batch])
+                except Exception as e:  # noqa
+                    slots.release()
+                    for _ in batch:
+                        _[3].set_exception(e)
+                else:
+                    future.add_done_callback(lambda f, batch=batch: on_done(f, batch))
+            if item is None:
+                for _ in batch:
+                    if not _[3].done():
+                        _[3].cancel()
+                return
+
+    def _submit(self, fn, *args):
+        if self._executor is None:
+            self.start()
+        return self._executor.submit(fn, *args).result()
+
+    def encode_prompt(self, query, history=None) -> typing.List[int]:
+        return self._submit(_encode_prompt, query, list(history or []), self.template)
+
+    def count_tokens(self, texts: typing.List[str]) -> typing.List[int]:
+        return self._submit(_count_tokens, list(texts))
+
+    def decode(self, ids) -> str:
+        return self._submit(_decode, list(ids))
+
+    def decode_incremental(self, ids, read_offset, final=False):
+        if self._executor is None:
+            self.start()
+        future = Future()
+        self._decode_queue.put((ids, read_offset, final, future))
+        return future.result()
+
+
+class IncrementalDetokenizer:
+    '''
+        单个流式请求的增量解码状态 , 每次只把未确定的窗口发到分词进程
+    '''
+    def __init__(self, pool: TokenizerPool):
+        self.pool = pool
+        self.ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.text = ''
+
+    def add(self, ids, final=False) -> str:
+        if ids:
+            self.ids.extend(ids)
+        elif not final or self.read_offset == len(self.ids):
+            return ''
+        window = self.ids[self.prefix_offset:]
+        delta, advance = self.pool.decode_incremental(window, self.read_offset - self.prefix_offset, final)
+        if advance:
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.ids)
+        self.text += delta
+        return delta
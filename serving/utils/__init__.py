@@ -2,8 +2,45 @@
 # @Time:  23:58
 # @Author: tk
 # @File：__init__.py
+import atexit
 import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
\ No newline at end of file
+
+class _ProcessQueueHandler(QueueHandler):
+    '''
+        日志格式化和写出都放到后台线程 , 请求线程只入队
+        fork 出的 worker 进程没有后台线程 , 直接写出
+    '''
+    def __init__(self, log_queue, fallback_handler: logging.Handler):
+        super(_ProcessQueueHandler, self).__init__(log_queue)
+        self._pid = os.getpid()
+        self._fallback_handler = fallback_handler
+
+    def prepare(self, record):
+        return record
+
+    def emit(self, record):
+        if os.getpid() != self._pid:
+            self._fallback_handler.handle(record)
+            return
+        super(_ProcessQueueHandler, self).emit(record)
+
+
+def _setup_logger():
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.handlers = [_ProcessQueueHandler(log_queue, stream_handler)]
+    root.setLevel(logging.INFO)
+    return root
+
+
+logger = _setup_logger()
\ No newline at end of file
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/12 10:10
+import json
+import pickle
+import struct
+import typing
+from array import array
+
+__all__ = [
+    'IPC_VERSION',
+    'encode_request',
+    'decode_request',
+    'ResultEncoder',
+    'ResultDecoder',
+]
+
+# 格式变化时升级版本号 , 解码端拒绝未知版本
+IPC_VERSION = 1
+
+_METHODS = ['generate', 'chat', 'chat_stream']
+
+# 请求 , 字段存在标记
+_REQ_QUERY = 1
+_REQ_HISTORY = 2
+_REQ_TEXTS = 4
+_REQ_PARAMS = 8
+_REQ_INPUT_IDS = 16
+_REQ_TIMING = 32
+_REQ_EXTRA = 64
+_REQ_METHOD_NAME = 128
+
+# 结果 , 载荷类型
+_KIND_NONE = 0
+_KIND_TEXT = 1
+_KIND_IDS = 2
+_KIND_OBJ = 3
+
+# 结果标记
+_RES_COMPLETE = 1
+_RES_DELTA = 2
+_RES_MSG = 4
+_RES_EXTRA = 8
+
+# version , method , flags , model 长度
+_REQ_HEADER = struct.Struct('<BBBH')
+# version , kind , flags , code , runtime(ms)
+_RES_HEADER = struct.Struct('<BBBif')
+_U32 = struct.Struct('<I')
+_F64 = struct.Struct('<d')
+# 结果帧头部之外的字段放入 extra
+_RES_KEYS = {'code', 'runtime', 'msg', 'complete', 'result', 'token_ids'}
+
+
+def _pack_str(buf: bytearray, s: str):
+    b = s.encode('utf-8')
+    buf += _U32.pack(len(b))
+    buf += b
+
+
+def _unpack_str(data, offset):
+    n, = _U32.unpack_from(data, offset)
+    offset += 4
+    return bytes(data[offset:offset + n]).decode('utf-8'), offset + n
+
+
+def _pack_bytes(buf: bytearray, b: bytes):
+    buf += _U32.pack(len(b))
+    buf += b
+
+
+def _unpack_bytes(data, offset):
+    n, = _U32.unpack_from(data, offset)
+    offset += 4
+    return bytes(data[offset:offset + n]), offset + n
+
+
+def _pack_ids(buf: bytearray, ids):
+    _pack_bytes(buf, array('I', ids).tobytes())
+
+
+def _unpack_ids(data, offset):
+    b, offset = _unpack_bytes(data, offset)
+    ids = array('I')
+    ids.frombytes(b)
+    return ids.tolist(), offset
+
+
+def _json_default(o):
+    # numpy 数组等
+    if hasattr(o, 'tolist'):
+        return o.tolist()
+    raise TypeError('{} is not json serializable'.format(type(o).__name__))
+
+
+def _dumps(obj, safe):
+    '''
+        safe 为 True 时用 json , 用于跨机器的帧 , 解码端不反序列化 pickle ; 本机 worker 间仍用 pickle
+    '''
+    if safe:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_json_default).encode('utf-8')
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _loads(b, safe):
+    return json.loads(b) if safe else pickle.loads(b)
+
+
+def _check_version(version):
+    if version != IPC_VERSION:
+        raise ValueError('ipc version {} not support , expect {}'.format(version, IPC_VERSION))
+
+
+def encode_request(r: typing.Dict, safe=False) -> bytes:
+    r = dict(r)
+    method = r.pop('method', 'generate')
+    model = r.pop('model', None) or ''
+    flags = 0
+    body = bytearray()
+    if method in _METHODS:
+        method_code = _METHODS.index(method)
+    else:
+        method_code = 255
+        flags |= _REQ_METHOD_NAME
+        _pack_str(body, method)
+
+    query = r.pop('query', None)
+    if query is not None:
+        flags |= _REQ_QUERY
+        _pack_str(body, query)
+
+    history = r.pop('history', None)
+    if history is not None:
+        flags |= _REQ_HISTORY
+        body += _U32.pack(len(history))
+        for turn in history:
+            _pack_str(body, turn["q"])
+            _pack_str(body, turn["a"])
+
+    texts = r.pop('texts', None)
+    if texts is not None:
+        flags |= _REQ_TEXTS
+        body += _U32.pack(len(texts))
+        for text in texts:
+            _pack_str(body, text)
+
+    params = r.pop('params', None)
+    if params is not None:
+        flags |= _REQ_PARAMS
+        _pack_str(body, json.dumps(params, ensure_ascii=False, separators=(',', ':')))
+
+    input_ids = r.pop('input_ids', None)
+    if input_ids is not None:
+        flags |= _REQ_INPUT_IDS
+        _pack_ids(body, input_ids)
+
+    timing = r.pop('timing', None)
+    if timing is not None:
+        flags |= _REQ_TIMING
+        body += _U32.pack(len(timing))
+        for k, v in timing.items():
+            _pack_str(body, k)
+            body += _F64.pack(v)
+
+    if r:
+        # 其余字段 , 如 route_key conversation_id
+        flags |= _REQ_EXTRA
+        _pack_bytes(body, _dumps(r, safe))
+
+    model_b = model.encode('utf-8')
+    return _REQ_HEADER.pack(IPC_VERSION, method_code, flags, len(model_b)) + model_b + bytes(body)
+
+
+def decode_request(data: bytes, safe=False) -> typing.Dict:
+    data = memoryview(data)
+    version, method_code, flags, model_len = _REQ_HEADER.unpack_from(data, 0)
+    _check_version(version)
+    offset = _REQ_HEADER.size
+    r = {"model": bytes(data[offset:offset + model_len]).decode('utf-8')}
+    offset += model_len
+
+    if flags & _REQ_METHOD_NAME:
+        r["method"], offset = _unpack_str(data, offset)
+    else:
+        r["method"] = _METHODS[method_code]
+
+    if flags & _REQ_QUERY:
+        r["query"], offset = _unpack_str(data, offset)
+
+    if flags & _REQ_HISTORY:
+        n, = _U32.unpack_from(data, offset)
+        offset += 4
+        history = []
+        for _ in range(n):
+            q, offset = _unpack_str(data, offset)
+            a, offset = _unpack_str(data, offset)
+            history.append({"q": q, "a": a})
+        r["history"] = history
+
+    if flags & _REQ_TEXTS:
+        n, = _U32.unpack_from(data, offset)
+        offset += 4
+        texts = []
+        for _ in range(n):
+            text, offset = _unpack_str(data, offset)
+            texts.append(text)
+        r["texts"] = texts
+
+    if flags & _REQ_PARAMS:
+        params, offset = _unpack_str(data, offset)
+        r["params"] = json.loads(params)
+
+    if flags & _REQ_INPUT_IDS:
+        r["input_ids"], offset = _unpack_ids(data, offset)
+
+    if flags & _REQ_TIMING:
+        n, = _U32.unpack_from(data, offset)
+        offset += 4
+        timing = {}
+        for _ in range(n):
+            k, offset = _unpack_str(data, offset)
+            timing[k], = _F64.unpack_from(data, offset)
+            offset += 8
+        r["timing"] = timing
+
+    if flags & _REQ_EXTRA:
+        extra, offset = _unpack_bytes(data, offset)
+        r.update(_loads(extra, safe))
+    return r
+
+
+class ResultEncoder:
+    '''
+        worker 端 , 单个请求的结果帧编码
+        文本结果只发送相对上一帧新增的部分 , 流式帧不带 history , 前端用请求里的 history 补齐
+        safe 为 True 时非文本结果和 extra 用 json 编码 , 解码端须同样设置
+    '''
+    def __init__(self, method, safe=False):
+        self.is_stream = method == 'chat_stream'
+        self.safe = safe
+        self.last_text = ''
+
+    def encode(self, ret: typing.Dict) -> bytes:
+        flags = _RES_COMPLETE if ret.get('complete', True) else 0
+        kind = _KIND_NONE
+        payload = b''
+        if 'token_ids' in ret:
+            kind = _KIND_IDS
+            payload = array('I', ret['token_ids'] or []).tobytes()
+        elif 'result' in ret:
+            result = ret['result']
+            if isinstance(result, str):
+                kind = _KIND_TEXT
+                last_text = self.last_text
+                if last_text and len(result) > len(last_text) and result.startswith(last_text):
+                    flags |= _RES_DELTA
+                    payload = result[len(last_text):].encode('utf-8')
+                else:
+                    payload = result.encode('utf-8')
+                self.last_text = result
+            else:
+                kind = _KIND_OBJ
+                payload = _dumps(result, self.safe)
+
+        body = b''
+        msg = ret.get('msg', 'ok')
+        if msg != 'ok':
+            flags |= _RES_MSG
+            b = str(msg).encode('utf-8')
+            body += _U32.pack(len(b)) + b
+        # timing history 等只在少数帧出现
+        extra = {k: v for k, v in ret.items() if k not in _RES_KEYS and not (self.is_stream and k == 'history')}
+        if extra:
+            flags |= _RES_EXTRA
+            b = _dumps(extra, self.safe)
+            body += _U32.pack(len(b)) + b
+        return _RES_HEADER.pack(IPC_VERSION, kind, flags, ret.get('code', 0), ret.get('runtime', 0.0)) + body + payload
+
+
+class ResultDecoder:
+    '''
+        前端 , 单个请求的结果帧解码 , 还原完整文本和流式帧的 history
+    '''
+    def __init__(self, r: typing.Dict, safe=False):
+        self.is_stream = r.get('method', None) == 'chat_stream'
+        self.safe = safe
+        # 与 model_handler 推送的 history 格式一致
+        self.history = [[_["q"], _["a"]] for _ in r.get('history', None) or []]
+        self.last_text = ''
+
+    def decode(self, data: bytes) -> typing.Dict:
+        data = memoryview(data)
+        version, kind, flags, code, runtime = _RES_HEADER.unpack_from(data, 0)
+        _check_version(version)
+        offset = _RES_HEADER.size
+        ret = {
+            "code": code,
+            "runtime": runtime,
+            "msg": "ok",
+            "complete": bool(flags & _RES_COMPLETE),
+        }
+        if flags & _RES_MSG:
+            ret["msg"], offset = _unpack_str(data, offset)
+        if flags & _RES_EXTRA:
+            extra, offset = _unpack_bytes(data, offset)
+            ret.update(_loads(extra, self.safe))
+
+        payload = data[offset:]
+        if kind == _KIND_TEXT:
+            text = bytes(payload).decode('utf-8')
+            if flags & _RES_DELTA:
+                text = self.last_text + text
+            self.last_text = text
+            ret["result"] = text
+        elif kind == _KIND_IDS:
+            ids = array('I')
+            ids.frombytes(payload)
+            ret["token_ids"] = ids.tolist()
+        elif kind == _KIND_OBJ:
+            ret["result"] = _loads(bytes(payload), self.safe)
+
+        if self.is_stream and code == 0 and "result" in ret and "history" not in ret:
+            ret["history"] = self.history
+        return ret
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/8 9:41
+import bisect
+import math
+import queue
+import threading
+import time
+import typing
+
+__all__ = [
+    'DEFAULT_BUCKETS',
+    'Histogram',
+    'Counter',
+    'Gauge',
+    'MetricsRegistry',
+    'MetricsCollector',
+    'global_registry',
+    'serving_metrics',
+    'RequestRecorder',
+]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+RATE_BUCKETS = (1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 50.0, 75.0, 100.0, 150.0, 200.0, 500.0)
+
+
+def _format_value(v):
+    if v == math.inf:
+        return '+Inf'
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+
+def _format_labels(labelnames, labels, extra=None):
+    pairs = list(zip(labelnames, labels))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        assert len(labels) == len(self.labelnames), ValueError('{} require labels {}'.format(self.name, self.labelnames))
+        return tuple(str(_) for _ in labels)
+
+    def describe(self):
+        return {"kind": self.kind, "name": self.name, "doc": self.doc, "labelnames": self.labelnames}
+
+    def collect(self, reset=False):
+        with self._lock:
+            values = self._values
+            if reset:
+                self._values = {}
+            else:
+                values = {k: (list(v) if isinstance(v, list) else v) for k, v in values.items()}
+        return values
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, value=1.0):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def merge(self, values):
+        with self._lock:
+            for k, v in values.items():
+                self._values[k] = self._values.get(k, 0.0) + v
+
+    def render(self):
+        lines = []
+        for k, v in self.collect().items():
+            lines.append('{}_total{} {}'.format(self.name, _format_labels(self.labelnames, k), _format_value(v)))
+        return lines
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, *labels, value=0.0):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labels, value=1.0):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def merge(self, values):
+        with self._lock:
+            self._values.update(values)
+
+    def render(self):
+        lines = []
+        for k, v in self.collect().items():
+            lines.append('{}{} {}'.format(self.name, _format_labels(self.labelnames, k), _format_value(v)))
+        return lines
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def describe(self):
+        d = super(Histogram, self).describe()
+        d["buckets"] = self.buckets
+        return d
+
+    def observe(self, *labels, value):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(key, None)
+            if v is None:
+                # bucket counts + [sum, count]
+                v = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            v[idx] += 1
+            v[-2] += value
+            v[-1] += 1
+
+    def merge(self, values):
+        with self._lock:
+            for k, src in values.items():
+                v = self._values.get(k, None)
+                if v is None:
+                    self._values[k] = list(src)
+                else:
+                    for i in range(len(v)):
+                        v[i] += src[i]
+
+    def render(self):
+        lines = []
+        for k, v in self.collect().items():
+            acc = 0
+            for i, upper in enumerate(self.buckets + (math.inf,)):
+                acc += v[i]
+                lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.labelnames, k, ('le', _format_value(upper))), acc))
+            lines.append('{}_sum{} {}'.format(self.name, _format_labels(self.labelnames, k), _format_value(v[-2])))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(self.labelnames, k), _format_value(v[-1])))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: typing.Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, doc, labelnames, **kwargs):
+        with self._lock:
+            m = self._metrics.get(name, None)
+            if m is None:
+                m = self._metrics[name] = cls(name, doc, labelnames, **kwargs)
+            return m
+
+    def counter(self, name, doc, labelnames=()) -> Counter:
+        return self._get_or_create(Counter, name, doc, labelnames)
+
+    def gauge(self, name, doc, labelnames=()) -> Gauge:
+        return self._get_or_create(Gauge, name, doc, labelnames)
+
+    def histogram(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, doc, labelnames, buckets=buckets)
+
+    def collect_delta(self):
+        '''
+            worker 端调用 , 取出计数器和直方图的增量 , gauge 取当前值
+        '''
+        with self._lock:
+            metrics = list(self._metrics.values())
+        delta = []
+        for m in metrics:
+            values = m.collect(reset=not isinstance(m, Gauge))
+            if values:
+                delta.append((m.describe(), values))
+        return delta
+
+    def merge(self, delta):
+        cls_map = {"counter": Counter, "gauge": Gauge, "histogram": Histogram}
+        for desc, values in delta:
+            kwargs = {"buckets": desc["buckets"]} if desc["kind"] == "histogram" else {}
+            m = self._get_or_create(cls_map[desc["kind"]], desc["name"], desc["doc"], desc["labelnames"], **kwargs)
+            m.merge(values)
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for m in metrics:
+            lines.append('# HELP {} {}'.format(m.name, m.doc))
+            lines.append('# TYPE {} {}'.format(m.name, m.kind))
+            lines.extend(m.render())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsCollector:
+    '''
+        前端进程内的旁路通道 , worker 通过 multiprocessing.Queue 推送指标增量 , 这里后台线程合并
+    '''
+    def __init__(self, metrics_queue, registry: MetricsRegistry, handlers=None):
+        self.metrics_queue = metrics_queue
+        self.registry = registry
+        self.handlers = list(handlers or [])
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                item = self.metrics_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+            delta = item.get("delta", None)
+            if delta:
+                self.registry.merge(delta)
+            for handler in self.handlers:
+                handler(item)
+
+
+_g_registry = MetricsRegistry()
+
+
+def global_registry() -> MetricsRegistry:
+    return _g_registry
+
+
+class _ServingMetrics:
+    def __init__(self, registry: MetricsRegistry):
+        labels = ('model', 'adapter', 'worker')
+        self.queue_wait = registry.histogram('aigc_queue_wait_seconds', 'time from api receive to worker pickup', labels)
+        self.ttft = registry.histogram('aigc_time_to_first_token_seconds', 'time from api receive to first streamed token', labels)
+        self.itl = registry.histogram('aigc_inter_token_latency_seconds', 'time between streamed chunks', labels)
+        self.e2e = registry.histogram('aigc_e2e_latency_seconds', 'time from api receive to last token', labels)
+        self.tokens_per_second = registry.histogram('aigc_tokens_per_second', 'completion tokens per second of generation', labels, buckets=RATE_BUCKETS)
+        self.requests = registry.counter('aigc_requests', 'finished requests', labels + ('code',))
+        self.completion_tokens = registry.counter('aigc_completion_tokens', 'generated tokens', labels)
+        self.worker_inflight = registry.gauge('aigc_worker_inflight_requests', 'requests being generated by a worker', labels)
+
+        self.scheduler_wait = registry.histogram('aigc_scheduler_wait_seconds', 'time waiting in front end scheduler', ('model',))
+        self.inflight = registry.gauge('aigc_inflight_requests', 'requests dispatched to workers', ('model',))
+        self.queued = registry.gauge('aigc_queued_requests', 'requests waiting in front end scheduler', ('model',))
+
+
+def serving_metrics(registry: typing.Optional[MetricsRegistry] = None) -> _ServingMetrics:
+    return _ServingMetrics(registry or _g_registry)
+
+
+class RequestRecorder:
+    '''
+        worker 端单个请求的计时 , 结束时写入本地 registry
+    '''
+    def __init__(self, metrics: _ServingMetrics, labels, receive_time=None):
+        self.metrics = metrics
+        self.labels = labels
+        self.pickup_time = time.time()
+        self.receive_time = receive_time or self.pickup_time
+        self.first_time = None
+        self.last_time = None
+        self.metrics.queue_wait.observe(*labels, value=max(0.0, self.pickup_time - self.receive_time))
+        # 同一 worker 可能同时处理多个请求 , 增减计数
+        self.metrics.worker_inflight.inc(*labels, value=1)
+
+    def on_chunk(self):
+        t = time.time()
+        if self.first_time is None:
+            self.first_time = t
+            self.metrics.ttft.observe(*self.labels, value=t - self.receive_time)
+        else:
+            self.metrics.itl.observe(*self.labels, value=t - self.last_time)
+        self.last_time = t
+
+    def get_timing(self):
+        timing = {"pickup": self.pickup_time}
+        if self.first_time is not None:
+            timing["first_token"] = self.first_time
+        if self.last_time is not None:
+            timing["last_token"] = self.last_time
+        return timing
+
+    def finish(self, code, completion_tokens=0):
+        t = time.time()
+        if self.last_time is None:
+            self.last_time = t
+        self.metrics.e2e.observe(*self.labels, value=self.last_time - self.receive_time)
+        self.metrics.requests.inc(*self.labels, str(code))
+        if completion_tokens:
+            self.metrics.completion_tokens.inc(*self.labels, value=completion_tokens)
+            gen_time = self.last_time - (self.first_time if self.first_time is not None and self.last_time > self.first_time else self.pickup_time)
+            if gen_time > 0:
+                self.metrics.tokens_per_second.observe(*self.labels, value=completion_tokens / gen_time)
+        self.metrics.worker_inflight.inc(*self.labels, value=-1)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/9 14:20
+import atexit
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+import typing
+from serving.utils import logger
+
+__all__ = [
+    'RequestLogger'
+]
+
+
+def _snapshot(obj):
+    if isinstance(obj, dict):
+        return {k: _snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_snapshot(_) for _ in obj]
+    if hasattr(obj, 'dict'):
+        # pydantic 请求对象
+        return _snapshot(obj.dict())
+    return obj
+
+
+class RequestLogger:
+    '''
+        请求日志 , 请求线程只做采样判断和入队 , 截断/哈希 , 序列化 , 批量写文件都在后台线程
+    '''
+    def __init__(self,
+                 enable=True,
+                 path='./logs/request.log',
+                 max_bytes=100 * 1024 * 1024,
+                 backup_count=5,
+                 sample_rate: typing.Optional[typing.Dict[str, float]] = None,
+                 body_mode='truncate',
+                 max_field_length=512,
+                 batch_size=256,
+                 flush_interval=1.0,
+                 queue_size=10000):
+        assert body_mode in ['truncate', 'hash', 'full'], ValueError('body_mode one of truncate,hash,full')
+        self.enable = enable
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.sample_rate = sample_rate or {}
+        self.body_mode = body_mode
+        self.max_field_length = max_field_length
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._dropped = 0
+        self._thread = None
+        self._file = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _should_sample(self, route):
+        rate = self.sample_rate.get(route, self.sample_rate.get('default', 1.0))
+        return rate >= 1.0 or (rate > 0 and random.random() < rate)
+
+    def log(self, route, body, **kwargs):
+        if not self.enable or not self._should_sample(route):
+            return
+        if self._thread is None:
+            self.start()
+        # 入队时复制嵌套的 dict / list ( timing , history , params 等 ) , 字符串不复制
+        # 之后请求线程对 body 的修改 ( 如追加 timing ) 不影响后台序列化 , 也不会记录入队之后才有的字段
+        body = _snapshot(body)
+        try:
+            self._queue.put_nowait((time.time(), route, body, kwargs))
+        except queue.Full:
+            self._dropped += 1
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def close(self):
+        # 退出时写出队列中剩余的日志
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 1)
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        with self._lock:
+            if batch:
+                self._write(batch)
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _shrink(self, obj):
+        if isinstance(obj, str):
+            if self.body_mode == 'full' or len(obj) <= self.max_field_length:
+                return obj
+            if self.body_mode == 'hash':
+                return 'sha1:{} len:{}'.format(hashlib.sha1(obj.encode('utf-8')).hexdigest(), len(obj))
+            return '{}...(+{} chars)'.format(obj[:self.max_field_length], len(obj) - self.max_field_length)
+        if isinstance(obj, dict):
+            return {k: self._shrink(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return [self._shrink(_) for _ in obj]
+        if hasattr(obj, 'dict'):
+            return self._shrink(obj.dict())
+        return obj
+
+    def _format(self, item):
+        t, route, body, kwargs = item
+        record = {
+            "time": t,
+            "route": route,
+            "body": self._shrink(body),
+        }
+        record.update(kwargs)
+        return json.dumps(record, ensure_ascii=False, default=str)
+
+    def _open(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        self._file = open(self.path, mode='a', encoding='utf-8')
+
+    def _rollover(self):
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = '{}.{}'.format(self.path, i)
+            if os.path.exists(src):
+                os.replace(src, '{}.{}'.format(self.path, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, '{}.1'.format(self.path))
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _write(self, batch):
+        lines = []
+        for item in batch:
+            try:
+                lines.append(self._format(item))
+            except Exception as e: # noqa
+                logger.warning('request log format error {}'.format(e))
+        if self._dropped:
+            lines.append(json.dumps({"time": time.time(), "route": "", "dropped": self._dropped}))
+            self._dropped = 0
+        if not lines:
+            return
+        if self._file is None:
+            self._open()
+        self._file.write('\n'.join(lines) + '\n')
+        self._file.flush()
+        if self.max_bytes > 0 and self._file.tell() >= self.max_bytes:
+            self._rollover()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            batch = []
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if batch or self._dropped:
+                try:
+                    with self._lock:
+                        self._write(batch)
+                except Exception as e: # noqa
+                    logger.warning('request log write error {}'.format(e))
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/11 10:30
+
+__all__ = [
+    'estimate_token_num',
+]
+
+
+def _is_cjk(ch):
+    return '一' <= ch <= '鿿' or '぀' <= ch <= 'ヿ' or '가' <= ch <= '힯'
+
+
+def estimate_token_num(text: str):
+    '''
+        没有 tokenizer 时按字符估算 , 中日韩字符一个 token , 其他约 4 个字符一个 token
+        前端 ( 上下文裁剪 ) 和 worker ( 用量统计 ) 共用
+    '''
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    return cjk + (len(text) - cjk + 3) // 4
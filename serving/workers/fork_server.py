@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/14 15:20
+import ctypes
+import multiprocessing
+import signal
+import threading
+import time
+from multiprocessing import Process
+from serving.utils import logger
+
+__all__ = [
+    'set_pdeathsig',
+    'ForkServer',
+    'ForkedWorker',
+]
+
+
+def set_pdeathsig():
+    # 父进程退出时收到 SIGTERM , 避免成为孤儿进程 , 仅 linux
+    try:
+        ctypes.CDLL('libc.so.6', use_errno=True).prctl(1, signal.SIGTERM)  # PR_SET_PDEATHSIG
+    except Exception:  # noqa
+        pass
+
+
+class ForkServer(Process):
+    '''
+        CPU 模式 ( 模型配置 fork_workers ) , 本进程加载一次模型 , worker 进程由本进程 fork , 按 copy-on-write 共享只读的权重内存
+        加载由 CLS_worker.preload 完成 , 之后 gc.freeze , fork 出的 worker 中 gc 不再改写已有对象 , 权重所在内存页不被复制
+        前端通过 Pipe 管理 worker , 加载完成前收到的 start 排队 , 加载后 fork , 新增 worker 毫秒级
+        命令和回复带序号 , 超时后迟到的回复按序号丢弃 , 不会被当作下一条命令的结果
+        worker_args 为 (model_name , config , ...) , config 随 start 传入 , 与 resize 后的配置一致 , 其余参数在本进程启动时继承
+    '''
+    def __init__(self, CLS_worker, worker_args: tuple, group_name, evt_quit):
+        super(ForkServer, self).__init__(daemon=False)
+        self.CLS_worker = CLS_worker
+        self.worker_args = worker_args
+        self.group_name = group_name
+        self.evt_quit = evt_quit
+        self._conn, self._child_conn = multiprocessing.Pipe()
+        self._lock = threading.Lock()
+        self._seq = 0
+
+    def create_worker(self, *args, identity, group_name, evt_quit, is_log_time, idx, daemon=False):
+        '''
+            与 CLS_worker 相同的构造参数 , 作为 WorkerGroup 的 CLS_worker
+        '''
+        return ForkedWorker(self, args[1], identity, evt_quit, is_log_time, idx, daemon)
+
+    def call(self, cmd, *args, timeout=30):
+        with self._lock:
+            if not self.is_alive():
+                raise RuntimeError('{} fork server exited with code {}'.format(self.group_name, self.exitcode))
+            self._seq += 1
+            seq = self._seq
+            self._conn.send((seq, cmd) + args)
+            deadline = time.time() + timeout
+            while True:
+                if not self._conn.poll(max(deadline - time.time(), 0)):
+                    raise TimeoutError('{} fork server {} timeout'.format(self.group_name, cmd))
+                reply_seq, ret = self._conn.recv()
+                if reply_seq == seq:
+                    return ret
+                # 之前超时的命令迟到的回复
+
+    def stop(self):
+        try:
+            self.call('stop', timeout=15)
+        except Exception as e:  # noqa
+            logger.warning(e)
+        self.join(5)
+        if self.is_alive():
+            self.kill()
+            self.join(5)
+
+    def _load(self, state):
+        model_name, config = self.worker_args[:2]
+        start = time.time()
+        state["preloaded"] = self.CLS_worker.preload(model_name, config, self.group_name)
+        logger.info('{} fork server load {:.1f}s'.format(self.group_name, time.time() - start))
+
+    def _fork(self, state, config, identity, is_log_time, idx, addr_sink, addr_pub):
+        worker = self.CLS_worker(
+            *((self.worker_args[0], config) + tuple(self.worker_args[2:])),
+            identity=identity,
+            group_name=self.group_name,
+            evt_quit=self.evt_quit,
+            is_log_time=is_log_time,
+            idx=idx,
+            daemon=True
+        )
+        worker.preloaded = state["preloaded"]
+        worker._set_addr(addr_sink, addr_pub)
+        worker.start()
+        return worker
+
+    def run(self):
+        set_pdeathsig()
+        conn = self._child_conn
+        state = {"preloaded": None}
+        loader = threading.Thread(target=self._load, args=(state,), daemon=True)
+        loader.start()
+        # key -> Process , 排队中的 key -> start 参数
+        workers = {}
+        pending = {}
+        while True:
+            if pending and not loader.is_alive():
+                for key, args in list(pending.items()):
+                    try:
+                        workers[key] = self._fork(state, *args)
+                    except Exception as e:  # noqa
+                        logger.error('{} fork worker error {}'.format(self.group_name, e))
+                pending.clear()
+            # 回收已退出的子进程
+            multiprocessing.active_children()
+            if not conn.poll(0.05):
+                continue
+            try:
+                msg = conn.recv()
+            except EOFError:
+                break
+            seq, cmd, key, args = msg[0], msg[1], (msg[2] if len(msg) > 2 else None), msg[3:]
+            p = workers.get(key, None)
+            ret = None
+            if cmd == 'start':
+                if loader.is_alive() or pending:
+                    pending[key] = args
+                elif state["preloaded"] is not None and state["preloaded"][0] is None:
+                    # 上次加载失败 , 重新加载
+                    loader = threading.Thread(target=self._load, args=(state,), daemon=True)
+                    loader.start()
+                    pending[key] = args
+                else:
+                    try:
+                        p = workers[key] = self._fork(state, *args)
+                        ret = p.pid
+                    except Exception as e:  # noqa
+                        logger.error('{} fork worker error {}'.format(self.group_name, e))
+            elif cmd == 'pid':
+                ret = p.pid if p is not None else None
+            elif cmd == 'is_alive':
+                ret = key in pending or (p is not None and p.is_alive())
+            elif cmd == 'exitcode':
+                ret = p.exitcode if p is not None else (None if key in pending else -signal.SIGTERM)
+            elif cmd in ['terminate', 'kill']:
+                pending.pop(key, None)
+                if p is not None and p.is_alive():
+                    getattr(p, cmd)()
+            elif cmd == 'join':
+                if p is not None:
+                    p.join(args[0])
+                    if not p.is_alive():
+                        workers.pop(key, None)
+            elif cmd == 'stop':
+                for p in workers.values():
+                    if p.is_alive():
+                        p.terminate()
+                for p in workers.values():
+                    p.join(5)
+                conn.send((seq, None))
+                break
+            conn.send((seq, ret))
+
+
+class ForkedWorker:
+    '''
+        前端中代替 worker Process 对象 , 进程由 ForkServer fork , 提供 WorkerGroup 用到的 Process 接口
+    '''
+    def __init__(self, server: ForkServer, config, identity, evt_quit, is_log_time, idx, daemon=False):
+        self.server = server
+        self.config = config
+        self.identity = identity
+        self._evt_quit = evt_quit
+        self._is_log_time = is_log_time
+        self._idx = idx
+        self.daemon = daemon
+        # fork 时 worker 已加载模型 , 前端只向 ready 的 worker 下发 , 不需要等待订阅
+        self.signal = threading.Event()
+        self._pid = None
+        self._addr_sink = None
+        self._addr_pub = None
+
+    def _set_addr(self, addr_sink, addr_pub):
+        self._addr_sink = addr_sink
+        self._addr_pub = addr_pub
+
+    def start(self):
+        self._pid = self.server.call('start', self.identity, self.config, self.identity, self._is_log_time,
+                                     self._idx, self._addr_sink, self._addr_pub)
+        self.signal.set()
+
+    @property
+    def pid(self):
+        if self._pid is None:
+            try:
+                self._pid = self.server.call('pid', self.identity)
+            except Exception:  # noqa
+                return None
+        return self._pid
+
+    @property
+    def exitcode(self):
+        try:
+            return self.server.call('exitcode', self.identity)
+        except Exception:  # noqa
+            return self.server.exitcode if self.server.exitcode is not None else -1
+
+    def is_alive(self):
+        try:
+            return self.server.call('is_alive', self.identity)
+        except Exception:  # noqa
+            return False
+
+    def terminate(self):
+        try:
+            self.server.call('terminate', self.identity)
+        except Exception as e:  # noqa
+            logger.warning(e)
+
+    def kill(self):
+        try:
+            self.server.call('kill', self.identity)
+        except Exception as e:  # noqa
+            logger.warning(e)
+
+    def join(self, timeout=None):
+        try:
+            self.server.call('join', self.identity, timeout, timeout=(timeout or 0) + 30)
+        except Exception as e:  # noqa
+            logger.warning(e)
+
+    def release(self):
+        pass
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/12 15:20
+import bisect
+import hashlib
+import typing
+
+__all__ = [
+    'HashRing'
+]
+
+
+def _hash(key: str):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'little')
+
+
+class HashRing:
+    '''
+        一致性哈希环 , 每个节点若干虚拟节点 , 增减节点只迁移约 1/n 的 key
+    '''
+    def __init__(self, nodes: typing.Iterable = (), replicas=160):
+        self.replicas = replicas
+        self._keys = []
+        self._nodes = []
+        self.node_set = set()
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.node_set:
+            return
+        self.node_set.add(node)
+        for i in range(self.replicas):
+            h = _hash('{}#{}'.format(node, i))
+            idx = bisect.bisect(self._keys, h)
+            self._keys.insert(idx, h)
+            self._nodes.insert(idx, node)
+
+    def remove(self, node):
+        if node not in self.node_set:
+            return
+        self.node_set.discard(node)
+        keep = [(k, n) for k, n in zip(self._keys, self._nodes) if n != node]
+        self._keys = [_[0] for _ in keep]
+        self._nodes = [_[1] for _ in keep]
+
+    def __len__(self):
+        return len(self.node_set)
+
+    def iter_nodes(self, key: str):
+        '''
+            从 key 的位置顺时针遍历 , 依次返回不重复的节点 , 第一个为首选节点
+        '''
+        if not self._keys:
+            return
+        start = bisect.bisect(self._keys, _hash(key))
+        seen = set()
+        n = len(self._keys)
+        for i in range(n):
+            node = self._nodes[(start + i) % n]
+            if node in seen:
+                continue
+            seen.add(node)
+            yield node
+            if len(seen) == len(self.node_set):
+                return
@@ -2,12 +2,19 @@
 # @Time    : 2022/6/8 13:33
 # @Author  : tk
 import os
+import queue
 import sys
+import threading
 import time
 import traceback
 from ipc_worker.ipc_zmq_loader import IPC_zmq,ZMQ_process_worker  # noqa
 import copy
+import gc
 from serving.utils import logger
+from serving.utils.metrics import MetricsRegistry, serving_metrics, RequestRecorder
+from serving.utils.ipc_codec import decode_request, ResultEncoder
+from serving.utils.token_count import estimate_token_num
+from config.main import global_worker_args
 
 
 def get_worker_instance(model_name,config,group_name,worker_idx):
@@ -46,18 +53,78 @@ def get_worker_instance(model_name,config,group_name,worker_idx):
     elif model_name.startswith("qwen"):
         from serving.model_handler.qwen.infer import EngineAPI
         api_client = EngineAPI(config, group_name=group_name, worker_idx=worker_idx)
+    elif model_name.startswith("mock"):
+        from serving.model_handler.mock.infer import EngineAPI
+        api_client = EngineAPI(config, group_name=group_name, worker_idx=worker_idx)
     else:
         raise ValueError('not support yet')
     return api_client
 
 class My_worker(ZMQ_process_worker):
-    def __init__(self,model_name,config,*args,**kwargs):
+    def __init__(self,model_name,config,metrics_queue=None,cancel_slots=None,*args,**kwargs):
         super(My_worker,self).__init__(*args,**kwargs)
         logger.info('group name {} ,worker id {}'.format(self._group_name,self._idx))
         self.config = copy.deepcopy(config)
         self.model_name = model_name
         self.api_client = None
         self.initial_error = None
+        self.metrics_queue = metrics_queue
+        self.metrics = None
+        # 当前请求已生成 token 数 , 随心跳发送到前端用于负载均衡
+        self._busy = False
+        self._generated = 0
+        # 已处理请求数 , 前端据此和内存决定是否回收 worker
+        self._served = 0
+        # 与前端共享的取消标记 , 对冲请求已由其他 worker 完成时跳过
+        self.cancel_slots = cancel_slots
+        # fork_workers 模式 , ForkServer 中已加载的 (api_client , 错误 , torch 线程数)
+        self.preloaded = None
+
+    @classmethod
+    def preload(cls,model_name,config,group_name):
+        '''
+            fork_workers 模式 , 在 ForkServer 进程加载模型 , 返回 (api_client , 错误 , torch 线程数)
+            加载时 torch 只用单线程 , fork 前不创建 OpenMP 线程池 ( fork 后子进程无法使用 ) , 由 worker 在 fork 后设置线程数
+        '''
+        num_threads = None
+        try:
+            try:
+                import torch
+                num_threads = torch.get_num_threads()
+                torch.set_num_threads(1)
+            except ImportError:
+                torch = None
+            api_client = get_worker_instance(model_name,config,group_name,0)
+            if not hasattr(api_client,'init_shared'):
+                raise ValueError('{} not support fork_workers'.format(model_name))
+            api_client.init_shared()
+            if torch is not None:
+                torch.set_grad_enabled(False)
+            # 已有对象移入永久代 , fork 后 gc 不再遍历和改写其对象头 , 减少写时复制的内存页
+            gc.collect()
+            gc.freeze()
+            return api_client,None,num_threads
+        except Exception as e:
+            traceback.print_exc()
+            logger.error(e)
+            return None,str(e),num_threads
+
+    def _init_preloaded(self):
+        from serving.workers.fork_server import set_pdeathsig
+        set_pdeathsig()
+        api_client,error,num_threads = self.preloaded
+        if error is not None:
+            raise RuntimeError(error)
+        cpu_threads = self.config.get('cpu_threads',None) or \
+            max(1,(num_threads or os.cpu_count() or 1) // max(1,len(self.config['workers'])))
+        try:
+            import torch
+            torch.set_num_threads(cpu_threads)
+        except ImportError:
+            pass
+        api_client.worker_idx = self._idx
+        api_client.init_forked()
+        return api_client
 
     #Process begin trigger this func
     def run_begin(self):
@@ -67,8 +134,16 @@ class My_worker(ZMQ_process_worker):
                 os.environ['CUDA_DEVICE_ORDER'] = "PCI_BUS_ID"
                 os.environ['CUDA_VISIBLE_DEVICES'] = ','.join([str(_) for _ in device_id])
             logger.info('{} worker pid {}...'.format(self.model_name, os.getpid()))
-            self.api_client = get_worker_instance(self.model_name, self.config,self._group_name, self._idx)
-            self.api_client.init()
+            # 子进程独立的 registry , 通过 metrics_queue 把增量发送到前端
+            self.metrics_registry = MetricsRegistry()
+            self.metrics = serving_metrics(self.metrics_registry)
+            self._start_heartbeat()
+            if self.preloaded is not None:
+                self.api_client = self._init_preloaded()
+            else:
+                api_client = get_worker_instance(self.model_name, self.config,self._group_name, self._idx)
+                api_client.init()
+                self.api_client = api_client
         except Exception as e:
             traceback.print_exc()
             logger.error(e)
@@ -84,27 +159,186 @@ class My_worker(ZMQ_process_worker):
             except:
                 pass
 
+    def _flush_metrics(self):
+        if self.metrics_queue is None or self.metrics is None:
+            return
+        try:
+            self.metrics_queue.put_nowait({
+                "model": self.model_name,
+                "worker": self._idx,
+                "delta": self.metrics_registry.collect_delta(),
+            })
+        except queue.Full:
+            pass
+        except Exception as e: # noqa
+            logger.warning(e)
+
+    def _start_heartbeat(self):
+        interval = global_worker_args.get("heartbeat_interval", 1.0)
+        if self.metrics_queue is None or not interval:
+            return
+        def heartbeat():
+            while True:
+                try:
+                    self.metrics_queue.put_nowait({
+                        "model": self.model_name,
+                        "worker": self._idx,
+                        "heartbeat": {
+                            "pid": os.getpid(),
+                            "busy": self._busy,
+                            "generated": self._generated,
+                            "ready": self.api_client is not None,
+                            "error": self.initial_error,
+                            "served": self._served,
+                            "rss": self._get_rss(),
+                            "time": time.time(),
+                        },
+                    })
+                except queue.Full:
+                    pass
+                except Exception as e: # noqa
+                    logger.warning(e)
+                time.sleep(interval)
+        threading.Thread(target=heartbeat, daemon=True).start()
+
+    def _get_rss(self):
+        # 常驻内存 MB , fork 的 worker 只统计私有内存 , 不含与 ForkServer 共享的权重
+        if self.preloaded is not None:
+            try:
+                with open('/proc/self/smaps_rollup') as f:
+                    return sum(int(line.split()[1]) for line in f if line.startswith('Private_')) / 1024
+            except Exception: # noqa
+                pass
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+        except Exception: # noqa
+            return 0
+
+    def _create_recorder(self,r):
+        if self.metrics is None:
+            return None
+        params = r.get('params', None) or {}
+        labels = (self.model_name, params.get('adapter_name', 'default'), self._idx)
+        timing = r.get('timing', None) or {}
+        recorder = RequestRecorder(self.metrics, labels, receive_time=timing.get('receive', None))
+        self._flush_metrics()
+        return recorder
+
+    def _finish_recorder(self,recorder,r,code,completion_text,completion_tokens=None):
+        '''
+            token 数不在 worker 重新分词 : token id 模式为输入和生成的 id 数 , 流式文本模式按 handler 推送的块数 * nchar ,
+            其他按字符估算 , timing["estimated"] 标记
+        '''
+        if recorder is None:
+            return None
+        estimated = completion_tokens is None
+        if not estimated:
+            pass
+        elif isinstance(completion_text,list):
+            completion_tokens = sum(self._estimate_token_num(_) for _ in completion_text)
+        else:
+            completion_tokens = self._estimate_token_num(completion_text)
+        recorder.finish(code, completion_tokens)
+        self._flush_metrics()
+
+        timing = dict(r.get('timing', None) or {})
+        timing.update(recorder.get_timing())
+        timing["prompt_tokens"] = self._get_prompt_token_num(r)
+        timing["completion_tokens"] = completion_tokens
+        if r.get('input_ids', None) is None:
+            timing["estimated"] = True
+        return timing
+
+    def _get_prompt_token_num(self,r):
+        if r.get('input_ids', None) is not None:
+            return len(r['input_ids'])
+        if r.get('method', "generate") == 'generate':
+            return sum(self._estimate_token_num(_) for _ in r.get('texts', []))
+        num = self._estimate_token_num(r.get('query', ""))
+        for x in r.get('history', None) or []:
+            num += self._estimate_token_num(x.get('q', "")) + self._estimate_token_num(x.get('a', ""))
+        return num
+
+    @staticmethod
+    def _estimate_token_num(text):
+        if not isinstance(text,str):
+            return 0
+        return estimate_token_num(text)
+
     #any data put will trigger this func
     def run_once(self,request_data):
-        r = request_data
+        if not isinstance(request_data,bytes):
+            yield from self._run_once(request_data)
+            return None
+        # 二进制请求 , 结果也按二进制帧返回
+        r = decode_request(request_data)
+        encoder = ResultEncoder(r.get('method', "generate"))
+        for ret in self._run_once(r):
+            yield encoder.encode(ret)
+
+    def _run_once(self,r):
+        cancel = r.pop('cancel',None)
+        if cancel is not None and self.cancel_slots is not None and self.cancel_slots[cancel[0]] == cancel[1]:
+            yield {"code": -1, "runtime": 0.0, "msg": "cancelled", "complete": True}
+            return None
+        self._busy = True
+        self._generated = 0
+        try:
+            yield from self._run_once_impl(r)
+        finally:
+            self._busy = False
+            self._generated = 0
+            self._served += 1
+
+    def _run_once_impl(self,r):
         result = None
         start_time = time.time()
+        recorder = self._create_recorder(r)
+        completion_text = ''
+        # token id 模式 , 结果只返回 token id , 前端解码
+        is_ids = r.get('input_ids', None) is not None
+        completion_tokens = 0 if is_ids else None
+        timing = None
         try:
             if self.initial_error is None:
                 method = r.get('method', "generate")
                 if method == 'chat_stream':
+                    params = r.get('params', None) or {}
+                    is_total = params.get('gtype', 'total') == 'total'
+                    nchar = params.get('nchar', 1) or 1
                     gen = self.api_client.trigger_generator(r)
                     for node_result in gen:
                         result, code, msg, complte_flag = node_result
                         end_time = time.time()
+                        if code == 0 and result:
+                            text = result[0] if isinstance(result, tuple) else result
+                            if is_ids and len(text) > 0:
+                                completion_tokens += len(text)
+                                self._generated = completion_tokens
+                                if recorder is not None:
+                                    recorder.on_chunk()
+                            elif isinstance(text,str) and len(text) > 0:
+                                completion_text = text if is_total else completion_text + text
+                                # 文本模式 handler 每 nchar 个 token 推送一次
+                                self._generated += nchar
+                                if recorder is not None:
+                                    recorder.on_chunk()
+                        if complte_flag:
+                            timing = self._finish_recorder(recorder, r, code, completion_text,
+                                                           completion_tokens if is_ids else self._generated)
                         ret = {
                             "code": code,
                             "runtime": (end_time - start_time) * 1000,
                             "msg": msg,
                             "complete": complte_flag
                         }
+                        if timing is not None:
+                            ret["timing"] = timing
                         if code == 0:
-                            if not isinstance(result, tuple):
+                            if is_ids:
+                                ret["token_ids"] = (result[0] if isinstance(result, tuple) else result) or []
+                            elif not isinstance(result, tuple):
                                 ret["result"] = result
                             else:
                                 ret["result"] = result[0]
@@ -115,6 +349,10 @@ class My_worker(ZMQ_process_worker):
 
                 else:
                     result,code,msg,complte_flag = self.api_client.trigger(r)
+                    if code == 0:
+                        completion_text = result[0] if isinstance(result, tuple) else result
+                        if is_ids:
+                            completion_tokens = len(completion_text)
             else:
                 code = -1
                 msg = self.initial_error
@@ -124,6 +362,7 @@ class My_worker(ZMQ_process_worker):
             msg = str(e)
             logger.info(e)
         end_time = time.time()
+        timing = self._finish_recorder(recorder, r, code, completion_text, completion_tokens)
 
         ret = {
             "code": code,
@@ -131,8 +370,12 @@ class My_worker(ZMQ_process_worker):
             "msg": msg,
             "complete": True
         }
+        if timing is not None:
+            ret["timing"] = timing
         if code == 0:
-            if not isinstance(result, tuple):
+            if is_ids:
+                ret["token_ids"] = result[0]
+            elif not isinstance(result, tuple):
                 ret["result"] = result
             else:
                 ret["result"] = result[0]
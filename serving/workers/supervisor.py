@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/12 17:40
+import threading
+import typing
+from serving.utils import logger
+
+__all__ = [
+    'WorkerSupervisor'
+]
+
+
+class WorkerSupervisor:
+    '''
+        前端进程内的后台线程 , 定时检查各 WorkerGroup 的 worker , 故障处理见 WorkerGroup.check_workers
+    '''
+    def __init__(self, groups: typing.List, check_interval=2.0):
+        self.groups = groups
+        self.check_interval = check_interval
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.check_interval + 5)
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.check_interval):
+            for group in list(self.groups):
+                if self._stop.is_set():
+                    break
+                try:
+                    group.check_workers()
+                except Exception as e:  # noqa
+                    logger.error('{} check workers error {}'.format(group.group_name, e))
@@ -0,0 +1,841 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/10 11:32
+import copy
+import math
+import pickle
+import queue
+import threading
+import time
+import typing
+from ipc_worker.ipc_zmq_loader import IPC_zmq  # noqa
+from serving.utils import logger
+from serving.utils.ipc_codec import encode_request, ResultDecoder
+from serving.workers.hash_ring import HashRing
+
+__all__ = [
+    'WorkerUnavailableError',
+    'RequestCancelledError',
+    'WorkerLoad',
+    'WorkerGroup',
+]
+
+
+class WorkerUnavailableError(Exception):
+    pass
+
+
+class RequestCancelledError(Exception):
+    pass
+
+
+# 秒 , 等待结果时检查 cancelled 的间隔
+CANCEL_CHECK_INTERVAL = 1.0
+
+
+def estimate_request_tokens(r: typing.Dict):
+    params = r.get('params', None) or {}
+    max_new_tokens = params.get('max_new_tokens', None) or 512
+    return max_new_tokens * max(1, len(r.get('texts', None) or []))
+
+
+class WorkerLoad:
+    '''
+        单个 worker 的负载和健康状态 , 在途请求由前端记录 , 当前请求已生成 token 数来自 worker 心跳
+        state: starting 启动中 , ready 可用 , restarting 重启中 ( 模型加载完成前 ) , failed 等待重启 , retired 缩容退出中
+        generation: 每次重启或回收换一个 zmq identity , 回收时新旧进程同时存在
+    '''
+    def __init__(self, idx, state='ready'):
+        self.idx = idx
+        self.outstanding = 0
+        # 在途请求预计生成 token 总数
+        self.outstanding_tokens = 0
+        # 当前请求已生成 token 数
+        self.generated = 0
+        self.dispatched = 0
+        self.pid = None
+        self.heartbeat_time = None
+        self.state = state
+        self.busy = False
+        # 最近一次有生成进度的时间 , 判断 worker 卡死
+        self.progress_time = time.time()
+        self.start_time = time.time()
+        self.error = None
+        self.last_error = None
+        self.restarts = 0
+        # 连续失败次数 , 决定重启退避时间
+        self.failures = 0
+        self.next_restart_time = 0
+        self.generation = 0
+        # 当前进程已处理请求数和内存(MB) , 来自心跳
+        self.served = 0
+        self.rss = 0
+        # 回收 , 预热中的新进程和排空中的旧进程 [process , generation , since]
+        self.spare = None
+        self.spare_pid = None
+        self.spare_generation = 0
+        self.spare_ready = False
+        self.spare_error = None
+        self.spare_time = 0
+        self.draining = []
+        self.recycles = 0
+        self.next_recycle_time = 0
+        # 手动回收 , 如滚动重启
+        self.recycle_request = None
+
+    @property
+    def remaining_tokens(self):
+        return max(0, self.outstanding_tokens - self.generated)
+
+    def to_dict(self):
+        return {
+            "worker": self.idx,
+            "pid": self.pid,
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "remaining_tokens": self.remaining_tokens,
+            "dispatched": self.dispatched,
+            "restarts": self.restarts,
+            "last_error": self.last_error,
+            "generation": self.generation,
+            "served": self.served,
+            "rss": self.rss,
+            "recycles": self.recycles,
+            "warming": self.spare is not None,
+            "draining": len(self.draining),
+            "heartbeat_age": (time.time() - self.heartbeat_time) if self.heartbeat_time is not None else None,
+        }
+
+
+class _Inflight:
+    def __init__(self, request_id, worker_idx, generation, tokens, data):
+        # 重试后实际的 ipc request_id , 调用方始终使用第一次的 request_id
+        self.request_id = request_id
+        self.worker_idx = worker_idx
+        self.generation = generation
+        self.tokens = tokens
+        # 已编码的请求 , 用于重试
+        self.data = data
+        self.frames = 0
+        self.retries = 0
+        # 对冲请求的取消标记 (slot , token) , 原请求和副本共用
+        self.cancel = None
+
+
+class WorkerGroup(IPC_zmq):
+    '''
+        按 worker 在途请求数和剩余 token 数下发 , 也支持指定 worker 下发
+        balance: least_work 最少剩余工作量 , round_robin 轮询
+        route_key 相同的请求 ( 会话 , 公共前缀 ) 按一致性哈希优先发往同一 worker ,
+        首选 worker 在途请求超过平均值的 load_factor 倍时顺着哈希环回退到下一个
+        check_workers 由 WorkerSupervisor 定时调用 , 退出 , 初始化失败 , 心跳超时 , 卡死的 worker 按退避时间重启 ,
+        其在途请求未收到结果的在其他 worker 重试 , 否则返回失败
+        max_requests max_rss(MB) max_age(秒) 任一超限时回收 worker : 先启动新进程预热 , ready 后接替 ,
+        旧进程不再接收请求 , 处理完在途请求后退出
+        cancel_slots 为与 worker 共享的取消标记数组 , 用于请求对冲 , worker 开始执行前检查 , 已取消的跳过
+        fork_server 不为空时 worker 由 ForkServer 在模型加载后 fork , CLS_worker 为 fork_server.create_worker
+    '''
+    def __init__(self, CLS_worker, worker_args: tuple, worker_num: int, group_name, *args,
+                 codec='binary', balance='least_work', load_factor=1.25, virtual_nodes=160,
+                 ipc_timeout=600, heartbeat=True, heartbeat_timeout=30, stall_timeout=600,
+                 restart_backoff=1, max_restart_backoff=60, max_retries=1,
+                 max_requests=0, max_rss=0, max_age=0, recycle_timeout=600, cancel_slots=None, fork_server=None,
+                 **kwargs):
+        super(WorkerGroup, self).__init__(CLS_worker, worker_args, worker_num, group_name, *args, **kwargs)
+        assert codec in ['binary', 'pickle'], ValueError('codec one of binary,pickle')
+        assert balance in ['least_work', 'round_robin'], ValueError('balance one of least_work,round_robin')
+        self.CLS_worker = CLS_worker
+        self.worker_args = worker_args
+        self.group_name = group_name
+        self.worker_num = worker_num
+        self.codec = codec
+        self.balance = balance
+        # worker 是否发送心跳 , 没有心跳时无法得知模型是否加载完成 , 直接视为可用
+        self.heartbeat = heartbeat
+        # request_id -> ResultDecoder
+        self._decoders = {}
+        self.loads = [WorkerLoad(i, state='starting' if heartbeat else 'ready') for i in range(worker_num)]
+        self._ready_event = threading.Event()
+        if not heartbeat:
+            self._ready_event.set()
+        # request_id -> _Inflight
+        self._inflight = {}
+        self._load_lock = threading.Lock()
+        self._next_idx = 0
+        self.load_factor = load_factor
+        self.ring = HashRing(range(worker_num), replicas=virtual_nodes)
+        self.affinity_hits = 0
+        self.affinity_fallbacks = 0
+        self.ipc_timeout = ipc_timeout
+        self.heartbeat_timeout = heartbeat_timeout
+        self.stall_timeout = stall_timeout
+        self.restart_backoff = restart_backoff
+        self.max_restart_backoff = max_restart_backoff
+        self.max_retries = max_retries
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.max_age = max_age
+        self.recycle_timeout = recycle_timeout
+        # request_id -> 失败原因
+        self._failed = {}
+        # 已放弃的 ipc request_id , 之后到达的结果直接丢弃
+        self._dropped = {}
+        self.cancel_slots = cancel_slots
+        self.fork_server = fork_server
+        self._cancel_seq = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        # zmq SUB 按前缀订阅 , 默认 identity group_1 会收到 group_10 的请求 , 这里换成带结束符的 identity
+        for worker_idx, worker in enumerate(self.woker_process_list):
+            self.woker_process_list[worker_idx] = self._create_worker(worker_idx, 0, worker)
+
+    def start(self):
+        super(WorkerGroup, self).start()
+        for load, p in zip(self.loads, self.woker_process_list):
+            load.pid = p.pid
+            load.start_time = load.progress_time = time.time()
+
+    def terminate(self):
+        for load in self.loads:
+            for p in [load.spare] + [_[0] for _ in load.draining]:
+                if p is not None:
+                    self._stop_process(p)
+        super(WorkerGroup, self).terminate()
+        if self.fork_server is not None:
+            self.fork_server.stop()
+
+    def get_identity(self, worker_idx, generation=None):
+        if generation is None:
+            generation = self.loads[worker_idx].generation
+        return bytes('{}_{}_{}#'.format(self.group_name, worker_idx, generation), encoding='utf-8')
+
+    def _create_worker(self, worker_idx, generation, template):
+        return self.CLS_worker(
+            *self.worker_args,
+            identity=self.get_identity(worker_idx, generation),
+            group_name=self.group_name,
+            evt_quit=template._evt_quit,
+            is_log_time=template._is_log_time,
+            idx=worker_idx,
+            daemon=template.daemon
+        )
+
+    def _spawn(self, worker_idx, generation, template=None):
+        worker = self._create_worker(worker_idx, generation, template or self.woker_process_list[worker_idx])
+        worker._set_addr(self.manager_process_list[1].addr, self.manager_process_list[0].addr)
+        worker.start()
+        # 等待订阅完成 , 之后发送的请求不会丢失
+        worker.signal.wait(30)
+        del worker.signal
+        return worker
+
+    def _routable(self):
+        # 优先 ready , 都不可用时发往启动中的 worker , 请求在 zmq 中等待模型加载
+        # fork 模式的 worker 在模型加载完成后才订阅 , 启动前发出的请求会丢失 , 只发往 ready
+        ready = [_.idx for _ in self.loads if _.state == 'ready']
+        if self.fork_server is not None:
+            return ready
+        return ready or [_.idx for _ in self.loads if _.state in ['starting', 'restarting']]
+
+    def is_ready(self):
+        return self._ready_event.is_set() and any(_.state == 'ready' for _ in self.loads)
+
+    def wait_ready(self, timeout=None):
+        return self._ready_event.wait(timeout)
+
+    def route(self, route_key: typing.Optional[str]):
+        if not route_key:
+            return None
+        with self._load_lock:
+            routable = set(self._routable())
+            total = sum(_.outstanding for _ in self.loads)
+            # 有界负载 , 每个 worker 最多承担平均在途请求的 load_factor 倍
+            bound = max(1, math.ceil(self.load_factor * (total + 1) / max(1, len(routable))))
+            for i, worker_idx in enumerate(self.ring.iter_nodes(route_key)):
+                if worker_idx in routable and self.loads[worker_idx].outstanding < bound:
+                    if i == 0:
+                        self.affinity_hits += 1
+                    else:
+                        self.affinity_fallbacks += 1
+                    return worker_idx
+        return None
+
+    def _select(self, exclude=None):
+        routable = [_ for _ in self._routable() if _ != exclude]
+        if not routable:
+            raise WorkerUnavailableError('{} has no available worker'.format(self.group_name))
+        start = self._next_idx
+        self._next_idx = (self._next_idx + 1) % self.worker_num
+        # 从轮询位置开始比较 , 负载相同时依次分散
+        order = sorted(routable, key=lambda i: (i - start) % self.worker_num)
+        if self.balance == 'round_robin':
+            return order[0]
+        return min(order, key=lambda i: (self.loads[i].remaining_tokens, self.loads[i].outstanding))
+
+    def select(self):
+        with self._load_lock:
+            return self._select()
+
+    def _add_load(self, worker_idx, tokens):
+        load = self.loads[worker_idx]
+        load.outstanding += 1
+        load.outstanding_tokens += tokens
+        load.dispatched += 1
+
+    def _sub_load(self, worker_idx, tokens):
+        load = self.loads[worker_idx]
+        load.outstanding -= 1
+        load.outstanding_tokens -= tokens
+        if load.outstanding == 0:
+            load.generated = 0
+        else:
+            load.generated = max(0, load.generated - tokens)
+
+    def _release_load(self, request_id):
+        with self._load_lock:
+            inflight = self._inflight.pop(request_id, None)
+            if inflight is None:
+                return
+            self._sub_load(inflight.worker_idx, inflight.tokens)
+
+    def on_heartbeat(self, worker_idx, heartbeat: typing.Dict):
+        '''
+            返回 worker 是否刚变为就绪
+        '''
+        if worker_idx >= len(self.loads):
+            return
+        with self._load_lock:
+            load = self.loads[worker_idx]
+            pid = heartbeat.get('pid', None)
+            if load.spare is not None and pid == load.spare_pid:
+                load.spare_ready = heartbeat.get('ready', False)
+                load.spare_error = heartbeat.get('error', None)
+                return
+            if load.pid is None:
+                load.pid = pid
+            elif pid != load.pid:
+                # 已被替换或排空中的旧进程
+                return
+            now = time.time()
+            load.served = heartbeat.get('served', 0)
+            load.rss = heartbeat.get('rss', 0)
+            load.heartbeat_time = now
+            generated = heartbeat.get('generated', 0) if load.outstanding > 0 else 0
+            busy = heartbeat.get('busy', False)
+            if generated != load.generated or busy != load.busy:
+                load.progress_time = now
+            load.generated = generated
+            load.busy = busy
+            load.error = heartbeat.get('error', None)
+            if load.state in ['starting', 'restarting'] and heartbeat.get('ready', False):
+                load.state = 'ready'
+                self._ready_event.set()
+                logger.info('{} worker {} ready , load {:.1f}s'.format(self.group_name, worker_idx, now - load.start_time))
+                return True
+        return False
+
+    def ready_count(self):
+        with self._load_lock:
+            return sum(1 for _ in self.loads if _.state == 'ready')
+
+    def outstanding(self):
+        with self._load_lock:
+            return len(self._inflight)
+
+    def request_recycle(self, worker_idx, reason='manual'):
+        with self._load_lock:
+            self.loads[worker_idx].recycle_request = reason
+
+    def rolling_restart(self, timeout=None):
+        '''
+            滚动重启 , 逐个回收 worker , 前一个接替完成且旧进程退出后再处理下一个 , 其余 worker 继续服务
+            依赖心跳和 check_workers
+        '''
+        if not self.heartbeat:
+            logger.error('{} rolling restart requires worker heartbeat'.format(self.group_name))
+            return False
+        timeout = timeout or self.recycle_timeout * 2
+        for worker_idx, load in enumerate(self.loads):
+            recycles = load.recycles
+            self.request_recycle(worker_idx, 'rolling restart')
+            deadline = time.time() + timeout
+            while load.recycles == recycles or load.draining:
+                if time.time() > deadline:
+                    load.recycle_request = None
+                    logger.error('{} rolling restart worker {} timeout'.format(self.group_name, worker_idx))
+                    return False
+                time.sleep(0.5)
+            logger.info('{} rolling restart worker {} done'.format(self.group_name, worker_idx))
+        return True
+
+    def resize(self, worker_num, worker_args=None, timeout=None):
+        '''
+            调整 worker 数 , 新增的 worker 追加在末尾 , 减少时从末尾开始退出 , 先停止下发 , 等待在途请求完成
+            其余 worker 不受影响 , worker_args 为新配置 , 只用于之后启动的进程
+        '''
+        assert worker_num > 0, ValueError('worker_num must > 0')
+        if worker_args is not None:
+            self.worker_args = worker_args
+        template = self.woker_process_list[0]
+        for worker_idx in range(len(self.loads), worker_num):
+            worker = self._spawn(worker_idx, 0, template)
+            load = WorkerLoad(worker_idx, state='starting' if self.heartbeat else 'ready')
+            load.pid = worker.pid
+            # 先加入进程列表 , check_workers 按 loads 遍历
+            self.woker_process_list.append(worker)
+            with self._load_lock:
+                self.loads.append(load)
+                self.ring.add(worker_idx)
+                self.worker_num = len(self.loads)
+            logger.info('{} worker {} added , pid {}'.format(self.group_name, worker_idx, worker.pid))
+
+        timeout = self.recycle_timeout if timeout is None else timeout
+        for worker_idx in range(len(self.loads) - 1, worker_num - 1, -1):
+            load = self.loads[worker_idx]
+            with self._load_lock:
+                load.state = 'retired'
+                self.ring.remove(worker_idx)
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                with self._load_lock:
+                    busy = any(_.worker_idx == worker_idx for _ in self._inflight.values())
+                if not busy:
+                    break
+                time.sleep(0.5)
+            self._recover(worker_idx, 'retired')
+            for p in [self.woker_process_list[worker_idx], load.spare] + [_[0] for _ in load.draining]:
+                if p is not None:
+                    self._stop_process(p)
+            with self._load_lock:
+                self.loads.pop()
+                self.woker_process_list.pop()
+                self.worker_num = len(self.loads)
+                self._next_idx = 0
+            logger.info('{} worker {} retired'.format(self.group_name, worker_idx))
+        return self.worker_num
+
+    def get_state(self):
+        with self._load_lock:
+            return {
+                "ready": self.is_ready(),
+                "balance": self.balance,
+                "affinity_hits": self.affinity_hits,
+                "affinity_fallbacks": self.affinity_fallbacks,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "workers": [_.to_dict() for _ in self.loads],
+            }
+
+    def _send(self, worker_idx, generation, data):
+        request_id = self.manager_process_list[0].put(self.get_identity(worker_idx, generation), pickle.dumps(data))
+        with self.locker:
+            self.pending_request[request_id] = time.time()
+        return request_id
+
+    def put(self, data, worker_idx=None, cancelable=False):
+        tokens = estimate_request_tokens(data)
+        cancel = None
+        if cancelable and self.cancel_slots is not None:
+            with self._load_lock:
+                self._cancel_seq += 1
+                # token 从 1 开始 , 与未使用的 0 区分
+                cancel = (self._cancel_seq % len(self.cancel_slots), self._cancel_seq % 0x7fffffff or 1)
+            data = dict(data, cancel=cancel)
+        decoder = None
+        if self.codec == 'binary':
+            decoder = ResultDecoder(data)
+            data = encode_request(data)
+        with self._load_lock:
+            if worker_idx is None or self.loads[worker_idx].state == 'failed':
+                worker_idx = self._select()
+            self._add_load(worker_idx, tokens)
+            generation = self.loads[worker_idx].generation
+        request_id = self._send(worker_idx, generation, data)
+        inflight = _Inflight(request_id, worker_idx, generation, tokens, data)
+        inflight.cancel = cancel
+        with self._load_lock:
+            self._inflight[request_id] = inflight
+        if decoder is not None:
+            self._decoders[request_id] = decoder
+        return request_id
+
+    def hedge(self, request_id, allow=None):
+        '''
+            把还没有结果的请求复制一份发往负载最低的其他 ready worker , allow 为预算检查 , 返回副本 request_id 或 None
+        '''
+        with self._load_lock:
+            inflight = self._inflight.get(request_id, None)
+            if inflight is None or inflight.frames:
+                return None
+            # 不论 balance , 副本都发往剩余工作量最少的 worker
+            candidates = [_.idx for _ in self.loads if _.state == 'ready' and _.idx != inflight.worker_idx]
+            if not candidates or (allow is not None and not allow()):
+                return None
+            target = min(candidates, key=lambda i: (self.loads[i].remaining_tokens, self.loads[i].outstanding))
+            self._add_load(target, inflight.tokens)
+            generation = self.loads[target].generation
+            data, tokens, cancel = inflight.data, inflight.tokens, inflight.cancel
+            self.hedged += 1
+        hedge_id = self._send(target, generation, data)
+        duplicate = _Inflight(hedge_id, target, generation, tokens, data)
+        duplicate.cancel = cancel
+        with self._load_lock:
+            self._inflight[hedge_id] = duplicate
+        decoder = self._decoders.get(request_id, None)
+        if decoder is not None:
+            self._decoders[hedge_id] = copy.copy(decoder)
+        return hedge_id
+
+    def cancel(self, request_id):
+        '''
+            放弃请求 , 之后的结果直接丢弃 , worker 还没开始执行的跳过 , 已开始的无法中断
+            负载立即释放 , 只用于短请求对冲 , 已开始的剩余生成量小
+        '''
+        with self._load_lock:
+            inflight = self._inflight.get(request_id, None)
+            rid = inflight.request_id if inflight is not None else request_id
+            cancel = inflight.cancel if inflight is not None else None
+        if cancel is not None and self.cancel_slots is not None:
+            self.cancel_slots[cancel[0]] = cancel[1]
+        self._drop(rid)
+        self._decoders.pop(request_id, None)
+        self._release_load(request_id)
+
+    def _drop(self, request_id):
+        with self.locker:
+            self.pending_request.pop(request_id, None)
+            self.pending_response.pop(request_id, None)
+            self._dropped[request_id] = time.time()
+
+    def _poll(self, request_id, request_seq_id=None, timeout=None, drop=True):
+        '''
+            与 IPC_zmq._get_private 相同的收包逻辑 , 增加超时 , 失败和重试检查 , 返回 (response , error)
+            drop 为 False 时超时不放弃请求 , 返回 (None , None)
+        '''
+        sink = self.manager_process_list[1]
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            with self.locker:
+                with self._load_lock:
+                    error = self._failed.pop(request_id, None)
+                    inflight = self._inflight.get(request_id, None)
+                    rid = inflight.request_id if inflight is not None else request_id
+                if error is not None:
+                    return None, error
+                if rid not in self.pending_request:
+                    logger.error('bad request_id {}'.format(request_id))
+                    return None, 'bad request_id {}'.format(request_id)
+                up_time = time.time()
+                self.pending_request[rid] = up_time
+                reps = self.pending_response.get(rid, None)
+                if reps is not None:
+                    reps["time"] = up_time
+                    rep = reps["data"]
+                    for node in rep:
+                        if request_seq_id is None or node[0] == request_seq_id:
+                            rep.remove(node)
+                            if len(rep) == 0:
+                                self.pending_response.pop(rid)
+                            return node[1], None
+                try:
+                    item = sink.get_queue().get(block=False)
+                except queue.Empty:
+                    item = None
+                if item is not None:
+                    r_id, w_id, seq_id, response = item
+                    if r_id == rid and (request_seq_id is None or request_seq_id == seq_id):
+                        self._check_and_clean()
+                        return response, None
+                    if r_id not in self._dropped:
+                        if r_id in self.pending_response:
+                            self.pending_response[r_id]["data"].append((seq_id, response))
+                        else:
+                            self.pending_response[r_id] = {
+                                "time": time.time(),
+                                "data": [(seq_id, response)],
+                                "last_seq": seq_id - 1,
+                            }
+            if deadline is not None and time.time() > deadline:
+                if not drop:
+                    return None, None
+                self._drop(rid)
+                return None, 'worker response timeout after {}s'.format(timeout)
+            if item is None:
+                time.sleep(0.001)
+
+    def get(self, request_id, request_seq_id=None, timeout=None, cancelled=None):
+        '''
+            cancelled() 为 True 且还没有收到结果时取消请求 , 抛出 RequestCancelledError ; 已收到结果的继续等待 , 由调用方读完
+        '''
+        deadline = time.time() + (timeout or self.ipc_timeout)
+        while True:
+            remaining = max(deadline - time.time(), 0.001)
+            last = cancelled is None or remaining <= CANCEL_CHECK_INTERVAL
+            d, error = self._poll(request_id, request_seq_id, timeout=remaining if last else CANCEL_CHECK_INTERVAL,
+                                  drop=last)
+            if last or d is not None or error is not None:
+                return self._result(request_id, d, error)
+            if cancelled():
+                with self._load_lock:
+                    inflight = self._inflight.get(request_id, None)
+                    started = inflight is not None and inflight.frames > 0
+                if not started:
+                    self.cancel(request_id)
+                    raise RequestCancelledError('request {} cancelled'.format(request_id))
+
+    def get_hedged(self, request_id, delay, allow=None):
+        '''
+            非流式请求 , delay 秒内没有结果时对冲 , 返回先完成的结果 , 另一份取消 , 返回 (result , hedged , hedge_won)
+            一份因 worker 故障失败时继续等待另一份
+        '''
+        d, error = self._poll(request_id, timeout=delay, drop=False)
+        if d is not None or error is not None:
+            return self._result(request_id, d, error), False, False
+        hedge_id = self.hedge(request_id, allow)
+        if hedge_id is None:
+            return self.get(request_id), False, False
+        pending = [request_id, hedge_id]
+        deadline = time.time() + self.ipc_timeout
+        while True:
+            for rid in list(pending):
+                d, error = self._poll(rid, timeout=0.002, drop=False)
+                if d is None and error is None:
+                    continue
+                if error is not None and len(pending) > 1:
+                    # 失败的一份已不在途 , 不能设置共用的取消标记
+                    pending.remove(rid)
+                    self._result(rid, d, error)
+                    continue
+                for other in pending:
+                    if other != rid:
+                        self.cancel(other)
+                won = rid == hedge_id
+                if won:
+                    with self._load_lock:
+                        self.hedge_wins += 1
+                return self._result(rid, d, error), True, won
+            if time.time() > deadline:
+                for rid in pending:
+                    self.cancel(rid)
+                return {"code": -1, "msg": 'worker response timeout after {}s'.format(self.ipc_timeout),
+                        "complete": True}, True, False
+
+    def _result(self, request_id, d, error):
+        if error is not None:
+            result = {"code": -1, "msg": error, "complete": True}
+        else:
+            d = pickle.loads(d)
+            if not isinstance(d, bytes):
+                result = d
+            else:
+                decoder = self._decoders.get(request_id, None)
+                if decoder is None:
+                    decoder = self._decoders[request_id] = ResultDecoder({})
+                result = decoder.decode(d)
+        if result is None or result.get("complete", True):
+            self._decoders.pop(request_id, None)
+            self._release_load(request_id)
+        else:
+            with self._load_lock:
+                inflight = self._inflight.get(request_id, None)
+                if inflight is not None:
+                    inflight.frames += 1
+        return result
+
+    def _stop_process(self, p):
+        try:
+            if p.is_alive():
+                p.terminate()
+                p.join(5)
+            if p.is_alive():
+                p.kill()
+                p.join(5)
+        except Exception as e:  # noqa
+            logger.warning(e)
+
+    def _next_generation(self, load: WorkerLoad):
+        return max([load.generation, load.spare_generation] + [_[1] for _ in load.draining]) + 1
+
+    def _respawn(self, worker_idx):
+        generation = self._next_generation(self.loads[worker_idx])
+        worker = self._spawn(worker_idx, generation)
+        self.woker_process_list[worker_idx] = worker
+        with self._load_lock:
+            load = self.loads[worker_idx]
+            load.generation = generation
+            load.served = load.rss = 0
+            load.state = 'restarting' if self.heartbeat else 'ready'
+            load.pid = worker.pid
+            load.heartbeat_time = None
+            load.error = None
+            load.busy = False
+            load.start_time = load.progress_time = time.time()
+            load.restarts += 1
+        logger.info('{} worker {} respawned , pid {}'.format(self.group_name, worker_idx, worker.pid))
+
+    def _recover(self, worker_idx, reason, generation=None):
+        '''
+            故障 worker 的在途请求 , 还没有收到结果的在其他 worker 重试 , 否则返回失败
+        '''
+        retry = []
+        dropped = []
+        with self._load_lock:
+            for request_id, inflight in list(self._inflight.items()):
+                if inflight.worker_idx != worker_idx:
+                    continue
+                if generation is not None and inflight.generation != generation:
+                    continue
+                dropped.append(inflight.request_id)
+                target = None
+                if inflight.frames == 0 and inflight.retries < self.max_retries:
+                    try:
+                        target = self._select(exclude=worker_idx)
+                    except WorkerUnavailableError:
+                        target = None
+                if target is None:
+                    self._failed[request_id] = 'worker {} {}'.format(worker_idx, reason)
+                    self._sub_load(worker_idx, inflight.tokens)
+                    self._inflight.pop(request_id)
+                    continue
+                self._sub_load(worker_idx, inflight.tokens)
+                self._add_load(target, inflight.tokens)
+                inflight.worker_idx = target
+                inflight.generation = self.loads[target].generation
+                inflight.retries += 1
+                retry.append(inflight)
+
+        for request_id in dropped:
+            self._drop(request_id)
+        for inflight in retry:
+            old_id = inflight.request_id
+            new_id = self._send(inflight.worker_idx, inflight.generation, inflight.data)
+            with self.locker:
+                with self._load_lock:
+                    inflight.request_id = new_id
+            logger.info('{} retry request {} on worker {}'.format(self.group_name, old_id, inflight.worker_idx))
+
+    def _fail_worker(self, worker_idx, reason):
+        with self._load_lock:
+            load = self.loads[worker_idx]
+            load.state = 'failed'
+            load.last_error = reason
+            backoff = min(self.max_restart_backoff, self.restart_backoff * (2 ** load.failures))
+            load.failures += 1
+            load.next_restart_time = time.time() + backoff
+            generation = load.generation
+        logger.error('{} worker {} {} , restart after {}s'.format(self.group_name, worker_idx, reason, backoff))
+        self._stop_process(self.woker_process_list[worker_idx])
+        if load.spare is not None:
+            self._stop_process(load.spare)
+            load.spare = load.spare_pid = None
+        self._recover(worker_idx, reason, generation)
+
+    def _recycle_reason(self, load: WorkerLoad, now):
+        if load.recycle_request:
+            return load.recycle_request
+        if self.max_requests and load.served >= self.max_requests:
+            return 'served {} requests'.format(load.served)
+        if self.max_rss and load.rss >= self.max_rss:
+            return 'rss {:.0f}MB'.format(load.rss)
+        if self.max_age and now - load.start_time >= self.max_age:
+            return 'age {:.0f}s'.format(now - load.start_time)
+        return None
+
+    def _promote(self, worker_idx):
+        now = time.time()
+        with self._load_lock:
+            load = self.loads[worker_idx]
+            load.draining.append([self.woker_process_list[worker_idx], load.generation, now])
+            self.woker_process_list[worker_idx] = load.spare
+            load.generation = load.spare_generation
+            load.pid = load.spare_pid
+            load.spare = load.spare_pid = None
+            load.spare_ready = False
+            load.served = load.rss = 0
+            load.busy = False
+            load.heartbeat_time = None
+            load.start_time = load.progress_time = now
+            load.recycles += 1
+        logger.info('{} worker {} recycled , pid {}'.format(self.group_name, worker_idx, load.pid))
+
+    def _check_recycle(self, worker_idx, now):
+        load = self.loads[worker_idx]
+        # 旧进程处理完在途请求后退出 , 超时的在途请求按故障处理
+        for item in list(load.draining):
+            p, generation, since = item
+            with self._load_lock:
+                busy = any(_.worker_idx == worker_idx and _.generation == generation for _ in self._inflight.values())
+            if busy and p.is_alive() and now - since < self.recycle_timeout:
+                continue
+            # 刚接替时可能还有请求正在发往旧进程 , 稍等再退出
+            if not busy and now - since < 5:
+                continue
+            if busy:
+                self._recover(worker_idx, 'drain timeout', generation)
+            self._stop_process(p)
+            load.draining.remove(item)
+
+        if load.spare is not None:
+            if load.spare_ready:
+                self._promote(worker_idx)
+            elif load.spare_error or not load.spare.is_alive() or now - load.spare_time > self.recycle_timeout:
+                logger.error('{} worker {} recycle failed , {}'.format(
+                    self.group_name, worker_idx, load.spare_error or 'spare not ready'))
+                self._stop_process(load.spare)
+                load.spare = load.spare_pid = None
+                load.next_recycle_time = now + self.max_restart_backoff
+            return
+
+        # 回收依赖心跳上报的 ready served rss
+        if not self.heartbeat or load.state != 'ready' or now < load.next_recycle_time:
+            return
+        reason = self._recycle_reason(load, now)
+        if reason is None:
+            return
+        generation = self._next_generation(load)
+        load.recycle_request = None
+        logger.info('{} worker {} {} , start recycle'.format(self.group_name, worker_idx, reason))
+        spare = self._spawn(worker_idx, generation)
+        with self._load_lock:
+            load.spare = spare
+            load.spare_pid = spare.pid
+            load.spare_generation = generation
+            load.spare_ready = False
+            load.spare_error = None
+            load.spare_time = now
+
+    def check_workers(self):
+        now = time.time()
+        for worker_idx, load in enumerate(self.loads):
+            if load.state == 'retired':
+                continue
+            if load.state == 'failed':
+                if now >= load.next_restart_time:
+                    try:
+                        self._respawn(worker_idx)
+                    except Exception as e:  # noqa
+                        self._fail_worker(worker_idx, 'respawn error {}'.format(e))
+                continue
+            p = self.woker_process_list[worker_idx]
+            reason = None
+            if not p.is_alive():
+                reason = 'exited with code {}'.format(p.exitcode)
+            elif load.error:
+                reason = 'init error {}'.format(load.error)
+            elif self.heartbeat_timeout and load.heartbeat_time is not None \
+                    and now - load.heartbeat_time > self.heartbeat_timeout:
+                reason = 'heartbeat timeout'
+            elif self.stall_timeout and load.busy and now - load.progress_time > self.stall_timeout:
+                reason = 'stalled {:.0f}s'.format(now - load.progress_time)
+            if reason is not None:
+                self._fail_worker(worker_idx, reason)
+                continue
+            if load.state == 'ready' and load.failures and now - load.start_time > self.max_restart_backoff:
+                # 稳定运行后重置退避
+                load.failures = 0
+            self._check_recycle(worker_idx, now)
+
+        # 清理过期的丢弃记录
+        with self.locker:
+            for request_id in [k for k, t in self._dropped.items() if now - t > 3600]:
+                self._dropped.pop(request_id, None)
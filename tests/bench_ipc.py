@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/12 11:30
+# 流式结果 ipc 编码对比 , 每个 token 的字节数和编解码 cpu 耗时
+import os
+import pickle
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from serving.utils.ipc_codec import encode_request, decode_request, ResultEncoder, ResultDecoder
+
+
+def make_request(history_turns, turn_chars, gtype):
+    history = [{"q": "问" * turn_chars, "a": "答" * turn_chars} for _ in range(history_turns)]
+    return {
+        "method": "chat_stream",
+        "model": "chatglm2-6b-int4",
+        "query": "你好",
+        "history": history,
+        "params": {"adapter_name": "default", "max_new_tokens": 512, "gtype": gtype, "nchar": 1},
+        "timing": {"receive": time.time(), "enqueue": time.time()},
+    }
+
+
+def make_frames(r, tokens, gtype):
+    # 与 model_handler 推送的结果一致 , 每帧带完整 history
+    history = [(_["q"], _["a"]) for _ in r["history"]]
+    text = ''
+    for i in range(tokens):
+        text += '字'
+        yield {"code": 0, "runtime": 1.0, "msg": "ok", "complete": False,
+               "result": text if gtype == 'total' else '字', "history": history}
+    yield {"code": 0, "runtime": 1.0, "msg": "ok", "complete": True, "result": "", "history": history,
+           "timing": {"receive": 0.0, "pickup": 0.0, "prompt_tokens": 10, "completion_tokens": tokens}}
+
+
+def bench_pickle(r, frames):
+    n_bytes = len(pickle.dumps(r))
+    t = time.process_time()
+    for ret in frames:
+        # 旧格式 , worker pickle.dumps , 前端 pickle.loads
+        d = pickle.dumps(ret)
+        n_bytes += len(d)
+        pickle.loads(d)
+    return n_bytes, time.process_time() - t
+
+
+def bench_binary(r, frames):
+    t = time.process_time()
+    msg = pickle.dumps(encode_request(r))
+    n_bytes = len(msg)
+    req = decode_request(pickle.loads(msg))
+    encoder = ResultEncoder(req["method"])
+    decoder = ResultDecoder(r)
+    for ret in frames:
+        # ipc_worker 仍会 pickle 一层 bytes
+        d = pickle.dumps(encoder.encode(ret))
+        n_bytes += len(d)
+        decoder.decode(pickle.loads(d))
+    return n_bytes, time.process_time() - t
+
+
+def main():
+    tokens = 512
+    print('{:<10}{:<10}{:<10}{:>16}{:>16}{:>16}{:>16}'.format(
+        'gtype', 'history', 'codec', 'bytes/token', 'us/token', 'total KB', 'total ms'))
+    for gtype in ['increace', 'total']:
+        for history_turns in [0, 4, 16]:
+            r = make_request(history_turns, 200, gtype)
+            frames = list(make_frames(r, tokens, gtype))
+            for codec, fn in [('pickle', bench_pickle), ('binary', bench_binary)]:
+                n_bytes, cost = fn(r, frames)
+                print('{:<10}{:<10}{:<10}{:>16.1f}{:>16.2f}{:>16.1f}{:>16.2f}'.format(
+                    gtype, history_turns, codec, n_bytes / tokens, cost * 1e6 / tokens, n_bytes / 1024, cost * 1000))
+
+
+if __name__ == '__main__':
+    main()
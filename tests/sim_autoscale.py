@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/13 14:30
+# 自动扩缩容策略离线模拟 , 突发流量下对比固定 worker 数和自动扩缩容的排队时间与占用的 worker 时长
+# 不启动进程 , 每个 worker 同一时间处理一个请求 , 新 worker 需要 load_time 秒加载
+import os
+import random
+import sys
+from collections import deque
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from config.main import global_autoscale_args
+from serving.serve.autoscaler import AutoScalePolicy
+
+
+def arrival_rate(t):
+    # 平时每秒 0.1 个请求 , 每 20 分钟有 5 分钟突发到每秒 0.8 个
+    return 0.8 if t % 1200 < 300 else 0.1
+
+
+def simulate(policy, workers, duration=3600, service_time=4.0, load_time=60, interval=5, seed=1):
+    rng = random.Random(seed)
+    queue = deque()
+    # 每个 worker : [可用时间 , 当前请求结束时间]
+    slots = [[0.0, 0.0] for _ in range(workers)]
+    waits = []
+    # 上次检查时已下发的请求数
+    checked = 0
+    worker_seconds = 0.0
+    timeline = []
+    for t in range(duration):
+        if rng.random() < arrival_rate(t):
+            queue.append(t)
+        for slot in slots:
+            if slot[0] <= t and slot[1] <= t and queue:
+                waits.append(t - queue.popleft())
+                slot[1] = t + rng.expovariate(1.0 / service_time)
+        worker_seconds += len(slots)
+        if policy is not None and t % interval == 0:
+            starting = sum(1 for _ in slots if _[0] > t)
+            inflight = sum(1 for _ in slots if _[1] > t)
+            oldest_wait = t - queue[0] if queue else 0.0
+            recent = waits[checked:]
+            checked = len(waits)
+            target = policy.decide(t, len(slots), starting=starting, queued=len(queue),
+                                   inflight=inflight, oldest_wait=oldest_wait,
+                                   avg_wait=sum(recent) / len(recent) if recent else 0.0)
+            if target != len(slots):
+                policy.record(t)
+                if target > len(slots):
+                    slots.append([t + load_time, 0.0])
+                else:
+                    # 缩容时去掉末尾的 worker , 在途请求处理完再退出 , 这里简化为立即退出
+                    slots.pop()
+        if t % 300 == 0:
+            timeline.append(len(slots))
+    waits.sort()
+    p95 = waits[int(len(waits) * 0.95)] if waits else 0
+    return {
+        "requests": len(waits),
+        "mean_wait": sum(waits) / max(1, len(waits)),
+        "p95_wait": p95,
+        "worker_hours": worker_seconds / 3600,
+        "timeline": timeline,
+    }
+
+
+def main():
+    policy_args = {k: v for k, v in global_autoscale_args.items()
+                   if k not in ['enable', 'interval', 'dry_run', 'max_workers_per_device']}
+    print('{:<24}{:>10}{:>14}{:>14}{:>16}  {}'.format('mode', 'requests', 'mean wait(s)', 'p95 wait(s)', 'worker hours', 'workers every 5min'))
+    for name, policy, workers in [
+        ('fixed 1', None, 1),
+        ('fixed 4', None, 4),
+        ('autoscale 1-4', AutoScalePolicy(min_workers=1, max_workers=4, **policy_args), 1),
+        ('autoscale 1-4 fast', AutoScalePolicy(min_workers=1, max_workers=4, **dict(
+            policy_args, up_cooldown=20, down_cooldown=120, scale_down_delay=120)), 1),
+    ]:
+        ret = simulate(policy, workers, interval=global_autoscale_args["interval"])
+        print('{:<24}{:>10}{:>14.1f}{:>14.1f}{:>16.2f}  {}'.format(
+            name, ret["requests"], ret["mean_wait"], ret["p95_wait"], ret["worker_hours"], ret["timeline"]))
+
+
+if __name__ == '__main__':
+    main()
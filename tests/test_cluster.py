@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/13 18:20
+# 本机多进程模拟多机部署 , 一个网关和若干 node 进程 , node 用模拟 handler 代替模型
+# 验证 node 注册和签名 , 按 worker 数分配 , 会话亲和 , node 被 kill 后重试 , node 重启后恢复 , 伪造的请求和结果帧被丢弃
+# python -m pytest tests/test_cluster.py
+import json
+import multiprocessing
+import os
+import pickle
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+
+import pytest
+import zmq
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from serving.serve.cluster import Gateway, NodeAgent, _sign
+from serving.utils.ipc_codec import encode_request, ResultDecoder
+
+SECRET = 'test-secret'
+
+
+def get_free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def run_node(gateway_addr, node_id, workers, secret, first_delay):
+    def handler(model_name, r):
+        # 模拟流式生成 , 每帧返回 node_id 和 query , 用于检查路由和结果
+        time.sleep(first_delay)
+        for i in range(3):
+            time.sleep(0.02)
+            yield {"code": 0, "result": '{}:{}:{}'.format(node_id, r["query"], i), "complete": False}
+        yield {"code": 0, "result": '{}:{}:done'.format(node_id, r["query"]), "complete": True}
+
+    def get_models():
+        return {"mock-chat": {"ready": True, "workers": workers, "outstanding": 0}}
+
+    agent = NodeAgent(gateway_addr, node_id, handler, get_models, heartbeat_interval=0.2, secret=secret)
+    agent.start()
+    while True:
+        time.sleep(1)
+
+
+def start_node(gateway_addr, node_id, workers, secret=SECRET, first_delay=0.0):
+    p = multiprocessing.Process(target=run_node, args=(gateway_addr, node_id, workers, secret, first_delay),
+                                daemon=True)
+    p.start()
+    return p
+
+
+def wait_for(cond, timeout=10):
+    deadline = time.time() + timeout
+    while not cond():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def call(group, query, route_key=None, worker_idx=None):
+    '''
+        返回 (处理的 node , 最后一帧)
+    '''
+    if worker_idx is None:
+        worker_idx = group.route(route_key)
+    request_id = group.put({"method": "chat_stream", "query": query, "history": [], "params": {"max_new_tokens": 8}},
+                           worker_idx=worker_idx)
+    while True:
+        ret = group.get(request_id, timeout=10)
+        if ret["code"] != 0 or ret["complete"]:
+            node = ret["result"].split(':')[0] if ret["code"] == 0 else None
+            return node, ret
+
+
+def run_clients(group, n_threads, n_requests, route_key=None):
+    results = []
+    lock = threading.Lock()
+
+    def client(t):
+        for i in range(n_requests):
+            query = 'q{}-{}'.format(t, i)
+            node, ret = call(group, query, route_key)
+            with lock:
+                results.append((query, node, ret))
+
+    threads = [threading.Thread(target=client, args=(t,)) for t in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+@pytest.fixture()
+def cluster():
+    addr = 'tcp://127.0.0.1:{}'.format(get_free_port())
+    gateway = Gateway(addr, heartbeat_timeout=1, max_retries=1, secret=SECRET)
+    gateway.start()
+    procs = []
+    yield gateway, addr, procs
+    for p in procs:
+        p.kill()
+    gateway.stop()
+
+
+def wait_nodes(gateway, node_ids):
+    return wait_for(lambda: set(node_ids) <= {k for k, v in gateway.nodes.items() if v.alive}
+                    and 'mock-chat' in gateway.groups)
+
+
+def test_secret_required_for_public_bind():
+    with pytest.raises(AssertionError):
+        Gateway('tcp://0.0.0.0:{}'.format(get_free_port()))
+    # 本机地址可以不设置
+    Gateway('tcp://127.0.0.1:{}'.format(get_free_port()))
+
+
+def test_balance_by_workers(cluster):
+    gateway, addr, procs = cluster
+    # A 有 1 个 worker , B 有 3 个
+    procs += [start_node(addr, 'A', 1), start_node(addr, 'B', 3)]
+    assert wait_nodes(gateway, ['A', 'B'])
+    group = gateway.groups['mock-chat']
+    assert group.is_ready()
+
+    results = run_clients(group, 8, 10)
+    assert len(results) == 80
+    for query, node, ret in results:
+        assert ret["code"] == 0, ret
+        assert ret["result"] == '{}:{}:done'.format(node, query)
+    counter = Counter(node for _, node, _ in results)
+    assert set(counter) == {'A', 'B'}
+    assert counter['B'] > counter['A']
+    assert not gateway.inflight
+    assert sum(group.node_outstanding.values()) == 0
+
+
+def test_affinity(cluster):
+    gateway, addr, procs = cluster
+    procs += [start_node(addr, 'A', 2), start_node(addr, 'B', 2)]
+    assert wait_nodes(gateway, ['A', 'B'])
+    group = gateway.groups['mock-chat']
+    # 同一会话的请求串行发送 , 都落在同一 node
+    results = run_clients(group, 1, 10, route_key='conversation-1')
+    assert len({node for _, node, _ in results}) == 1
+    assert all(ret["code"] == 0 for _, _, ret in results)
+    assert group.affinity_hits == 10
+
+
+def test_failover_and_recover(cluster):
+    gateway, addr, procs = cluster
+    node_a = start_node(addr, 'A', 1)
+    # B 首帧前等待 , 被 kill 时请求还没有结果 , 应在 A 重试
+    node_b = start_node(addr, 'B', 3, first_delay=1.0)
+    procs += [node_a, node_b]
+    assert wait_nodes(gateway, ['A', 'B'])
+    group = gateway.groups['mock-chat']
+
+    results = []
+    threads = [threading.Thread(target=lambda i=i: results.append(('r{}'.format(i),) +
+                                                               call(group, 'r{}'.format(i), worker_idx='B')))
+               for i in range(4)]
+    for t in threads:
+        t.start()
+    time.sleep(0.3)
+    node_b.kill()
+    for t in threads:
+        t.join()
+
+    assert len(results) == 4
+    for query, node, ret in results:
+        assert ret["code"] == 0, ret
+        assert node == 'A'
+        assert ret["result"] == 'A:{}:done'.format(query)
+    assert not gateway.nodes['B'].alive
+    assert not gateway.inflight
+
+    # B 重启后重新注册并接收请求
+    procs.append(start_node(addr, 'B', 3))
+    assert wait_nodes(gateway, ['A', 'B'])
+    node, ret = call(group, 'again', worker_idx='B')
+    assert node == 'B' and ret["result"] == 'B:again:done'
+
+
+def test_bad_secret_rejected(cluster):
+    gateway, addr, procs = cluster
+    procs.append(start_node(addr, 'evil', 8, secret='wrong'))
+    procs.append(start_node(addr, 'nosecret', 8, secret=None))
+    procs.append(start_node(addr, 'A', 1))
+    assert wait_nodes(gateway, ['A'])
+    time.sleep(0.5)
+    assert set(gateway.nodes) == {'A'}
+
+
+def test_heartbeat_bound_to_identity(cluster):
+    gateway, addr, procs = cluster
+    procs.append(start_node(addr, 'A', 1))
+    assert wait_nodes(gateway, ['A'])
+    # 另一个连接重放为 A 的 identity 签名的心跳 , 不能抢占 A
+    payload = json.dumps({"node_id": "A", "models": {"mock-chat": {"ready": True, "workers": 8}},
+                          "time": time.time(), "seq": 10 ** 9}).encode('utf-8')
+    identity = gateway.nodes['A'].identity
+    context = zmq.Context()
+    try:
+        sock = context.socket(zmq.DEALER)
+        sock.setsockopt(zmq.IDENTITY, b'attacker')
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(addr)
+        for _ in range(5):
+            sock.send_multipart([b'heartbeat', payload, _sign(SECRET, identity, b'heartbeat', payload)])
+            time.sleep(0.1)
+        assert gateway.nodes['A'].identity == identity
+        assert gateway.nodes['A'].models["mock-chat"]["workers"] == 1
+    finally:
+        context.destroy(linger=0)
+
+
+class _Evil:
+    # 被 pickle.loads 时创建标记文件
+    def __init__(self, marker):
+        self.marker = marker
+
+    def __reduce__(self):
+        return open, (self.marker, 'w')
+
+
+def test_forged_result_rejected(cluster, tmp_path):
+    gateway, addr, procs = cluster
+    procs.append(start_node(addr, 'A', 1, first_delay=2.0))
+    assert wait_nodes(gateway, ['A'])
+    group = gateway.groups['mock-chat']
+    request_id = group.put({"method": "chat_stream", "query": "q", "history": [], "params": {}}, worker_idx='A')
+    marker = str(tmp_path / 'pwned')
+    # 结果帧 : 头部 version=1 kind=obj flags=complete , 载荷为恶意 pickle
+    frame = bytes([1, 3, 1]) + b'\0' * 8 + pickle.dumps(_Evil(marker))
+    identity = gateway.nodes['A'].identity
+    context = zmq.Context()
+    try:
+        # 用 A 的 identity 接管连接后发送伪造结果
+        sock = context.socket(zmq.DEALER)
+        sock.setsockopt(zmq.IDENTITY, identity)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(addr)
+        for signature in [b'', _sign('wrong', identity, b'result', request_id, frame)]:
+            sock.send_multipart([b'result', request_id, frame, signature])
+        time.sleep(0.5)
+        assert gateway.inflight[request_id].frames == 0
+        assert not os.path.exists(marker)
+    finally:
+        context.destroy(linger=0)
+        gateway.finish(request_id)
+
+
+def test_node_rejects_unsigned_request(tmp_path):
+    addr = 'tcp://127.0.0.1:{}'.format(get_free_port())
+    calls = []
+
+    def handler(model_name, r):
+        calls.append(r)
+        yield {"code": 0, "result": [1.5, 2.5], "complete": True}
+
+    context = zmq.Context()
+    agent = NodeAgent(addr, 'N', handler, lambda: {"mock-chat": {"ready": True, "workers": 1}},
+                      heartbeat_interval=0.2, secret=SECRET)
+    try:
+        router = context.socket(zmq.ROUTER)
+        router.setsockopt(zmq.LINGER, 0)
+        router.bind(addr)
+        agent.start()
+        assert router.poll(5000)
+        identity = router.recv_multipart()[0]
+        marker = str(tmp_path / 'pwned')
+        r = {"model": "mock-chat", "method": "generate", "texts": ["x"]}
+        # pickle 编码的 extra , 未签名和签名错误的请求都不执行
+        evil = encode_request(dict(r, evil=_Evil(marker)))
+        router.send_multipart([identity, b'request', b'1', evil])
+        router.send_multipart([identity, b'request', b'2', evil, _sign('wrong', identity, b'request', b'2', evil)])
+        time.sleep(0.5)
+        assert not calls and not os.path.exists(marker)
+
+        payload = encode_request(r, safe=True)
+        router.send_multipart([identity, b'request', b'3', payload, _sign(SECRET, identity, b'request', b'3', payload)])
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            assert router.poll(5000)
+            frames = router.recv_multipart()
+            if frames[1] == b'result':
+                break
+        assert frames[2] == b'3'
+        assert frames[4] == _sign(SECRET, identity, b'result', frames[2], frames[3])
+        assert ResultDecoder(r, safe=True).decode(frames[3])["result"] == [1.5, 2.5]
+        assert len(calls) == 1
+    finally:
+        agent.stop()
+        context.destroy(linger=0)
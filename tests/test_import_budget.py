@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# @Author  : ssbuild
+# @Time    : 2023/8/11 9:40
+# 前端进程导入预算 , api 进程不能导入 torch transformers 等模型依赖
+import os
+import subprocess
+import sys
+
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# 秒 , 前端导入耗时上限
+import_budget = float(os.environ.get('IMPORT_BUDGET', 1.0))
+
+heavy_modules = ['torch', 'transformers', 'deepspeed', 'accelerate', 'peft', 'deep_training', 'bitsandbytes']
+
+code = '''
+import sys,time,json
+t = time.time()
+import serving.serve.api
+cost = time.time() - t
+print(json.dumps({"cost": cost, "modules": [m for m in %r if m in sys.modules]}))
+''' % (heavy_modules,)
+
+
+def test_import_budget():
+    import json
+    # 新进程导入 , 避免当前进程已导入的模块影响结果
+    out = subprocess.run([sys.executable, '-c', code], cwd=root_dir, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout
+    result = json.loads(out.strip().splitlines()[-1])
+    print(result)
+    assert not result["modules"], 'front end imports heavy modules {}'.format(result["modules"])
+    assert result["cost"] < import_budget, 'front end import cost {:.3f}s > {}s'.format(result["cost"], import_budget)
+
+
+if __name__ == '__main__':
+    test_import_budget()